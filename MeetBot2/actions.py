@@ -0,0 +1,71 @@
+import re
+
+from . import formatting
+
+# A nick made only of word characters matches "\bnick\b" exactly
+# when it is one of these tokens, so most nicks can be looked up in a
+# dict instead of searching every line with a regex of their own.
+word_re = re.compile(r'\w+')
+
+
+class ActionIndex(object):
+    """Which action items are assigned to which attendee.
+
+    An action item is assigned to every attendee whose nick appears
+    in it as a whole word (case insensitive).  Each ACTION line is
+    tokenized once and its words looked up in a table of the nicks;
+    only nicks with non-word characters in them (like 'T-Rex') are
+    searched for with makeNickRE.
+
+    Attributes:
+      nicks:       attendees, sorted case-insensitively
+      byNick:      nick -> list of action items assigned to that nick
+      unassigned:  action items assigned to nobody
+    """
+    def __init__(self, nicks, minutes):
+        self.nicks = sorted(nicks, key=lambda x: x.lower())
+        self.byNick = dict([ (nick, [ ]) for nick in self.nicks ])
+        self.unassigned = [ ]
+        words = { }
+        others = [ ]
+        for nick in self.nicks:
+            if word_re.fullmatch(nick):
+                words.setdefault(nick.lower(), [ ]).append(nick)
+            else:
+                others.append((nick, formatting.makeNickRE(nick)))
+        for m in minutes:
+            if m.itemtype != "ACTION": continue
+            found = set()
+            for word in word_re.findall(m.line):
+                for nick in words.get(word.lower(), ()):
+                    if nick not in found:
+                        found.add(nick)
+                        self.byNick[nick].append(m)
+            for nick, nick_re in others:
+                if nick_re.search(m.line) is not None:
+                    found.add(nick)
+                    self.byNick[nick].append(m)
+            if not found:
+                self.unassigned.append(m)
+
+    def iterNicks(self):
+        """Yield (nick, action items) for every attendee, in order."""
+        for nick in self.nicks:
+            yield nick, self.byNick[nick]
+
+
+def actionIndex(M):
+    """Return the ActionIndex of a meeting.
+
+    It is kept on the meeting until the minutes or the set of
+    attendees change."""
+    if hasattr(M, 'versions'):
+        key = M.versions(('minutes', 'attendees'))
+    else:
+        key = None
+    cached = getattr(M, '_actionIndex', None)
+    if key is not None and cached is not None and cached[0] == key:
+        return cached[1]
+    index = ActionIndex(list(M.attendees.keys()), M.minutes)
+    M._actionIndex = (key, index)
+    return index
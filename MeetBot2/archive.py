@@ -0,0 +1,273 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import meeting
+
+# Config settings which don't change what the writers output, so
+# changing them doesn't call for a rebuild.  (writer_map is looked at
+# per output.)
+_notRendering = frozenset([
+    'logFileDir', 'writer_map', 'update_realtime', 'dontSave',
+    'RestrictPerm', 'fsyncPolicy', 'fsyncInterval',
+    'realtimeMaxLatency', 'realtimeMaxDirtyLines',
+    'inboxSize', 'inboxOverflow', 'inboxBlockTimeout',
+    'journalDir', 'journalSnapshotEvery', 'offloadTimeout',
+    'wikiPublisher', 'catalogFile',
+    ])
+
+
+def configHash(config):
+    """Return a hash of the settings of config the output depends on."""
+    values = [ ]
+    for name in dir(type(config)):
+        if name.startswith('_') or name in _notRendering:
+            continue
+        if isinstance(getattr(type(config), name), property):
+            continue
+        value = getattr(config, name)
+        if hasattr(value, 'pattern'):
+            value = value.pattern
+        if not isinstance(value, (str, int, float, tuple, list, dict,
+                                  type(None))):
+            continue
+        values.append((name, value))
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def fileHash(path):
+    """Return the sha1 of the contents of the file at path."""
+    digest = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        for block in iter(lambda: f.read(65536), b''):
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def splitKey(writerkey):
+    """Split a writer_map key into (extension, args), like Config.save."""
+    if '|' in writerkey:
+        extension, args = writerkey.split('|', 1)
+        args = dict([ a.split('=', 1) for a in args.split('|') ])
+        return extension, args
+    return writerkey, { }
+
+
+def outputVersions(config):
+    """Return {writer_map key: version} of the file outputs of config.
+
+    The version of an output changes whenever something it is made
+    from (besides the log) changes: the writer (its class and
+    `version`), the files it uses (`sources`), or the settings in
+    config.  The log itself (a .log.txt output) isn't one of them."""
+    confighash = configHash(config)
+    versions = { }
+    for writerkey, writer in config.writers.items():
+        extension, args = splitKey(writerkey)
+        if extension.lower()[:5] in (".none", "."):
+            # Not a file: don't re-publish the whole archive.
+            continue
+        if extension.lower() == '.log.txt':
+            # What everything is rebuilt from: never write it over.
+            continue
+        cls = type(writer)
+        parts = [ writerkey, '%s.%s'%(cls.__module__, cls.__name__),
+                  str(getattr(writer, 'version', 1)), confighash ]
+        for path in writer.sources(extension, **args):
+            parts.append(fileHash(path))
+        versions[writerkey] = hashlib.sha1(
+            '\0'.join(parts).encode('utf-8')).hexdigest()
+    return versions
+
+
+def findLogs(config):
+    """Return the paths of all raw logs (.log.txt) under logFileDir.
+
+    Only the directories and names filenamePattern (and
+    specialChannelFilenamePattern) can produce are looked at."""
+    found = set()
+    for pattern in (config.filenamePattern,
+                    config.specialChannelFilenamePattern):
+        pattern = pattern%{'channel':'*', 'network':'*',
+                           'meetingname':'*'}
+        # What strftime would fill in:
+        pattern = re.sub(r'%.', '*', pattern)
+        pattern = os.path.join(glob.escape(config.logFileDir),
+                               pattern + '.log.txt')
+        found.update(glob.glob(pattern))
+    return sorted(found)
+
+
+class Manifest(object):
+    """What was last built from each log under logFileDir.
+
+    For every log, keyed by its path relative to logFileDir, the
+    manifest has the size, mtime and sha1 of the log and the version
+    (see outputVersions) of each output built from it.  A log is
+    only hashed again if its size or mtime changed.
+
+    The manifest is a file of JSON lines, one per log built, appended
+    as soon as the log is done; the last line for a log wins.  So an
+    interrupted rebuild loses at most the logs it was working on,
+    and the next one carries on from there.  `compact` rewrites the
+    file with one line per log.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = { }
+        self._f = None
+
+    def load(self):
+        if not os.access(self.path, os.F_OK):
+            return
+        f = open(self.path, 'rb')
+        try:
+            for record in f:
+                if not record.endswith(b'\n'):
+                    # Torn by an interruption while writing it.
+                    break
+                entry = json.loads(record.decode('utf-8'))
+                self.entries[entry['log']] = entry
+        finally:
+            f.close()
+
+    def get(self, log):
+        return self.entries.get(log)
+
+    def record(self, entry):
+        """Note that the outputs of entry['log'] were built."""
+        self.entries[entry['log']] = entry
+        if self._f is None:
+            self._f = open(self.path, 'ab')
+        self._f.write(self._line(entry))
+        self._f.flush()
+
+    def compact(self, logs):
+        """Rewrite the manifest with only the entries of logs."""
+        self.close()
+        self.entries = dict([ (log, self.entries[log]) for log in logs
+                              if log in self.entries ])
+        tmpname = self.path + '.tmp'
+        f = open(tmpname, 'wb')
+        try:
+            for log in sorted(self.entries):
+                f.write(self._line(self.entries[log]))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.replace(tmpname, self.path)
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    @staticmethod
+    def _line(entry):
+        return (json.dumps(entry, sort_keys=True, separators=(',', ':'))
+                + '\n').encode('utf-8')
+
+
+def rebuild_log(path, writer_map, extraConfig={}):
+    """Replay the log at path, writing only the outputs in writer_map.
+
+    Run in the process pool by rebuild().  Errors of writers aren't
+    ignored, so the log is rebuilt again next time.  The catalog is
+    left alone: the bot recorded the meeting when it was held."""
+    extraConfig = dict(extraConfig)
+    extraConfig['writer_map'] = writer_map
+    extraConfig['catalogFile'] = None
+    M = meeting.replay_log(path, extraConfig=extraConfig, safeMode=False)
+    return len(M.lines)
+
+
+def rebuild(extraConfig={}, jobs=None, force=False, dryRun=False):
+    """Regenerate the outputs of the logs under logFileDir which are
+    out of date, in `jobs` processes (by default, one per CPU).
+
+    An output is out of date if it is missing, or its log, writer or
+    configuration changed since it was built (see Manifest).  force
+    rebuilds everything, dryRun only prints what would be rebuilt.
+    Returns a dict of counts."""
+    config = meeting.Meeting(channel='#rebuild', owner=None,
+                             extraConfig=extraConfig).config
+    versions = outputVersions(config)
+    manifest = Manifest(os.path.join(config.logFileDir,
+                                     '.meetbot-manifest'))
+    manifest.load()
+    start = time.time()
+    stats = {'logs': 0, 'rebuilt': 0, 'outputs': 0, 'lines': 0,
+             'failed': 0}
+    # log -> (manifest entry to record once built, writer_map to build)
+    work = { }
+    logs = [ ]
+    for path in findLogs(config):
+        log = os.path.relpath(path, config.logFileDir)
+        logs.append(log)
+        st = os.stat(path)
+        old = manifest.get(log)
+        if old is not None and old['size'] == st.st_size and \
+               old['mtime'] == st.st_mtime_ns:
+            sha1 = old['sha1']
+        else:
+            sha1 = fileHash(path)
+        entry = {'log': log, 'size': st.st_size, 'mtime': st.st_mtime_ns,
+                 'sha1': sha1, 'outputs': versions}
+        base = path[:-len('.log.txt')]
+        stale = { }
+        for writerkey, version in versions.items():
+            if (force or old is None or old['sha1'] != sha1 or
+                old['outputs'].get(writerkey) != version or
+                not os.access(base + splitKey(writerkey)[0], os.F_OK)):
+                stale[writerkey] = config.writer_map[writerkey]
+        stats['logs'] += 1
+        if stale:
+            work[path] = (entry, stale)
+        elif old != entry:
+            # Only touched, or writers were dropped: nothing to build.
+            if not dryRun:
+                manifest.record(entry)
+
+    if dryRun:
+        for path in sorted(work):
+            print("%s: %s"%(path, ' '.join(sorted(work[path][1]))))
+        print("%d of %d logs would be rebuilt"%(len(work), stats['logs']))
+        return stats
+
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        futures = dict([ (pool.submit(rebuild_log, path, stale,
+                                      extraConfig), path)
+                         for path, (entry, stale) in work.items() ])
+        for future in as_completed(futures):
+            path = futures[future]
+            entry, stale = work[path]
+            try:
+                stats['lines'] += future.result()
+            except Exception:
+                traceback.print_exc()
+                print("(exception above ignored, could not rebuild %s)"%path)
+                stats['failed'] += 1
+                continue
+            manifest.record(entry)
+            stats['rebuilt'] += 1
+            stats['outputs'] += len(stale)
+    finally:
+        pool.shutdown()
+        manifest.close()
+    manifest.compact(logs)
+    elapsed = max(time.time() - start, 1e-9)
+    print("Rebuilt %d outputs of %d logs (%d up to date) in %.1fs: "
+          "%.0f lines/s, %.1f meetings/s"%(
+        stats['outputs'], stats['rebuilt'], stats['logs'] - len(work),
+        elapsed, stats['lines']/elapsed, stats['rebuilt']/elapsed))
+    return stats
@@ -0,0 +1,153 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meetings (
+    id          INTEGER PRIMARY KEY,
+    channel     TEXT NOT NULL COLLATE NOCASE,
+    network     TEXT NOT NULL COLLATE NOCASE,
+    start_time  REAL NOT NULL,
+    end_time    REAL,
+    name        TEXT,
+    title       TEXT,
+    owner       TEXT,
+    chairs      TEXT,   -- JSON list of nicks, the owner first
+    attendees   TEXT,   -- JSON {nick: number of lines}
+    topics      TEXT,   -- JSON list
+    path        TEXT,   -- output files, without their extension
+    url         TEXT,
+    outputs     TEXT,   -- JSON list of the extensions written
+    UNIQUE (channel, network, start_time)
+);
+CREATE TABLE IF NOT EXISTS chairs (
+    nick        TEXT NOT NULL COLLATE NOCASE,
+    start_time  REAL NOT NULL,
+    meeting     INTEGER NOT NULL REFERENCES meetings (id)
+                ON DELETE CASCADE,
+    PRIMARY KEY (nick, start_time, meeting)
+) WITHOUT ROWID;
+"""
+
+
+class Catalog(object):
+    """An SQLite database of all meetings which were saved.
+
+    Every final save of a meeting (see Config.save) records it here,
+    replacing what was recorded by earlier saves of the same meeting
+    (same channel, network and start time).  Looking meetings up by
+    channel (`recent`) or by chair (`chairedBy`) only reads an index.
+
+    The database is in WAL mode, so lookups aren't blocked by saves,
+    also when several processes (the bot, archive rebuilds) use it.
+    Each thread gets its own connection.
+    """
+    def __init__(self, path, timeout=10.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._setupLock = threading.Lock()
+        self._setup = False
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        with self._setupLock:
+            if not self._setup:
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.executescript(_schema)
+                self._setup = True
+        self._local.conn = conn
+        return conn
+
+    def record(self, M, path=None, url=None, outputs=()):
+        """Add the meeting M, or update it if it is there already."""
+        chairs = [ M.owner ] + sorted([ nick for nick in M.chairs
+                                        if nick != M.owner ])
+        chairs = [ nick for nick in chairs if nick ]
+        topics = [ m.topic for m in M.minutes if m.itemtype == 'TOPIC' ]
+        start = time.mktime(M.start_time)
+        end = getattr(M, 'endtime', None)
+        if end is not None:
+            end = time.mktime(end)
+        row = (M.channel, M.network, start, end,
+               M._meetingname or None, M.meeting_topic, M.owner,
+               json.dumps(chairs), json.dumps(M.attendees),
+               json.dumps(topics), path, url, json.dumps(list(outputs)))
+        conn = self._connection()
+        with conn:
+            conn.execute("""
+                INSERT INTO meetings (channel, network, start_time,
+                    end_time, name, title, owner, chairs, attendees,
+                    topics, path, url, outputs)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (channel, network, start_time) DO UPDATE SET
+                    end_time = excluded.end_time, name = excluded.name,
+                    title = excluded.title, owner = excluded.owner,
+                    chairs = excluded.chairs,
+                    attendees = excluded.attendees,
+                    topics = excluded.topics, path = excluded.path,
+                    url = excluded.url, outputs = excluded.outputs""", row)
+            meetingid = conn.execute("""
+                SELECT id FROM meetings
+                WHERE channel = ? AND network = ? AND start_time = ?""",
+                (M.channel, M.network, start)).fetchone()[0]
+            conn.execute("DELETE FROM chairs WHERE meeting = ?",
+                         (meetingid,))
+            conn.executemany("""
+                INSERT OR IGNORE INTO chairs (nick, start_time, meeting)
+                VALUES (?, ?, ?)""",
+                [ (nick, start, meetingid) for nick in chairs ])
+        return meetingid
+
+    def recent(self, channel, network, limit=10):
+        """Return the last `limit` meetings in channel, newest first."""
+        return self._meetings(self._connection().execute("""
+            SELECT * FROM meetings
+            WHERE channel = ? AND network = ?
+            ORDER BY start_time DESC LIMIT ?""",
+            (channel, network, limit)))
+
+    def chairedBy(self, nick, limit=10):
+        """Return the last `limit` meetings nick chaired, newest first."""
+        return self._meetings(self._connection().execute("""
+            SELECT meetings.* FROM chairs
+            JOIN meetings ON meetings.id = chairs.meeting
+            WHERE chairs.nick = ?
+            ORDER BY chairs.start_time DESC LIMIT ?""",
+            (nick, limit)))
+
+    @staticmethod
+    def _meetings(cursor):
+        """Return the rows of cursor as dicts, JSON columns decoded."""
+        meetings = [ ]
+        for row in cursor:
+            meeting = dict(row)
+            for name in ('chairs', 'attendees', 'topics', 'outputs'):
+                if meeting[name] is not None:
+                    meeting[name] = json.loads(meeting[name])
+            meetings.append(meeting)
+        return meetings
+
+
+_catalogs = { }
+_catalogsLock = threading.Lock()
+
+def catalog(path):
+    """Return the Catalog of the database at path, shared by all
+    meetings in this process."""
+    path = os.path.abspath(path)
+    with _catalogsLock:
+        if path not in _catalogs:
+            _catalogs[path] = Catalog(path)
+        return _catalogs[path]
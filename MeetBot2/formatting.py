@@ -0,0 +1,76 @@
+"""Escaping and wrapping helpers shared by the writers and items.
+
+Everything here is called for every line or item of every save, so
+regular expressions are compiled once, wrappers are made once per
+shape and nick regexes are remembered.
+"""
+
+import functools
+import re
+import textwrap
+
+
+# Data sanitizing for various output methods
+def html(text):
+    """Escape bad sequences (in HTML) in user-generated lines."""
+    # Chained str.replace beats str.translate with a table of
+    # multi-character replacements by a wide margin on CPython, see
+    # tests/bench_formatting.py.
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+rst_re = re.compile('_( |-|$)')
+
+def rst(text):
+    """Escapes bad sequences in reST"""
+    if '_' not in text:
+        return text
+    return rst_re.sub(r'\_\1', text)
+
+
+def text(text):
+    """Escape bad sequences in text (not implemented yet)"""
+    return text
+
+
+def mw(text):
+    """Escape bad sequences in MediaWiki markup (not implemented yet)"""
+    return text
+
+
+# wraping functions (for RST)
+class TextWrapper(textwrap.TextWrapper):
+    # why is this a class?
+    wordsep_re = re.compile(r'(\s+)')
+
+
+@functools.lru_cache(maxsize=None)
+def getWrapper(width=72, indent=0, hanging=2):
+    """Return the TextWrapper for this shape of paragraph.
+
+    The first line is indented by `indent` spaces and the following
+    ones by `indent`+`hanging`.  Wrappers keep no state between
+    calls, so one of each shape is shared by everyone."""
+    return TextWrapper(width=width, initial_indent=' '*indent,
+                       subsequent_indent=' '*(indent+hanging),
+                       break_long_words=False)
+
+
+def wrapList(item, indent=0):
+    return getWrapper(72, indent).fill(item)
+
+
+re_wrap = re.compile(r'sWRAPs(.*)eWRAPe', re.DOTALL)
+
+def _replaceWRAP(m):
+    return getWrapper(72, 0, 0).fill(m.group(1))
+
+def replaceWRAP(item):
+    if 'sWRAPs' not in item:
+        return item
+    return re_wrap.sub(_replaceWRAP, item)
+
+
+@functools.lru_cache(maxsize=1024)
+def makeNickRE(nick):
+    return re.compile('\\b'+re.escape(nick)+'\\b', re.IGNORECASE)
@@ -1,4 +1,21 @@
-from . import writers
+import re
+import time
+
+from . import formatting
+
+
+def inbase(i, chars='abcdefghijklmnopqrstuvwxyz', place=0):
+    """Converts an integer into a postfix in base 26 using ascii chars.
+
+    This is used to make a unique postfix for ReStructured Text URL
+    references, which must be unique.
+    """
+    div, mod = divmod(i, len(chars)**(place+1))
+    if div == 0:
+        return chars[mod]
+    else:
+        return inbase(div, chars=chars, place=place)+chars[mod]
+
 
 class _BaseItem(object):
     itemtype = None
@@ -10,12 +27,51 @@ class _BaseItem(object):
     endtext = ''
     startmw = ''
     endmw = ''
+    # The names available to the templates: the markup above, which
+    # is the same for every item of a class, and `fields`, which are
+    # set on each item.  Subclasses with more fields extend `fields`.
+    _markup = ('itemtype', 'starthtml', 'endhtml', 'startrst', 'endrst',
+               'starttext', 'endtext', 'startmw', 'endmw')
+    fields = ('nick', 'line', 'linenum', 'time', 'url', 'prefix', 'suffix')
+
+    def __setattr__(self, name, value):
+        # Rendered output is cached, see _render(); changing the item
+        # throws it away.
+        object.__setattr__(self, name, value)
+        if name[0] != '_':
+            self.__dict__.pop('_rendered', None)
+
+    def __getstate__(self):
+        # Don't pickle the rendered output (journal snapshots).
+        state = self.__dict__.copy()
+        state.pop('_rendered', None)
+        return state
+
+    def _render(self, fmt, M, escapewith, render):
+        """Return render(), memoized per (format, escape function, log URL).
+
+        Items hardly ever change after they are made, so the minutes
+        writers can reuse what they rendered on the previous save."""
+        key = (fmt, escapewith, self.logURL(M))
+        cache = self.__dict__.get('_rendered')
+        if cache is None:
+            cache = self.__dict__['_rendered'] = { }
+        if key not in cache:
+            cache[key] = render()
+        return cache[key]
 
     def get_replacements(self, M, escapewith):
         replacements = { }
-        for name in dir(self):
-            if name[0] == "_": continue
+        for name in self._markup:
             replacements[name] = getattr(self, name)
+        for name in self.fields:
+            if name in self.__dict__:
+                replacements[name] = self.__dict__[name]
+        # Set by rst() for each save; it is an underscore name so that
+        # setting it doesn't throw away the cached renderings.
+        if '_rstref' in self.__dict__:
+            replacements['rstref'] = self._rstref
+        replacements['anchor'] = self.anchor
         replacements['nick'] = escapewith(replacements['nick'])
         replacements['link'] = self.logURL(M)
         for key in ('line', 'prefix', 'suffix', 'topic'):
@@ -28,14 +84,16 @@ class _BaseItem(object):
         return replacements
 
     def template(self, M, escapewith):
-        template = { }
-        for k,v in list(self.get_replacements(M, escapewith).items()):
-            if k not in ('itemtype', 'line', 'topic',
-                         'url', 'url_quoteescaped',
-                         'nick', 'time', 'link', 'anchor'):
-                continue
-            template[k] = v
-        return template
+        def render():
+            template = { }
+            for k,v in list(self.get_replacements(M, escapewith).items()):
+                if k not in ('itemtype', 'line', 'topic',
+                             'url', 'url_quoteescaped',
+                             'nick', 'time', 'link', 'anchor'):
+                    continue
+                template[k] = v
+            return template
+        return dict(self._render('template', M, escapewith, render))
 
     def makeRSTref(self, M):
         if self.nick[-1] == '_':
@@ -81,36 +139,188 @@ class Topic(_BaseItem):
     starthtml = '<b class="TOPIC">'
     endhtml = '</b>'
 
+    fields = ('nick', 'topic', 'linenum', 'time')
+
     def __init__(self, nick, line, linenum, time_):
         self.nick = nick ; self.topic = line ; self.linenum = linenum
         self.time = time.strftime("%H:%M:%S", time_)
 
     def _htmlrepl(self, M):
-        repl = self.get_replacements(M, escapewith=writers.html)
+        repl = self.get_replacements(M, escapewith=formatting.html)
         repl['link'] = self.logURL(M)
         return repl
 
     def html(self, M):
-        return self.html_template%self._htmlrepl(M)
+        return self._render('html', M, formatting.html,
+                            lambda: self.html_template%self._htmlrepl(M))
 
     def html2(self, M):
-        return self.html2_template%self._htmlrepl(M)
+        return self._render('html2', M, formatting.html,
+                            lambda: self.html2_template%self._htmlrepl(M))
 
     def rst(self, M):
-        self.rstref = self.makeRSTref(M)
-        repl = self.get_replacements(M, escapewith=writers.rst)
+        self._rstref = self.makeRSTref(M)
+        repl = self.get_replacements(M, escapewith=formatting.rst)
         if repl['topic']=='': repl['topic']=' '
         repl['link'] = self.logURL(M)
         return self.rst_template%repl
 
     def text(self, M):
-        repl = self.get_replacements(M, escapewith=writers.text)
+        def render():
+            repl = self.get_replacements(M, escapewith=formatting.text)
+            repl['link'] = self.logURL(M)
+            return self.text_template%repl
+        return self._render('text', M, formatting.text, render)
+
+    def mw(self, M):
+        def render():
+            repl = self.get_replacements(M, escapewith=formatting.mw)
+            return self.mw_template%repl
+        return self._render('mw', M, formatting.mw, render)
+
+    def __str__(self):
+        return "#topic %s" % self.topic
+
+
+class Generic(_BaseItem):
+    itemtype = ''
+    html_template = """<tr><td><a href='%(link)s#%(anchor)s'>%(time)s</a></td>
+        <td>%(itemtype)s</td><td>%(nick)s</td><td>%(starthtml)s%(line)s%(endhtml)s</td>
+        </tr>"""
+    html2_template = ("""<i>%(itemtype)s</i>: %(starthtml)s%(line)s%(endhtml)s """
+                      """<span class="details">"""
+                      """(<a href='%(link)s#%(anchor)s'>%(nick)s</a>, """
+                      """%(time)s)"""
+                      """</span>""")
+    rst_template = """*%(itemtype)s*: %(startrst)s%(line)s%(endrst)s  (%(rstref)s_)"""
+    text_template = """%(itemtype)s: %(starttext)s%(line)s%(endtext)s  (%(nick)s, %(time)s)"""
+    mw_template = """''%(itemtype)s:'' %(startmw)s%(line)s%(endmw)s  (%(nick)s, %(time)s)"""
+
+    def __init__(self, nick, line, linenum, time_):
+        self.nick = nick ; self.line = line ; self.linenum = linenum
+        self.time = time.strftime("%H:%M:%S", time_)
+
+    def _htmlrepl(self, M):
+        repl = self.get_replacements(M, escapewith=formatting.html)
         repl['link'] = self.logURL(M)
-        return self.text_template%repl
+        return repl
+
+    def html(self, M):
+        return self._render('html', M, formatting.html,
+                            lambda: self.html_template%self._htmlrepl(M))
+
+    def html2(self, M):
+        return self._render('html2', M, formatting.html,
+                            lambda: self.html2_template%self._htmlrepl(M))
+
+    def rst(self, M):
+        self._rstref = self.makeRSTref(M)
+        repl = self.get_replacements(M, escapewith=formatting.rst)
+        return self.rst_template%repl
+
+    def text(self, M):
+        def render():
+            repl = self.get_replacements(M, escapewith=formatting.text)
+            return self.text_template%repl
+        return self._render('text', M, formatting.text, render)
 
     def mw(self, M):
-        repl = self.get_replacements(M, escapewith=writers.mw)
-        return self.mw_template%repl
+        def render():
+            repl = self.get_replacements(M, escapewith=formatting.mw)
+            return self.mw_template%repl
+        return self._render('mw', M, formatting.mw, render)
+
+    def __str__(self):
+        return "#%s %s" % (self.itemtype.lower(), self.line)
+
+
+class Info(Generic):
+    itemtype = 'INFO'
+    html2_template = ("""%(starthtml)s%(line)s%(endhtml)s """
+                      """<span class="details">"""
+                      """(<a href='%(link)s#%(anchor)s'>%(nick)s</a>, """
+                      """%(time)s)"""
+                      """</span>""")
+    rst_template = """%(startrst)s%(line)s%(endrst)s  (%(rstref)s_)"""
+    text_template = """%(starttext)s%(line)s%(endtext)s  (%(nick)s, %(time)s)"""
+    mw_template = """%(startmw)s%(line)s%(endmw)s  (%(nick)s, %(time)s)"""
+
+
+class Idea(Generic):
+    itemtype = 'IDEA'
+
+
+class Agreed(Generic):
+    itemtype = 'AGREED'
+
+
+class Action(Generic):
+    itemtype = 'ACTION'
+
+
+class Help(Generic):
+    itemtype = 'HELP'
+
+
+class Accepted(Generic):
+    itemtype = 'ACCEPTED'
+    starthtml = '<font color="green">'
+    endhtml = '</font>'
+
+
+class Rejected(Generic):
+    itemtype = 'REJECTED'
+    starthtml = '<font color="red">'
+    endhtml = '</font>'
+
+
+class Vote(Generic):
+    itemtype = 'VOTE'
+
+
+class Link(Generic):
+    itemtype = 'LINK'
+    html_template = """<tr><td><a href='%(link)s#%(anchor)s'>%(time)s</a></td>
+        <td>%(itemtype)s</td><td>%(nick)s</td><td>%(starthtml)s<a href="%(url)s">%(url_readable)s</a> %(line)s%(endhtml)s</td>
+        </tr>"""
+    html2_template = ("""%(starthtml)s<a href="%(url)s">%(url_readable)s</a> %(line)s%(endhtml)s """
+                      """<span class="details">"""
+                      """(<a href='%(link)s#%(anchor)s'>%(nick)s</a>, """
+                      """%(time)s)"""
+                      """</span>""")
+    rst_template = """*%(itemtype)s*: %(startrst)s%(url)s %(line)s%(endrst)s  (%(rstref)s_)"""
+    text_template = """%(itemtype)s: %(starttext)s%(url)s %(line)s%(endtext)s  (%(nick)s, %(time)s)"""
+    mw_template = """''%(itemtype)s:'' %(startmw)s%(url)s %(line)s%(endmw)s  (%(nick)s, %(time)s)"""
+
+    # (UrlProtocols, compiled url regex), see __init__.
+    _url_re = (None, None)
+
+    def __init__(self, nick, line, linenum, time_, M):
+        Generic.__init__(self, nick, line, linenum, time_)
+        protocols = M.config.UrlProtocols
+        url_re = self._url_re
+        if url_re[0] != protocols:
+            # (.*?)          - any prefix, non-greedy
+            # (%s//[^\s]+    - protocol://... until the next space
+            # (?<!\.|\))     - but the last character can NOT be . or )
+            # (.*)           - any suffix
+            url_re = Link._url_re = (protocols, re.compile(
+                r'(.*?)((?:%s)//[^\s]+(?<!\.|\)))(.*)'%
+                '|'.join([ re.escape(p) for p in protocols ])))
+        m = url_re[1].match(line)
+        if m:
+            self.line = (m.group(1)+m.group(3)).strip()
+            self.url = m.group(2)
+        else:
+            self.line = ''
+            self.url = line.strip()
+
+    def _htmlrepl(self, M):
+        repl = Generic._htmlrepl(self, M)
+        # special: replace doublequote only for the URL.
+        repl['url'] = formatting.html(self.url.replace('"', "%22"))
+        repl['url_readable'] = formatting.html(self.url)
+        return repl
 
     def __str__(self):
-        return "#topic %s" % self.topic
\ No newline at end of file
+        return "#link %s %s" % (self.url, self.line)
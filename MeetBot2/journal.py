@@ -0,0 +1,174 @@
+import json
+import os
+import pickle
+import threading
+import time
+import urllib.parse
+
+# Kinds of events in a journal.
+LINE = 'l'     # Meeting.add_line: something said in the channel
+RAW = 'r'      # Meeting.addrawline: something the bot said
+
+
+class Journal(object):
+    """A write-ahead journal of the input of one live meeting.
+
+    Everything that changes a meeting comes from the lines said in
+    its channel (commands, chairs, votes, ...), so those are what is
+    journaled: each event is appended (as one line of JSON) before
+    it is applied to the meeting.  A meeting can then be rebuilt
+    after a crash or restart by replaying its journal, see
+    `replay`.
+
+    Every `snapshotEvery` events the state of the meeting is pickled
+    next to the journal, together with the journal's length at that
+    time.  Recovery starts from the snapshot and only replays the
+    events after it, so it takes time proportional to what happened
+    since the last snapshot, not to the length of the meeting.
+
+    The journal is removed once the meeting has ended and been saved.
+    """
+    def __init__(self, path, snapshotEvery=500):
+        self.path = path
+        self.snapPath = path + '.snap'
+        self.snapshotEvery = snapshotEvery
+        self._lock = threading.Lock()
+        self._f = None
+        self._sinceSnapshot = 0
+        # Where the last whole event ends, as found by load().
+        self._end = None
+
+    @staticmethod
+    def filename(directory, channel, network):
+        """Path of the journal of the meeting in channel on network."""
+        return os.path.join(directory, '%s.%s.journal'%(
+            urllib.parse.quote(network, safe=''),
+            urllib.parse.quote(channel, safe='')))
+
+    def create(self, header):
+        """Start a new journal.  header is a dict describing the meeting."""
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.access(dirname, os.F_OK):
+            os.makedirs(dirname)
+        if os.access(self.snapPath, os.F_OK):
+            os.unlink(self.snapPath)
+        self._f = open(self.path, 'wb')
+        self._write(header)
+
+    def reopen(self):
+        """Continue appending to an existing (recovered) journal.
+
+        A half-written last line ignored by load() is cut off first,
+        so the next event doesn't get glued to it."""
+        self._f = open(self.path, 'r+b')
+        if self._end is not None:
+            self._f.truncate(self._end)
+        self._f.seek(0, os.SEEK_END)
+
+    def append(self, kind, time_, nick, line):
+        """Record an event, before it is applied to the meeting."""
+        self._write([kind, time.mktime(time_), nick, line])
+
+    def applied(self, M):
+        """Call after applying an event, to snapshot M when it is due."""
+        self._sinceSnapshot += 1
+        if self._sinceSnapshot >= self.snapshotEvery:
+            self.snapshot(M)
+
+    def snapshot(self, M):
+        """Save the state of M, so recovery can skip what came before."""
+        with self._lock:
+            self._f.flush()
+            offset = self._f.tell()
+            data = pickle.dumps((offset, M.journalState()),
+                                pickle.HIGHEST_PROTOCOL)
+        tmpname = self.snapPath + '.tmp'
+        f = open(tmpname, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.replace(tmpname, self.snapPath)
+        self._sinceSnapshot = 0
+
+    def close(self):
+        """Stop writing, keeping the journal to recover the meeting from."""
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+
+    def remove(self):
+        """The meeting is over and saved, forget the journal."""
+        self.close()
+        for path in (self.path, self.snapPath):
+            if os.access(path, os.F_OK):
+                os.unlink(path)
+
+    def _write(self, record):
+        data = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            self._f.write(data)
+            self._f.flush()
+
+    def load(self):
+        """Return (header, state, events) of the journal on disk.
+
+        state is the last snapshot of the meeting (None if there is
+        none), and events are the (kind, time, nick, line) after it,
+        with time a time.struct_time.  A half-written last line, from
+        a crash while writing it, is ignored."""
+        state = None
+        offset = None
+        if os.access(self.snapPath, os.F_OK):
+            f = open(self.snapPath, 'rb')
+            try:
+                offset, state = pickle.load(f)
+            finally:
+                f.close()
+        events = [ ]
+        f = open(self.path, 'rb')
+        try:
+            header = json.loads(f.readline().decode('utf-8'))
+            if offset is not None:
+                f.seek(offset)
+            end = f.tell()
+            for record in f:
+                if not record.endswith(b'\n'):
+                    break
+                kind, when, nick, line = json.loads(record.decode('utf-8'))
+                events.append((kind, time.localtime(when), nick, line))
+                end += len(record)
+        finally:
+            f.close()
+        self._end = end
+        return header, state, events
+
+
+def journals(directory):
+    """Return the paths of all journals in directory."""
+    if not os.access(directory, os.F_OK):
+        return [ ]
+    return [ os.path.join(directory, name)
+             for name in sorted(os.listdir(directory))
+             if name.endswith('.journal') ]
+
+
+def replay(M, state, events):
+    """Bring the new meeting M to the state recorded in a journal.
+
+    state and events are as returned by Journal.load: the snapshot,
+    if any, is loaded into M and the events after it are replayed."""
+    if state is not None:
+        M.restoreJournalState(state)
+    M._replaying = True
+    try:
+        for kind, time_, nick, line in events:
+            if kind == LINE:
+                M.add_line(nick, line, time_=time_)
+            elif kind == RAW:
+                M.addrawline(nick, line, time_=time_, bot=True)
+    finally:
+        M._replaying = False
@@ -0,0 +1,128 @@
+import array
+import time
+
+# Kinds of lines in the log.
+MESSAGE = 0
+ACTION = 1     # /me
+BOT = 2        # said by the bot itself
+
+
+class Line(object):
+    """A view of one line in a LineStore."""
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def linenum(self):
+        return self.index + 1
+
+    @property
+    def time(self):
+        """When the line was said, in seconds since the epoch."""
+        return self.store._times[self.index]
+
+    @property
+    def nick(self):
+        return self.store._nickNames[self.store._nicks[self.index]]
+
+    @property
+    def kind(self):
+        return self.store._kinds[self.index]
+
+    @property
+    def text(self):
+        return self.store._texts[self.index]
+
+    def timestr(self):
+        return time.strftime("%H:%M:%S", time.localtime(self.time))
+
+    def __str__(self):
+        return self.store.format(self.index)
+
+    def __repr__(self):
+        return '<Line %d %r>'%(self.linenum, str(self))
+
+
+class LineStore(object):
+    """The lines of a meeting log, stored column by column.
+
+    Timestamps, nicks (interned to small integers) and kinds are kept
+    in arrays and only the text itself is a Python string.  Indexing
+    and iterating give the traditional "HH:MM:SS <nick> text" strings,
+    which are made when asked for; writers which can use the fields
+    directly should use row() or rows() instead.
+    """
+    def __init__(self):
+        self._times = array.array('q')
+        self._nicks = array.array('I')
+        self._kinds = array.array('B')
+        self._texts = [ ]
+        self._nickNames = [ ]
+        self._nickIds = { }
+        # Bumped whenever existing lines are removed, so that writers
+        # which only add the new lines know to start over.
+        self.rewrites = 0
+
+    def append(self, nick, text, when, kind=MESSAGE):
+        """Add a line.  `when` is in seconds since the epoch."""
+        nickid = self._nickIds.get(nick)
+        if nickid is None:
+            nickid = self._nickIds[nick] = len(self._nickNames)
+            self._nickNames.append(nick)
+        self._times.append(int(when))
+        self._nicks.append(nickid)
+        self._kinds.append(kind)
+        self._texts.append(text)
+
+    def truncate(self, length):
+        """Remove all lines after the first `length`.
+
+        Bumps `rewrites`, so writers which append to their files on
+        realtime saves write them again (see TextLog)."""
+        if length >= len(self._texts):
+            return
+        del self._times[length:]
+        del self._nicks[length:]
+        del self._kinds[length:]
+        del self._texts[length:]
+        self.rewrites += 1
+
+    def format(self, index):
+        """Return line `index` in the traditional string form."""
+        timestr = time.strftime("%H:%M:%S", time.localtime(self._times[index]))
+        nick = self._nickNames[self._nicks[index]]
+        if self._kinds[index] == ACTION:
+            return "%s * %s %s"%(timestr, nick, self._texts[index])
+        return "%s <%s> %s"%(timestr, nick, self._texts[index])
+
+    def row(self, index):
+        if index < 0:
+            index += len(self._texts)
+        if not 0 <= index < len(self._texts):
+            raise IndexError(index)
+        return Line(self, index)
+
+    def rows(self, start=0):
+        """Iterate over Line views, starting from index `start`."""
+        for index in range(start, len(self._texts)):
+            yield Line(self, index)
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self.format(i)
+                     for i in range(*index.indices(len(self._texts))) ]
+        if index < 0:
+            index += len(self._texts)
+        if not 0 <= index < len(self._texts):
+            raise IndexError(index)
+        return self.format(index)
+
+    def __iter__(self):
+        for index in range(len(self._texts)):
+            yield self.format(index)
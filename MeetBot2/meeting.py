@@ -1,10 +1,24 @@
+import argparse
+import concurrent.futures.process
+import hashlib
 import os
 import re
 import stat
+import sys
 import textwrap
+import threading
 import time
+import traceback
+import types
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+__version__ = '0.2'
+
+from . import catalog
 from . import items
+from . import lines
+from . import minutes
+from . import scheduler
 from . import writers
 
 
@@ -26,11 +40,19 @@ class Config(object):
     # This is used with the #restrict command to remove permissions from files.
     RestrictPerm = stat.S_IRWXO|stat.S_IRWXG  # g,o perm zeroed
     # RestrictPerm = stat.S_IRWXU|stat.S_IRWXO|stat.S_IRWXG  #u,g,o perm zeroed
+    # When to fsync() written files: 'never', 'final' (only on the
+    # final save of a meeting) or 'interval' (at most every
+    # fsyncInterval seconds, for all files of the meeting at once).
+    fsyncPolicy = 'final'
+    fsyncInterval = 30
     # used to detect #link :
     UrlProtocols = ('http:', 'https:', 'irc:', 'ftp:', 'mailto:', 'ssh:')
     # regular expression for parsing commands.  First group is the cmd name,
     # second group is the rest of the line.
     command_RE = re.compile(r'#([\w]+)[ \t]*(.*)')
+    # Every line command_RE matches starts with this, so other lines
+    # don't need to go through the regular expression at all.
+    commandPrefix = '#'
     # Regular expression for parsing the startvote command.
     startvote_RE = re.compile(r'(?P<question>.*)\?\s*(?P<choices>.*)')
     # Regular expression for parsing the startvote options.
@@ -67,11 +89,45 @@ class Config(object):
 
     # Write out select logfiles
     update_realtime = True
+    # Realtime saves are coalesced: they happen at most this many
+    # seconds after a line was said, or once this many lines are
+    # waiting.  A latency of 0 saves after every line.
+    realtimeMaxLatency = 2.0
+    realtimeMaxDirtyLines = 50
+    # Lines for a meeting wait in its inbox (see Meeting.actor) until
+    # they are processed.  When inboxSize lines are waiting,
+    # inboxOverflow 'block' waits inboxBlockTimeout seconds for room
+    # before dropping the line, 'drop' drops it at once.
+    inboxSize = 1000
+    inboxOverflow = 'block'
+    inboxBlockTimeout = 5.0
+    # The plugin journals live meetings here so they survive a
+    # restart (see journal.Journal); None means '.journal' in
+    # logFileDir.  The state of a meeting is snapshotted every
+    # journalSnapshotEvery lines.
+    journalDir = None
+    journalSnapshotEvery = 500
+    # Every meeting is recorded in this SQLite database (relative to
+    # logFileDir) by its final save, see catalog.Catalog.  None
+    # disables the catalog.
+    catalogFile = 'meetings.sqlite'
     # CSS configs:
     cssFile_log      = 'default'
     cssEmbed_log     = True
     cssFile_minutes  = 'default'
     cssEmbed_minutes = True
+    # Instead of embedding the stylesheet in every page, write it once
+    # into logFileDir (named after a hash of its contents) and link
+    # to it.  Only used when cssEmbed_* is true.
+    cssShared_log     = False
+    cssShared_minutes = False
+    # Writers with `offload` set are rendered in Meeting.renderPool
+    # (a process pool), if there is one.  A render taking longer than
+    # this many seconds is killed and done again in the bot.
+    offloadTimeout = 120
+    # The publish.WikiPublisher uploading MediaWiki minutes, None for
+    # the one shared by all meetings.
+    wikiPublisher = None
 
     # This tells which writers write out which to extensions.
     writer_map = {
@@ -87,62 +143,140 @@ class Config(object):
                  extraConfig={}):
         self.M = M
         self.writers = { }
+        # filename -> (hash of contents, restricted) of what we last
+        # wrote, so unchanged files are not rewritten.
+        self._fileHashes = { }
+        # Files written but not yet fsync()ed, for fsyncPolicy
+        # 'interval'.
+        self._unsynced = set()
+        self._lastSync = time.time()
+        # (inputs, (path, URL, basename)) of the output files.
+        self._pathCache = None
+        # (versions, minutes.MinutesModel) shared by the writers.
+        self._model = None
+        # writer_map key -> (versions of the writer's inputs, output)
+        # from the last time the writer ran.
+        self._lastOutput = { }
+        # filename -> number of the latest offloaded render of it, so
+        # an older render finishing late doesn't overwrite it.
+        self._offloads = { }
+        self._offloadLock = threading.Lock()
         # Update config values with anything we may have
         for k,v in list(extraConfig.items()):
             setattr(self, k, v)
 
         if hasattr(self, "init_hook"):
             self.init_hook()
+        # A line is auto-detected as a link if the part before the
+        # first '//' is one of UrlProtocols.
+        self.url_RE = re.compile('(?:%s)(?://|$)'%'|'.join(
+            [ re.escape(p) for p in self.UrlProtocols ]))
         if write_raw_log:
             self.writers['.log.txt'] = writers.TextLog(self.M)
         for extension, writer in list(self.writer_map.items()):
             self.writers[extension] = writer(self.M)
         self.safeMode = safeMode
 
+    def enc(self, text):
+        """Prepare text for output.
+
+        Strings are unicode all the way through; they are encoded
+        (as UTF-8) only when written, see writeToFile."""
+        return text
+
+    def dec(self, text):
+        """Prepare text from input, see enc()."""
+        return text
+
     def filename(self, url=False):
         # provide a way to override the filename.  If it is
         # overridden, it must be a full path (and the URL-part may not
         # work.):
         if getattr(self.M, '_filename', None):
             return self.M._filename
+        path, urlpath, basename = self._paths()
+        if url:
+            return urlpath
+        return path
+
+    @property
+    def basename(self):
+        if getattr(self.M, '_filename', None):
+            return os.path.basename(self.M._filename)
+        return self._paths()[2]
+
+    def _paths(self):
+        """Return (local path, URL, basename) of the output files.
+
+        This is called for every item of every writer, so the result
+        is kept until the meeting name or the configuration it is
+        made from changes."""
+        M = self.M
+        key = (M.channel, M.network, M._meetingname, M.start_time,
+               self.filenamePattern, self.specialChannels,
+               self.specialChannelFilenamePattern,
+               self.logFileDir, self.logUrlPrefix)
+        cached = self._pathCache
+        if cached is not None and cached[0] == key:
+            return cached[1]
         # names useful for pathname formatting.
         # Certain test channels always get the same name - don't need
         # file prolifiration for them
-        if self.M.channel in self.specialChannels:
+        if M.channel in self.specialChannels:
             pattern = self.specialChannelFilenamePattern
         else:
             pattern = self.filenamePattern
-        channel = self.M.channel.strip('# ').lower().replace('/', '')
-        network = self.M.network.strip(' ').lower().replace('/', '')
-        if self.M._meetingname:
-            meetingname = self.M._meetingname.replace('/', '')
+        channel = M.channel.strip('# ').lower().replace('/', '')
+        network = M.network.strip(' ').lower().replace('/', '')
+        if M._meetingname:
+            meetingname = M._meetingname.replace('/', '')
         else:
             meetingname = channel
         path = pattern%{'channel':channel, 'network':network,
                         'meetingname':meetingname}
-        path = time.strftime(path, self.M.start_time)
-        # If we want the URL name, append URL prefix and return
-        if url:
-            return os.path.join(self.logUrlPrefix, path)
+        path = time.strftime(path, M.start_time)
+        urlpath = os.path.join(self.logUrlPrefix, path)
         path = os.path.join(self.logFileDir, path)
         # make directory if it doesn't exist...
         dirname = os.path.dirname(path)
-        if not url and dirname and not os.access(dirname, os.F_OK):
+        if dirname and not os.access(dirname, os.F_OK):
             os.makedirs(dirname)
-        return path
-
-    @property
-    def basename(self):
-        return os.path.basename(self.M.config.filename())
+        paths = (path, urlpath, os.path.basename(path))
+        self._pathCache = (key, paths)
+        return paths
 
     def save(self, realtime_update=False):
         """Write all output files.
 
         If `realtime_update` is true, then this isn't a complete save,
         it will only update those writers with the update_realtime
-        attribute true.  (default update_realtime=False for this method)"""
+        attribute true.  (default update_realtime=False for this method)
+
+        Writers with a `format_incremental` method only have the new
+        part of their output spliced into the existing file on
+        realtime updates; a full save always rewrites every file.
+        Once a writer's output is in its file, its `saved` method is
+        called.
+
+        On realtime updates, writers whose inputs (see
+        `_BaseWriter.depends`) haven't changed since they last ran
+        are skipped and their last output is returned again.
+
+        Writers may also make `format` a generator yielding the
+        output in pieces, which are then written to the file as they
+        come.  In that case the returned dict has None for that
+        extension, unless nothing was written (dontSave).
+
+        Writers which are expensive to render can set `offload` and
+        provide `snapshot` and `render` instead, see offload().  They
+        are never run on realtime updates and have None in the
+        returned dict, their file is written when the render is done."""
         if realtime_update and not hasattr(self.M, 'start_time'):
             return
+        if not realtime_update:
+            # We are writing everything, pending realtime saves
+            # are covered by this.
+            self.M.saveScheduler.discard()
         rawname = self.filename()
         # We want to write the rawlog (.log.txt) first in case the
         # other methods break.  That way, we have saved enough to
@@ -159,9 +293,16 @@ class Config(object):
             # should be updated step-by-step.
             if (realtime_update and
                 ( not getattr(writer, 'update_realtime', False) or
+                  getattr(writer, 'offload', False) or
                   getattr(self, '_filename', None) )
                 ):
                 continue
+            inputs = self.M.versions(getattr(writer, 'depends', None))
+            last = self._lastOutput.get(extension)
+            if realtime_update and last is not None and last[0] == inputs:
+                results[extension.split('|', 1)[0]] = last[1]
+                continue
+            writerkey = extension
             # Parse embedded arguments
             if '|' in extension:
                 extension, args = extension.split('|', 1)
@@ -170,8 +311,52 @@ class Config(object):
             else:
                 args = { }
 
+            if (getattr(writer, 'offload', False) and
+                not getattr(self, "dontSave", False) and
+                extension.lower()[:5] not in (".none", ".")):
+                self.offload(writer, writer.snapshot(extension, **args),
+                             rawname + extension)
+                results[extension] = None
+                self._lastOutput[writerkey] = (inputs, None)
+                continue
+
+            # Writers which know how to bring an existing file up to
+            # date (instead of regenerating all of it) get a chance
+            # to do so on realtime updates.  If they can't, or the
+            # splice into the file fails, fall through to a full
+            # rewrite.
+            if (realtime_update and
+                hasattr(writer, 'format_incremental') and
+                not getattr(self, "dontSave", False)):
+                filename = rawname + extension
+                text = writer.format_incremental(extension, **args)
+                if text is not None and \
+                       self.appendToFile(text, filename,
+                                         footer=getattr(writer, 'footer', ''),
+                                         final=False):
+                    if hasattr(writer, 'saved'):
+                        writer.saved()
+                    results[extension] = text
+                    self._lastOutput[writerkey] = (inputs, text)
+                    continue
+
             text = writer.format(extension, **args)
+            if isinstance(text, types.GeneratorType):
+                # The writer yields its output in pieces.  Stream
+                # them to the file; only collect them if they aren't
+                # going to a file.
+                if getattr(self, "dontSave", False) or \
+                       extension.lower()[:5] in (".none", "."):
+                    text = "".join(text)
+                else:
+                    filename = rawname + extension
+                    self.writeToFile(text, filename,
+                                     final=not realtime_update)
+                    if hasattr(writer, 'saved'):
+                        writer.saved()
+                    text = None
             results[extension] = text
+            self._lastOutput[writerkey] = (inputs, text)
             # If the writer returns a string or unicode object, then
             # we should write it to a filename with that extension.
             # If it doesn't, then it's assumed that the write took
@@ -188,26 +373,267 @@ class Config(object):
                     pass
                 else:
                     filename = rawname + extension
-                    self.writeToFile(text, filename)
+                    self.writeToFile(text, filename,
+                                     final=not realtime_update)
+                    if hasattr(writer, 'saved'):
+                        writer.saved()
+        if not realtime_update and self.catalogFile and \
+               not getattr(self, "dontSave", False):
+            self.recordInCatalog()
         if hasattr(self, 'save_hook'):
             self.save_hook(realtime_update=realtime_update)
         return results
 
-    def writeToFile(self, string, filename):
-        """Write a given string to a file"""
-        # The reason we have this method just for this is to proxy
-        # through the _restrictPermissions logic.
-        f = open(filename, 'w')
-        if self.M._restrictlogs:
-            self.restrictPermissions(f)
-        f.write(string)
-        f.close()
-
-    def restrictPermissions(self, f):
-        """Remove the permissions given in the variable RestrictPerm."""
-        f.flush()
-        newmode = os.stat(f.name).st_mode & (~self.RestrictPerm)
-        os.chmod(f.name, newmode)
+    def recordInCatalog(self):
+        """Add (or update) the meeting in the catalog."""
+        outputs = [ extension.split('|', 1)[0]
+                    for extension in sorted(self.writers)
+                    if extension.split('|', 1)[0].lower()[:5]
+                       not in (".none", ".") ]
+        try:
+            catalog.catalog(os.path.join(self.logFileDir, self.catalogFile)
+                            ).record(self.M, path=self.filename(),
+                                     url=self.filename(url=True),
+                                     outputs=outputs)
+        except Exception:
+            if not self.safeMode:
+                raise
+            traceback.print_exc()
+            print("(exception above ignored, continuing)")
+
+    def offload(self, writer, snapshot, filename):
+        """Render `snapshot` with `writer.render` and write it to filename.
+
+        `writer.snapshot` takes what the writer needs from the
+        meeting, in a form which can be pickled, so that `render` can
+        run in another process.  If the meeting has a renderPool
+        (see scheduler.RenderPool), it runs there and a thread writes
+        the file when the render is done, so the save doesn't wait
+        for it.  A render which takes more than offloadTimeout
+        seconds has its workers killed (RenderPool.recycle), and is
+        done again in that thread instead: the file is written in the
+        end either way.  Without a renderPool, the render happens
+        here and now."""
+        pool = getattr(self.M, 'renderPool', None)
+        if pool is None:
+            self.writeToFile(writer.render(snapshot), filename, final=True)
+            return
+        with self._offloadLock:
+            generation = self._offloads.get(filename, 0) + 1
+            self._offloads[filename] = generation
+        future = pool.submit(writer.render, snapshot)
+        def writeBack():
+            try:
+                text = future.result(self.offloadTimeout)
+            except concurrent.futures.TimeoutError:
+                print("Rendering %s took more than %ss, rendering it here"%(
+                    filename, self.offloadTimeout))
+                if hasattr(pool, 'recycle'):
+                    pool.recycle(future)
+                else:
+                    future.cancel()
+                text = None
+            except (concurrent.futures.CancelledError,
+                    concurrent.futures.process.BrokenProcessPool):
+                # Another render hung, and took this one down with it.
+                traceback.print_exc()
+                print("(exception above ignored, rendering %s here)"%filename)
+                text = None
+            except Exception:
+                traceback.print_exc()
+                print("(exception above ignored, %s not saved)"%filename)
+                return
+            if text is None:
+                with self._offloadLock:
+                    if self._offloads.get(filename) != generation:
+                        return
+                try:
+                    text = writer.render(snapshot)
+                except Exception:
+                    traceback.print_exc()
+                    print("(exception above ignored, %s not saved)"%filename)
+                    return
+            with self._offloadLock:
+                if self._offloads.get(filename) != generation:
+                    # A later render of this file is coming.
+                    return
+                try:
+                    self.writeToFile(text, filename, final=True)
+                except Exception:
+                    traceback.print_exc()
+                    print("(exception above ignored, continuing)")
+        thread = threading.Thread(target=writeBack,
+                                  name='MeetBot2-render-%s'%(
+                                      os.path.basename(filename),))
+        thread.daemon = True
+        thread.start()
+
+    def minutesModel(self):
+        """Return the minutes.MinutesModel for the current meeting state.
+
+        It is built the first time a writer asks for it during a save
+        and shared by the other writers, until the meeting changes."""
+        key = self.M.versions()
+        model = self._model
+        if model is None or model[0] != key:
+            model = self._model = (key, minutes.MinutesModel(self.M))
+        return model[1]
+
+    def writeToFile(self, string, filename, final=False):
+        """Write a given string to a file
+
+        `string` may also be an iterable of strings, which are
+        written one after the other without joining them first.
+
+        The data goes to a temporary file in the same directory which
+        is then renamed over `filename`, so readers never see a
+        half-written file.  Nothing is written if the file already
+        has this content.  `final` says whether this is the final
+        save, for the fsyncPolicy."""
+        restricted = bool(self.M.restrict_logs)
+        if isinstance(string, str):
+            data = string.encode('utf-8')
+            digest = hashlib.sha1(data).digest()
+            if self._storedHash(filename, restricted) == digest:
+                return
+            chunks = [ data ]
+        else:
+            # We only know the hash once everything is written, so
+            # the comparison happens before the rename instead.
+            digest = None
+            hasher = hashlib.sha1()
+            def encoded(pieces):
+                for piece in pieces:
+                    piece = piece.encode('utf-8')
+                    hasher.update(piece)
+                    yield piece
+            chunks = encoded(string)
+        mode = 0o666
+        if restricted:
+            mode &= ~self.RestrictPerm
+        dirname, basename = os.path.split(filename)
+        tmpname = os.path.join(dirname, '.%s.%s.tmp'%(
+            basename, threading.current_thread().ident))
+        if os.access(tmpname, os.F_OK):
+            # Left over from a crash, and maybe with the wrong mode.
+            os.unlink(tmpname)
+        fd = os.open(tmpname, os.O_WRONLY|os.O_CREAT|os.O_EXCL, mode)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.writelines(chunks)
+                if digest is None:
+                    digest = hasher.digest()
+                    if self._storedHash(filename, restricted) == digest:
+                        f.close()
+                        os.unlink(tmpname)
+                        return
+                f.flush()
+                if final and self.fsyncPolicy != 'never':
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.replace(tmpname, filename)
+        except:
+            if os.access(tmpname, os.F_OK):
+                os.unlink(tmpname)
+            raise
+        self._fileHashes[filename] = (digest, restricted)
+        self._synced(filename, final)
+
+    def _storedHash(self, filename, restricted):
+        """Hash of what is in filename, if it was written as restricted."""
+        if filename not in self._fileHashes:
+            # First time we see this file: hash what is on disk.
+            if not os.access(filename, os.F_OK):
+                return None
+            mode = os.stat(filename).st_mode
+            f = open(filename, 'rb')
+            try:
+                digest = hashlib.sha1(f.read()).digest()
+            finally:
+                f.close()
+            self._fileHashes[filename] = \
+                (digest, not (mode & self.RestrictPerm))
+        digest, wasRestricted = self._fileHashes[filename]
+        if wasRestricted != restricted:
+            return None
+        return digest
+
+    def _synced(self, filename, final):
+        """Apply fsyncPolicy after filename has been written."""
+        policy = self.fsyncPolicy
+        if policy == 'never':
+            return
+        if final:
+            # Make the renames durable, too.
+            dirs = set([os.path.dirname(filename)])
+            if policy == 'interval':
+                for fname in list(self._unsynced):
+                    self._fsync(fname)
+                    dirs.add(os.path.dirname(fname))
+                self._unsynced.clear()
+            for dirname in dirs:
+                self._fsync(dirname or '.')
+            return
+        if policy != 'interval':
+            return
+        self._unsynced.add(filename)
+        now = time.time()
+        if now - self._lastSync < self.fsyncInterval:
+            return
+        dirs = set()
+        for fname in self._unsynced:
+            self._fsync(fname)
+            dirs.add(os.path.dirname(fname))
+        for dirname in dirs:
+            self._fsync(dirname or '.')
+        self._unsynced.clear()
+        self._lastSync = now
+
+    def _fsync(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def appendToFile(self, string, filename, footer='', final=False):
+        """Append a string to an existing file, keeping its footer.
+
+        If `footer` is given, the file must currently end in exactly
+        that text: it is cut off, `string` is written in its place,
+        and the footer is written again after it.  Returns False if
+        the file is missing or doesn't end in the footer, in which
+        case the caller should rewrite the whole file instead."""
+        if not os.access(filename, os.F_OK):
+            return False
+        footer = footer.encode('utf-8')
+        f = open(filename, 'r+b')
+        try:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            if footer:
+                if end < len(footer):
+                    return False
+                f.seek(end - len(footer))
+                if f.read() != footer:
+                    return False
+                f.seek(end - len(footer))
+                f.truncate()
+            f.write(string.encode('utf-8') + footer)
+            if final and self.fsyncPolicy != 'never':
+                f.flush()
+                os.fsync(f.fileno())
+        finally:
+            f.close()
+        # The content changed, we no longer know its hash.
+        self._fileHashes.pop(filename, None)
+        self._synced(filename, final)
+        return True
 
     def findFile(self, fname):
         """Find template files by searching paths.
@@ -237,12 +663,14 @@ class MeetingCommands(object):
 
     def do_start_meeting(self, nick, time_, line, **kwargs):
         """Begin a meeting."""
+        self.start_time = time_
+        self.expected_end = time.mktime(time_) + self.length * 60
         repl = self.replacements()
         message = self.config.startMeetingMessage%repl
         for messageline in message.split('\n'):
             self.reply(messageline)
         if line.strip():
-            self.set_meeting_topic(nick=nick, line=line, time_=time_, **kwargs)
+            self.do_set_meeting_topic(nick=nick, line=line, time_=time_, **kwargs)
             self.do_meetingname(nick=nick, line=line, time_=time_, **kwargs)
 
     def do_end_meeting(self, nick, time_, **kwargs):
@@ -252,12 +680,16 @@ class MeetingCommands(object):
         if self.old_topic:
             self.topic(self.old_topic)
         self.endtime = time_
-        self.config.save()
+        self.changed('minutes')
+        self.save()
         repl = self.replacements()
         message = self.config.endMeetingMessage%repl
         for messageline in message.split('\n'):
             self.reply(messageline)
         self.meeting_is_over = True
+        self.saveScheduler.discard()
+    do_startmeeting = do_start_meeting
+    do_endmeeting = do_end_meeting
 
     def do_set_channel_topic(self, nick, line, **kwargs):
         """Set a new topic in the channel."""
@@ -268,6 +700,7 @@ class MeetingCommands(object):
         m = items.Topic(nick=nick, line=line, **kwargs)
         self.add_to_minutes(m)
         self.settopic()
+    do_topic = do_set_channel_topic
 
     def do_set_meeting_topic(self, nick, line, **kwargs):
         """Set a meeting topic (included in all sub-topics)"""
@@ -277,14 +710,16 @@ class MeetingCommands(object):
             self.meeting_topic = None
         else:
             self.meeting_topic = line
+        self.changed('minutes')
         self.settopic()
+    do_meetingtopic = do_set_meeting_topic
 
     def do_save(self, nick, time_, **kwargs):
         """Save the config???"""
         if not self.isChair(nick):
             return
         self.end_time = time.localtime()
-        self.config.save()
+        self.save()
 
     def do_agreed(self, nick, **kwargs):
         """Add agreement to the minutes - chairs only."""
@@ -315,11 +750,11 @@ class MeetingCommands(object):
             if not chair: continue
             if chair not in self.chairs:
                 if self._channelNicks is not None and \
-                       ( chair.encode(self.config.input_codec)
-                         not in self._channelNicks()):
+                       ( chair not in self._channelNicks()):
                     self.reply("Warning: Nick not in channel: %s"%chair)
                 self.addnick(chair, lines=0)
                 self.chairs.setdefault(chair, True)
+                self.changed('minutes')
         chairs = dict(self.chairs) # make a copy
         chairs.setdefault(self.owner, True)
         self.reply("Current chairs: %s"%(" ".join(sorted(chairs.keys()))))
@@ -331,6 +766,7 @@ class MeetingCommands(object):
             chair = chair.strip()
             if chair in self.chairs:
                 del self.chairs[chair]
+                self.changed('minutes')
         chairs = dict(self.chairs) # make a copy
         chairs.setdefault(self.owner, True)
         self.reply("Current chairs: %s"%(" ".join(sorted(chairs.keys()))))
@@ -341,13 +777,14 @@ class MeetingCommands(object):
         if len(self.minutes) == 0: return
         self.reply("Removing item from minutes: %s"%str(self.minutes[-1]))
         del self.minutes[-1]
+        self.changed('minutes')
 
     def do_restrict_logs(self, nick, **kwargs):
         """When saved, remove permissions from the files."""
         if not self.isChair(nick): return
         self.restrict_logs = True
         self.reply("Restricting permissions on minutes: -%s on next #save"%\
-                   oct(RestrictPerm))
+                   oct(self.config.RestrictPerm))
 
     def do_lurk(self, nick, **kwargs):
         """Don't interact in the channel."""
@@ -366,6 +803,7 @@ class MeetingCommands(object):
         meetingname = "_".join(line.strip().lower().split())
         meetingname = re.sub(r'[^a-z0-9]', '_', meetingname)
         self._meetingname = meetingname
+        self.changed('minutes')
         self.reply("The meeting name has been set to '%s'"%meetingname)
 
     # Commands for Anyone:
@@ -436,6 +874,7 @@ class MeetingCommands(object):
         self.reply("Begin voting on: %s? Valid vote options are %s." % \
             (self.vote_topic, ", ".join(self._voteOptions)))
         self.reply("Vote using '#vote OPTION'. Only your last vote counts.")
+    do_startvote = do_start_vote
 
     def do_endvote(self, nick, line, **kwargs):
         """End voting on topic."""
@@ -486,10 +925,25 @@ class MeetingCommands(object):
                 self.reply(m1 + m2)
 
     def do_commands(self, **kwargs):
-        commands = [ "#"+x[3:] for x in dir(self) if x[:3]=="do_" ]
+        commands = [ "#"+x for x in self.commands() ]
         commands.sort()
         self.reply("Available commands: "+(" ".join(commands)))
 
+    @classmethod
+    def commands(cls):
+        """Return a dict of command name -> do_ method.
+
+        This includes aliases like do_agree.  It is built once per
+        class, so define commands as methods, not on instances."""
+        table = cls.__dict__.get('_commandTable')
+        if table is None:
+            table = { }
+            for name in dir(cls):
+                if name[:3] == "do_":
+                    table[name[3:]] = getattr(cls, name)
+            cls._commandTable = table
+        return table
+
 
 class Meeting(MeetingCommands, object):
     _lurk = False
@@ -506,7 +960,9 @@ class Meeting(MeetingCommands, object):
                  channelNicks=None,
                  extraConfig={},
                  network='nonetwork',
-                 length=60):
+                 length=60,
+                 savePool=None,
+                 renderPool=None):
 
         if getRegistryValue is not None:
             self._registryValue = getRegistryValue
@@ -519,6 +975,10 @@ class Meeting(MeetingCommands, object):
         self.channel = channel
         self.network = network
         self.length = length
+        # The plugin makes the Meeting when the meeting starts;
+        # #startmeeting (in replayed logs) sets these again.
+        self.start_time = time.localtime()
+        self.expected_end = time.mktime(self.start_time) + length * 60
         self.current_topic = ""
         self.config = Config(self, write_raw_log=write_raw_log, safeMode=safeMode,
                             extraConfig=extraConfig)
@@ -526,7 +986,7 @@ class Meeting(MeetingCommands, object):
             self.old_topic = old_topic
         else:
             self.old_topic = None
-        self.lines = [ ]
+        self.lines = lines.LineStore()
         self.minutes = [ ]
         self.attendees = { }
         self.chairs = { }
@@ -534,10 +994,36 @@ class Meeting(MeetingCommands, object):
         self.meeting_topic = None
         self._meetingname = ""
         self.meeting_is_over = False
+        # Set while journal.replay brings the meeting back.
+        self._replaying = False
         self._channelNicks = channelNicks
         self.vote_topic = None
         self._votes = { }
         self._voters = { }
+        # Saves are run on savePool (a scheduler.WriterPool) if
+        # given, keyed by saveKey so they stay in order.
+        self.savePool = savePool
+        self.saveKey = (channel, network)
+        # Writers with `offload` set render in renderPool (a
+        # scheduler.RenderPool) if given.
+        self.renderPool = renderPool
+        self.saveScheduler = scheduler.SaveScheduler(self)
+        # Work for this meeting posted by the IRC handlers runs here,
+        # in order.  Its thread is only started by the first post.
+        self.actor = scheduler.MeetingActor(
+            '%s@%s'%(channel, network),
+            maxDepth=self.config.inboxSize,
+            overflow=self.config.inboxOverflow,
+            blockTimeout=self.config.inboxBlockTimeout)
+        # Bumped whenever the corresponding state changes, so that
+        # writers only need to run when their inputs did:
+        #   log:       self.lines
+        #   minutes:   self.minutes, chairs, meeting topic and name
+        #   attendees: the set of nicks in self.attendees (but not
+        #              their line counts, which change on every line)
+        self._versions = {'log': 0, 'minutes': 0, 'attendees': 0}
+        # A journal.Journal of the input, set by the plugin.
+        self.journal = None
         if filename:
             self._filename = filename
 
@@ -568,13 +1054,53 @@ class Meeting(MeetingCommands, object):
 
     def addnick(self, nick, lines=1):
         """This person has spoken, lines=<how many lines>"""
+        if nick not in self.attendees:
+            self.changed('attendees')
         self.attendees[nick] = self.attendees.get(nick, 0) + lines
 
+    def changed(self, *inputs):
+        """Record that the given inputs of the writers changed."""
+        for name in inputs:
+            self._versions[name] += 1
+
+    def versions(self, inputs=None):
+        """Return the current versions of the given inputs (or all)."""
+        if inputs is None:
+            inputs = sorted(self._versions)
+        return tuple([ self._versions[name] for name in inputs ])
+
+    # What journal snapshots save of a meeting: everything the
+    # commands and lines change.
+    _journalState = ('owner', 'lines', 'minutes', 'attendees', 'chairs',
+                     'current_topic', 'meeting_topic', '_meetingname',
+                     'meeting_is_over', 'vote_topic', '_voteOptions',
+                     '_votes', '_voters', '_lurk', 'restrict_logs',
+                     'start_time', 'expected_end', 'endtime', 'old_topic')
+
+    def journalState(self):
+        """Return the state of the meeting to be snapshotted."""
+        return dict([ (name, self.__dict__[name])
+                      for name in self._journalState
+                      if name in self.__dict__ ])
+
+    def restoreJournalState(self, state):
+        """Load a snapshot made by journalState() into this meeting."""
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.changed('log', 'minutes', 'attendees')
+
     def isChair(self, nick):
         """Is the nick a chair?"""
         return (nick == self.owner  or  nick in self.chairs)
 
     def save(self, **kwargs):
+        """Save the meeting, waiting for the save to finish.
+
+        With a writer pool, the save is queued behind the saves
+        already pending for this meeting."""
+        if self.savePool is not None:
+            return self.savePool.submit(self.saveKey, self.config.save,
+                                        **kwargs).result()
         return self.config.save(**kwargs)
 
     # Primary entry point for new lines in the log:
@@ -585,24 +1111,35 @@ class Meeting(MeetingCommands, object):
         if time_ is None:
             time_ = time.localtime()
 
+        config = self.config
         # Handle any commands given in the line.
-        matches = self.config.command_RE.match(line)
+        if line.startswith(config.commandPrefix):
+            matches = config.command_RE.match(line)
+        else:
+            matches = None
         if matches is not None:
             command, line = matches.groups()
             command = command.lower()
             # to define new commands, define a method do_commandname .
-            if hasattr(self, "do_"+command):
-                getattr(self, "do_"+command)(nick=nick, line=line,
-                                             linenum=linenum, time_=time_)
+            do_command = self.commands().get(command)
+            if do_command is not None:
+                do_command(self, nick=nick, line=line,
+                           linenum=linenum, time_=time_)
         else:
             # Detect URLs automatically
-            if line.split('//')[0] in self.config.UrlProtocols:
+            if config.url_RE.match(line) is not None:
                 self.do_link(nick=nick, line=line,
                              linenum=linenum, time_=time_)
-        self.save(realtime_update=True)
+        # Not once the meeting is over (the final save has been
+        # done), nor for lines replayed into it.
+        if config.update_realtime and not self.meeting_is_over and \
+               not self._replaying:
+            self.saveScheduler.mark_dirty()
 
-    def addrawline(self, nick, line, time_=None):
+    def addrawline(self, nick, line, time_=None, bot=False):
         """This adds a line to the log, bypassing command execution.
+
+        `bot` marks lines said by the bot itself.
         """
         # nick = self.config.dec(nick)
         # line = self.config.dec(line)
@@ -614,12 +1151,12 @@ class Meeting(MeetingCommands, object):
 
         # Handle the logging of the line
         if line[:6] == 'ACTION':
-            logline = "%s * %s %s"%(time.strftime("%H:%M:%S", time_),
-                                 nick, line[7:].strip())
+            self.lines.append(nick, line[7:].strip(), time.mktime(time_),
+                              lines.ACTION)
         else:
-            logline = "%s <%s> %s"%(time.strftime("%H:%M:%S", time_),
-                                 nick, line.strip())
-        self.lines.append(logline)
+            self.lines.append(nick, line.strip(), time.mktime(time_),
+                              lines.BOT if bot else lines.MESSAGE)
+        self.changed('log')
         linenum = len(self.lines)
         return linenum
 
@@ -627,6 +1164,7 @@ class Meeting(MeetingCommands, object):
         """Add an item to the meeting minutes list.
         """
         self.minutes.append(m)
+        self.changed('minutes')
         
     def replacements(self):
         repl = { }
@@ -643,5 +1181,268 @@ class Meeting(MeetingCommands, object):
         repl['__version__'] = __version__
         repl['chair'] = self.owner
         repl['urlBasename'] = self.config.filename(url=True)
-        repl['basename'] = os.path.basename(self.config.filename())
+        repl['basename'] = self.config.basename
         return repl
+
+
+# Replaying of saved logs.
+
+def parse_time(time_, date=None):
+    """Parse the timestamp of a log line.
+
+    date is a (year, month, day) tuple, the timestamps themselves
+    only have the time of day.  Returns None if time_ isn't a time."""
+    if date is None:
+        date = time.localtime()[:3]
+    for format in ("%H:%M:%S", "%H:%M"):
+        try:
+            t = time.strptime(time_, format)
+        except ValueError:
+            continue
+        return time.localtime(time.mktime(tuple(date) + t[3:6] +
+                                          (0, 0, -1)))
+    return None
+
+logline_re = re.compile(r'\[?([0-9: ]*)\]? *<[@+]?([^>]+)> *(.*)')
+loglineAction_re = re.compile(r'\[?([0-9: ]*)\]? *\* *([^ ]+) *(.*)')
+filenameDate_re = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
+def process_meeting(contents, channel, filename,
+                    extraConfig={},
+                    dontSave=False,
+                    safeMode=True,
+                    existingMeeting=None,
+                    quiet=False,
+                    network='nonetwork'):
+    """Replay a saved log into a meeting, and return the Meeting.
+
+    contents is the text of the log, or an iterable of its lines
+    (like an open file, which is then read as it goes).  Each line
+    goes through Meeting.add_line with its original timestamp, the
+    date being taken from filename if it has one (YYYY-MM-DD).  No
+    realtime saves are done; call M.save() to write the output.
+
+    The first nick to speak owns the meeting.  To carry on replaying
+    into a meeting, pass it as existingMeeting.  quiet drops what the
+    bot would have said in the channel, instead of printing it."""
+    m = filenameDate_re.search(filename or '')
+    if m:
+        date = tuple([ int(x) for x in m.groups() ])
+    else:
+        date = time.localtime()[:3]
+    if existingMeeting is None:
+        extraConfig = dict(extraConfig)
+        extraConfig['update_realtime'] = False
+        kwargs = { }
+        if quiet:
+            kwargs = dict(sendReply=lambda x: None, setTopic=lambda x: None)
+        M = Meeting(channel=channel, owner=None, network=network,
+                    filename=filename, write_raw_log=False,
+                    safeMode=safeMode, extraConfig=extraConfig, **kwargs)
+        if dontSave:
+            M.config.dontSave = True
+    else:
+        M = existingMeeting
+    if isinstance(contents, str):
+        contents = contents.split('\n')
+    first = existingMeeting is None
+    last = None
+    # process all lines
+    for line in contents:
+        line = line.rstrip('\r\n')
+        # match regular spoken lines:
+        m = logline_re.match(line)
+        if m:
+            action = False
+        else:
+            # match /me lines
+            m = loglineAction_re.match(line)
+            if m is None:
+                continue
+            action = True
+        time_ = parse_time(m.group(1).strip(), date)
+        nick = m.group(2).strip()
+        line = m.group(3).strip()
+        if time_ is not None:
+            last = time_
+            if first:
+                # Until (unless) there is a #startmeeting
+                M.start_time = time_
+                M.expected_end = time.mktime(time_) + M.length * 60
+        first = False
+        if M.owner is None:
+            M.owner = nick ; M.chairs = {nick:True}
+        if action:
+            line = "ACTION " + line
+        M.add_line(nick, line, time_=time_)
+    if getattr(M, 'endtime', None) is None:
+        # The writers need one, even if the meeting didn't end.
+        M.endtime = last or time.localtime()
+    return M
+
+
+def logNetwork(path, extraConfig={}):
+    """Return the network of the meeting logged at path, as put in its
+    name by filenamePattern (or specialChannelFilenamePattern), or
+    None if the patterns don't have it."""
+    path = path.replace(os.sep, '/')
+    for name in ('filenamePattern', 'specialChannelFilenamePattern'):
+        pattern = extraConfig.get(name, getattr(Config, name))
+        if '%(network)s' not in pattern:
+            continue
+        regex = [ ]
+        named = False
+        for part in re.split(r'(%\(\w+\)s|%%.)', pattern):
+            if part == '%(network)s':
+                if named:
+                    regex.append('(?P=network)')
+                else:
+                    regex.append('(?P<network>[^/]+)')
+                    named = True
+            elif part.startswith('%'):
+                # Another name, or what strftime fills in.
+                regex.append('[^/]*')
+            else:
+                regex.append(re.escape(part))
+        m = re.search('(?:^|/)' + ''.join(regex) + r'\.log\.txt$', path)
+        if m:
+            return m.group('network')
+    return None
+
+
+def replay_log(path, extraConfig={}, dontSave=False, safeMode=True):
+    """Replay the log at path and save the output next to it.
+
+    The output files are named like the log, without its .log.txt;
+    an output which would be the log itself (TextLog) isn't written.
+    With safeMode, errors of a writer are printed and the other
+    outputs saved anyway.  The meeting is only recorded in the
+    catalog if its network is known (see logNetwork), so that it
+    replaces what the bot recorded.  Returns the Meeting."""
+    m = re.match(r'(.*)\.log\.txt$', path)
+    if m:
+        filename = m.group(1)
+    else:
+        filename = os.path.splitext(path)[0]
+    channel = '#'+os.path.basename(path).split('.')[0]
+    extraConfig = dict(extraConfig)
+    writer_map = extraConfig.get('writer_map', Config.writer_map)
+    extraConfig['writer_map'] = dict([
+        (writerkey, writer) for writerkey, writer in writer_map.items()
+        if os.path.abspath(filename + writerkey.split('|', 1)[0]) !=
+           os.path.abspath(path) ])
+    network = logNetwork(path, extraConfig)
+    if network is None:
+        network = 'nonetwork'
+        extraConfig['catalogFile'] = None
+    f = open(path, encoding='utf-8', errors='replace')
+    try:
+        M = process_meeting(f, channel=channel, filename=filename,
+                            extraConfig=extraConfig, dontSave=dontSave,
+                            safeMode=safeMode, quiet=True,
+                            network=network)
+    finally:
+        f.close()
+    # A meeting which ended in the log was saved by its #endmeeting.
+    if not M.meeting_is_over:
+        M.save()
+    return M
+
+
+def replay_file(path, extraConfig={}, dontSave=False, safeMode=True):
+    """replay_log() for a process pool: returns (path, number of
+    lines, seconds taken) instead of the Meeting."""
+    start = time.time()
+    M = replay_log(path, extraConfig=extraConfig, dontSave=dontSave,
+                   safeMode=safeMode)
+    return path, len(M.lines), time.time() - start
+
+
+def main(argv=None):
+    """The command line: replay saved logs to regenerate their output.
+
+        python -m MeetBot2.meeting replay [-j N] [--dont-save] [--strict]
+                                          LOG...
+        python -m MeetBot2.meeting rebuild [-j N] [-n] [--force] [DIR]
+
+    The logs are replayed in parallel in N processes (by default,
+    one per CPU).  rebuild regenerates the whole archive under DIR
+    (logFileDir), skipping what is up to date, see archive.rebuild.
+    Returns the last Meeting replayed if this was done in this
+    process (replay -j 1), else None."""
+    parser = argparse.ArgumentParser(prog='meeting.py')
+    commands = parser.add_subparsers(dest='command')
+    replay = commands.add_parser('replay', help="regenerate the output "
+                                 "of saved .log.txt files")
+    replay.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help="number of processes (default: one per CPU)")
+    replay.add_argument('--dont-save', action='store_true',
+                        help="only replay, don't write any files")
+    replay.add_argument('--strict', action='store_true',
+                        help="fail on the first error of a writer, "
+                        "instead of printing it and going on")
+    replay.add_argument('logs', nargs='+', metavar='LOG')
+    rebuild = commands.add_parser('rebuild', help="regenerate the outputs "
+                                  "in the archive whose log, writer or "
+                                  "configuration changed")
+    rebuild.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                         help="number of processes (default: one per CPU)")
+    rebuild.add_argument('-n', '--dry-run', action='store_true',
+                         help="only list what would be rebuilt")
+    rebuild.add_argument('--force', action='store_true',
+                         help="rebuild everything")
+    rebuild.add_argument('logFileDir', nargs='?', default=Config.logFileDir)
+    options = parser.parse_args(argv)
+    if options.command == 'rebuild':
+        from . import archive
+        stats = archive.rebuild({'logFileDir': options.logFileDir},
+                                jobs=options.jobs, force=options.force,
+                                dryRun=options.dry_run)
+        if stats['failed']:
+            print("%d logs failed"%stats['failed'])
+            sys.exit(1)
+        return None
+    if options.command != 'replay':
+        parser.error("no command given")
+
+    start = time.time()
+    meetings = nlines = failed = 0
+    M = None
+    if options.jobs <= 1 or len(options.logs) == 1:
+        for path in options.logs:
+            print('Replaying:', path)
+            M = replay_log(path, dontSave=options.dont_save,
+                           safeMode=not options.strict)
+            meetings += 1
+            nlines += len(M.lines)
+    else:
+        pool = ProcessPoolExecutor(max_workers=options.jobs)
+        try:
+            futures = dict([ (pool.submit(replay_file, path,
+                                          dontSave=options.dont_save,
+                                          safeMode=not options.strict), path)
+                             for path in options.logs ])
+            for future in as_completed(futures):
+                try:
+                    path, n, seconds = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    print("(exception above ignored, could not replay %s)"%
+                          futures[future])
+                    failed += 1
+                    continue
+                meetings += 1
+                nlines += n
+        finally:
+            pool.shutdown()
+    elapsed = max(time.time() - start, 1e-9)
+    print("%d meetings, %d lines in %.1fs: %.0f lines/s, %.1f meetings/s"%(
+        meetings, nlines, elapsed, nlines/elapsed, meetings/elapsed))
+    if failed:
+        print("%d logs failed"%failed)
+        sys.exit(1)
+    return M
+
+
+if __name__ == '__main__':
+    M = main()
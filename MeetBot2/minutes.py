@@ -0,0 +1,51 @@
+from . import actions
+
+
+class MinutesModel(object):
+    """Everything the minutes writers need, computed in one pass.
+
+    Writers used to walk M.minutes several times each (for the topic
+    list, the action items, the per-person action items, ...).  This
+    is built once from the meeting and then shared by all writers of
+    a save; see Config.minutesModel().  All sequences are tuples.
+
+    Attributes:
+      items:          all minute items, in order
+      sections:       ((topic, items), ...): the items grouped under
+                      the TOPIC item before them.  The first section
+                      holds the items before any topic and its topic
+                      is None.
+      byType:         itemtype -> items of that type
+      actions:        the ACTION items
+      actionsByNick:  ((nick, actions), ...) for every attendee, nicks
+                      sorted case-insensitively
+      unassigned:     ACTION items assigned to nobody
+      attendance:     ((nick, lines said), ...), most talkative first
+    """
+    def __init__(self, M):
+        self.items = tuple(M.minutes)
+        sections = [ ]
+        topic = None
+        topicItems = [ ]
+        byType = { }
+        for m in self.items:
+            byType.setdefault(m.itemtype, [ ]).append(m)
+            if m.itemtype == "TOPIC":
+                sections.append((topic, tuple(topicItems)))
+                topic = m
+                topicItems = [ ]
+            else:
+                topicItems.append(m)
+        sections.append((topic, tuple(topicItems)))
+        self.sections = tuple(sections)
+        self.byType = dict([ (k, tuple(v)) for k, v in byType.items() ])
+        self.actions = self.byType.get("ACTION", ())
+
+        index = actions.actionIndex(M)
+        self.actionsByNick = tuple([ (nick, tuple(items))
+                                     for nick, items in index.iterNicks() ])
+        self.unassigned = tuple(index.unassigned)
+
+        attendance = list(M.attendees.items())
+        attendance.sort(key=lambda x: x[1], reverse=True)
+        self.attendance = tuple(attendance)
@@ -1,7 +1,15 @@
+from . import catalog
+from . import journal
 from . import meeting
+from . import registry
+from . import scheduler
 from supybot import utils, plugins, ircmsgs, ircutils, callbacks
 from supybot.commands import *
+import multiprocessing
+import os
+import site
 import time
+import traceback
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -9,16 +17,68 @@ try:
 except ImportError:
     _ = lambda x: x
 
+# The running meetings, see registry.MeetingRegistry.  The plugin is
+# threaded, so every change to a meeting is done holding its lock.
 try:
     meeting_cache
 except NameError:
-    meeting_cache = {}
+    meeting_cache = registry.MeetingRegistry()
+else:
+    if isinstance(meeting_cache, dict):
+        # Reloaded over a version which used a plain dict.
+        meeting_cache = registry.MeetingRegistry(meeting_cache)
 
 try:
     recent_meetings
 except NameError:
     recent_meetings = []
 
+# Saves of all meetings run here, so that file I/O and formatting
+# don't hold up message handling.
+try:
+    writer_pool
+except NameError:
+    writer_pool = scheduler.WriterPool()
+
+# Writers which are slow to render (HTMLfromReST) run here, so they
+# don't hold the GIL of the bot.  The bot has threads running, so the
+# workers aren't forked from it.  Plugins aren't on sys.path (they are
+# loaded from supybot.directories.plugins), so the workers are given
+# the directory this plugin was loaded from, to unpickle writers.
+try:
+    render_pool
+except NameError:
+    render_pool = scheduler.RenderPool(
+        max_workers=2,
+        mp_context=multiprocessing.get_context('forkserver'),
+        initializer=site.addsitedir,
+        initargs=(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),))
+
+
+# At most this many meetings are listed by recentmeetings and
+# chairedmeetings, so they can't be used to flood the channel.
+max_listed_meetings = 10
+
+
+def journal_dir(config=meeting.Config):
+    """Where live meetings are journaled, see journal.Journal."""
+    return config.journalDir or os.path.join(config.logFileDir, '.journal')
+
+
+def catalog_file(config=meeting.Config):
+    """The database where saved meetings are recorded, see catalog.Catalog."""
+    if not config.catalogFile:
+        return None
+    return os.path.join(config.logFileDir, config.catalogFile)
+
+
+def describe_meeting(row):
+    """One line about a meeting from the catalog, for replies."""
+    name = row['name'] or row['title'] or row['channel']
+    return "{} {} ({}, chaired by {}): {}".format(
+        time.strftime("%Y-%m-%d %H:%M", time.localtime(row['start_time'])),
+        name, row['channel'], ", ".join(row['chairs']), row['url'])
+
 
 class MeetBot2(callbacks.Plugin):
     """MeetBot Reborn"""
@@ -27,6 +87,132 @@ class MeetBot2(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(MeetBot2, self)
         self.__parent.__init__(irc)
+        self._recover(irc)
+
+    def die(self):
+        """Stop the meetings' threads and the pools, on unload or reload.
+
+        The meetings are left in their journals, so loading the plugin
+        again recovers them (see _recover)."""
+        global writer_pool, render_pool
+        for meeting_key, unique_meeting in meeting_cache.items():
+            # Let the lines already posted to it be added.
+            unique_meeting.actor.stop()
+            unique_meeting.actor.join()
+            with meeting_cache.locked(meeting_key) as current:
+                if current is not unique_meeting or \
+                       not meeting_cache.end(meeting_key, unique_meeting):
+                    continue
+            unique_meeting.saveScheduler.flush()
+            if unique_meeting.journal is not None:
+                unique_meeting.journal.close()
+        writer_pool.shutdown()
+        render_pool.shutdown()
+        # Made again when the plugin is loaded again.
+        del writer_pool, render_pool
+        self.__parent.die()
+
+    def _new_meeting(self, irc, channel, network, owner, old_topic):
+        """Make the Meeting object for a meeting in channel."""
+        # These callbacks are used to send data to the channel
+        def _set_topic(x):
+            irc.sendMsg(ircmsgs.topic(channel, x))
+
+        def _send_reply(x):
+            irc.sendMsg(ircmsgs.privmsg(channel, x))
+
+        def _channel_nicks():
+            if channel not in irc.state.channels:
+                # Not joined (yet): recovering meetings on startup.
+                return set()
+            return irc.state.channels[channel].users
+
+        return meeting.Meeting(
+            channel=channel,
+            owner=owner,
+            old_topic=old_topic,
+            write_raw_log=True,
+            setTopic=_set_topic,
+            sendReply=_send_reply,
+            getRegistryValue=self.registryValue,
+            safeMode=True,
+            channelNicks=_channel_nicks,
+            network=network,
+            savePool=writer_pool,
+            renderPool=render_pool,
+            )
+
+    def _recover(self, irc):
+        """Rebuild the meetings which were running when the bot stopped.
+
+        Meetings still in meeting_cache (the plugin was only
+        reloaded) are left alone."""
+        for path in journal.journals(journal_dir()):
+            journal_ = journal.Journal(path,
+                                       meeting.Config.journalSnapshotEvery)
+            try:
+                header, state, events = journal_.load()
+            except Exception:
+                traceback.print_exc()
+                print("(exception above ignored, not recovering %s)"%path)
+                continue
+            channel, network = header['channel'], header['network']
+            meeting_key = (channel, network)
+            unique_meeting = meeting_cache.start(
+                meeting_key, lambda: self._new_meeting(
+                    irc, channel, network, header['owner'],
+                    header['old_topic']))
+            if unique_meeting is None:
+                continue
+            with meeting_cache.locked(meeting_key):
+                # Journals from older versions don't have these.
+                if 'start_time' in header:
+                    unique_meeting.start_time = \
+                        time.localtime(header['start_time'])
+                    unique_meeting.expected_end = header['expected_end']
+                # Everything was already said in the channel once, and
+                # the bot hasn't joined it yet.
+                sendReply = unique_meeting._sendReply
+                setTopic = unique_meeting._setTopic
+                channelNicks = unique_meeting._channelNicks
+                unique_meeting._sendReply = unique_meeting._setTopic = \
+                    lambda x: None
+                unique_meeting._channelNicks = None
+                try:
+                    journal.replay(unique_meeting, state, events)
+                except Exception:
+                    traceback.print_exc()
+                    print("(exception above ignored, not recovering %s)"%
+                          path)
+                    meeting_cache.end(meeting_key, unique_meeting)
+                    unique_meeting.actor.stop()
+                    continue
+                finally:
+                    unique_meeting._sendReply = sendReply
+                    unique_meeting._setTopic = setTopic
+                    unique_meeting._channelNicks = channelNicks
+                journal_.reopen()
+                unique_meeting.journal = journal_
+            print("Recovered meeting in %s on %s (%d events replayed)"%(
+                channel, network, len(events)))
+
+    def _start_journal(self, unique_meeting):
+        """Start journaling a new meeting."""
+        config = unique_meeting.config
+        journal_ = journal.Journal(
+            journal.Journal.filename(journal_dir(config),
+                                     unique_meeting.channel,
+                                     unique_meeting.network),
+            config.journalSnapshotEvery)
+        journal_.create({'channel': unique_meeting.channel,
+                         'network': unique_meeting.network,
+                         'owner': unique_meeting.owner,
+                         'old_topic': unique_meeting.old_topic,
+                         'start_time': time.mktime(unique_meeting.start_time),
+                         'expected_end': unique_meeting.expected_end,
+                         })
+        unique_meeting.journal = journal_
+        return unique_meeting
 
     def doPrivmsg(self, irc, msg):
         nick = msg.nick
@@ -34,37 +220,94 @@ class MeetBot2(callbacks.Plugin):
         payload = msg.args[1]
         network = irc.msg.tags['receivedOn']
 
+        # The time it was said, not when the meeting gets to it.
+        received = time.localtime()
+
         # get the meeting object if it already exists
         meeting_key = (channel, network)
-        unique_meeting = meeting_cache.get(meeting_key, None)
+        unique_meeting = meeting_cache.get(meeting_key)
 
         # if no meeting is happening, quit
         if unique_meeting is None:
             return
 
-        # add line to our meeting buffer?
-        unique_meeting.add_line(nick, payload)
-
-        # end the meeting on demand
-        if unique_meeting.meeting_is_over:
+        # The meeting's own thread adds the line, don't wait for it.
+        unique_meeting.actor.post(self._add_line, meeting_key,
+                                  unique_meeting, nick, payload, received)
+
+    def _add_line(self, meeting_key, unique_meeting, nick, payload, received):
+        """Add a line to a meeting, run by the meeting's actor."""
+        with meeting_cache.locked(meeting_key) as current:
+            # the meeting may have ended while the line was waiting
+            if current is not unique_meeting:
+                return
+
+            # journal it first, then add line to our meeting buffer
+            journal_ = unique_meeting.journal
+            if journal_ is not None:
+                journal_.append(journal.LINE, received, nick, payload)
+            unique_meeting.add_line(nick, payload, time_=received)
+            if journal_ is not None:
+                journal_.applied(unique_meeting)
+
+            # #endmeeting has ended and saved the meeting, forget it
+            if unique_meeting.meeting_is_over and \
+                   meeting_cache.end(meeting_key, unique_meeting):
+                unique_meeting.actor.stop()
+                if journal_ is not None:
+                    journal_.remove()
+
+    def _add_raw_line(self, meeting_key, unique_meeting, nick, payload,
+                      received):
+        """Log a line said by the bot, run by the meeting's actor."""
+        with meeting_cache.locked(meeting_key) as current:
+            if current is unique_meeting:
+                journal_ = unique_meeting.journal
+                if journal_ is not None:
+                    journal_.append(journal.RAW, received, nick, payload)
+                unique_meeting.addrawline(nick, payload, time_=received,
+                                          bot=True)
+                if journal_ is not None:
+                    journal_.applied(unique_meeting)
+
+    def _end_meeting(self, meeting_key, unique_meeting, save=True):
+        """End a meeting after the lines already posted to it.
+
+        Run by the meeting's actor.  Returns False if it was already
+        over."""
+        with meeting_cache.locked(meeting_key) as current:
+            if current is not unique_meeting or \
+                   not meeting_cache.end(meeting_key, unique_meeting):
+                return False
+            unique_meeting.actor.stop()
+            if save:
+                unique_meeting.endtime = time.localtime()
+                unique_meeting.changed('minutes')
+        # Don't let a realtime save run after the final one, or for a
+        # meeting which isn't saved.
+        unique_meeting.saveScheduler.discard()
+        if save:
+            # This waits for the final save, and any realtime saves
+            # still queued before it, to finish.
             unique_meeting.save()
-            unique_meeting.do_end_meeting(nick, unique_meeting.endtime)
-            del meeting_cache[meeting_key]
-
+        if unique_meeting.journal is not None:
+            unique_meeting.journal.remove()
+        return True
 
     def startmeeting(self, irc, msg, args, channel):
+        """<channel> <meeting name>
+
+        Start a meeting in the channel.
+        """
         print('its a new meeting')
         nick = msg.nick
         channel = msg.args[0]
         payload = msg.args[1]
         network = irc.msg.tags['receivedOn']
 
-        # get the meeting object if it already exists
-        meeting_key = (channel, network)
-        unique_meeting = meeting_cache.get(meeting_key, None)
-
         # check if the meeting already exists
-        if unique_meeting is not None:
+        meeting_key = (channel, network)
+        if meeting_key in meeting_cache:
             irc.error("This meeting already exists.")
             return
 
@@ -75,33 +318,17 @@ class MeetBot2(callbacks.Plugin):
             return
 
         # if we passed our checks, let's set up the meeting
-        # This callback is used to send data to the channel
-
-        def _set_topic(x):
-            irc.sendMsg(ircmsgs.topic(channel, x))
-
-        def _send_reply(x):
-            irc.sendMsg(ircmsgs.privmsg(channel, x))
-
-        def _channel_nicks():
-            return irc.state.channels[channel].users
-
-        # create the meeting
-        unique_meeting = meeting.Meeting(
-            channel=channel,
-            owner=nick,
-            old_topic=irc.state.channels[channel].topic,
-            write_raw_log=True,
-            setTopic=_set_topic,
-            sendReply=_send_reply,
-            getRegistryValue=self.registryValue,
-            safeMode=True,
-            channelNicks=_channel_nicks,
-            network=network,
-            )
-
-        # add the meeting to the meeting list cache
-        meeting_cache[meeting_key] = unique_meeting
+        def _new_meeting():
+            return self._start_journal(self._new_meeting(
+                irc, channel, network, nick,
+                irc.state.channels[channel].topic))
+
+        # add the meeting to the meeting list cache, unless another
+        # thread started it meanwhile
+        unique_meeting = meeting_cache.start(meeting_key, _new_meeting)
+        if unique_meeting is None:
+            irc.error("This meeting already exists.")
+            return
 
         # keep the recent meetings list at no more than 10
         while len(recent_meetings) > 9:
@@ -123,14 +350,11 @@ class MeetBot2(callbacks.Plugin):
         Example: deletemeeting #mychannel freenode False
         """
         meeting_key = (channel, network)
-        if meeting_key not in meeting_cache:
+        unique_meeting = meeting_cache.get(meeting_key)
+        if unique_meeting is None or not self._post_end(unique_meeting,
+                                                         meeting_key, save):
             irc.reply("Meeting for {} channel {} is not found".format(network, channel))
             return
-        if save:
-            unique_meeting = meeting_cache.get(meeting_key, None)
-            unique_meeting.endtime = time.localtime()
-            unique_meeting.config.save()
-        del meeting_cache[meeting_key]
         irc.reply("Deleted meeting on {} {}".format(network, channel))
     deletemeeting = wrap(deletemeeting, ['admin', "channel", "something", optional("boolean", True)])
 
@@ -140,21 +364,30 @@ class MeetBot2(callbacks.Plugin):
         End a meeting. Example: endmeeting #mychannel freenode
         """
         meeting_key = (channel, network)
-        if meeting_key not in meeting_cache:
+        unique_meeting = meeting_cache.get(meeting_key)
+        if unique_meeting is None:
             irc.reply("Meeting for {} channel {} is not found".format(network, channel))
             return
 
-        unique_meeting = meeting_cache.get(meeting_key, None)
         if not unique_meeting.isChair(msg.nick):
             return
 
-        unique_meeting.endtime = time.localtime()
-        unique_meeting.config.save()
-        del meeting_cache[meeting_key]
+        if not self._post_end(unique_meeting, meeting_key, True):
+            return
         irc.reply("Ended meeting at {}".format(unique_meeting.endtime))
     endmeeting = wrap(endmeeting, [('checkCapability', 'admin'), "something", "something"])
 
 
+    def _post_end(self, unique_meeting, meeting_key, save):
+        """Have the meeting's actor end it, and wait for that."""
+        # Not dropped if the inbox is full, or the meeting wouldn't end.
+        future = unique_meeting.actor.post(self._end_meeting, meeting_key,
+                                           unique_meeting, save, force=True)
+        if future is None:
+            # Its actor has stopped, so it is ending already.
+            return False
+        return future.result()
+
     def listmeetings(self, irc, msg, args):
         """List all active meetings."""
         reply = ""
@@ -165,6 +398,50 @@ class MeetBot2(callbacks.Plugin):
             irc.reply(reply)
     listmeetings = wrap(listmeetings, ['admin'])
 
+    def _catalog_reply(self, irc, rows, none):
+        """Reply with one meeting from the catalog per line."""
+        if not rows:
+            irc.reply(none)
+            return
+        for row in rows:
+            irc.reply(describe_meeting(row))
+
+    def recentmeetings(self, irc, msg, args, channel, count):
+        """[<channel>] [<count>]
+
+        List the last <count> (default 5, at most 10) meetings held in
+        <channel>.
+        Example: recentmeetings #mychannel 10
+        """
+        path = catalog_file()
+        if path is None:
+            irc.error("The meeting catalog is disabled.")
+            return
+        count = min(count, max_listed_meetings)
+        rows = catalog.catalog(path).recent(channel, irc.network, count)
+        self._catalog_reply(irc, rows,
+                            "No meetings found in {}".format(channel))
+    recentmeetings = wrap(recentmeetings, ['channel',
+                                           optional('positiveInt', 5)])
+
+    def chairedmeetings(self, irc, msg, args, nick, count):
+        """<nick> [<count>]
+
+        List the last <count> (default 5, at most 10) meetings chaired by
+        <nick>.
+        Example: chairedmeetings alice 10
+        """
+        path = catalog_file()
+        if path is None:
+            irc.error("The meeting catalog is disabled.")
+            return
+        count = min(count, max_listed_meetings)
+        rows = catalog.catalog(path).chairedBy(nick, count)
+        self._catalog_reply(irc, rows,
+                            "No meetings found chaired by {}".format(nick))
+    chairedmeetings = wrap(chairedmeetings, ['something',
+                                             optional('positiveInt', 5)])
+
     def outFilter(self, irc, msg):
         """Log outgoing messages from supybot.
         """
@@ -174,9 +451,11 @@ class MeetBot2(callbacks.Plugin):
                 channel = msg.args[0]
                 payload = msg.args[1]
                 meeting_key = (channel, irc.network)
-                unique_meeting = meeting_cache.get(meeting_key, None)
+                unique_meeting = meeting_cache.get(meeting_key)
                 if unique_meeting is not None:
-                    unique_meeting.addrawline(nick, payload)
+                    unique_meeting.actor.post(self._add_raw_line,
+                                              meeting_key, unique_meeting,
+                                              nick, payload, time.localtime())
         except Exception as e:
             print(type(e))
             print(e.args)
@@ -0,0 +1,185 @@
+import collections
+import hashlib
+import threading
+import time
+import traceback
+
+
+def mwclientSite(host, username=None, password=''):
+    """Log in to the wiki at host with mwclient, return the Site."""
+    import mwclient
+    force_login = (username != None)
+    site = mwclient.Site(host, force_login=force_login)
+    if force_login:
+        site.login(username, password)
+    return site
+
+
+class WikiPublisher(object):
+    """Upload pages to MediaWiki sites from a background thread.
+
+    `publish` only queues the page and returns at once.  One logged
+    in site object (see `siteFactory`) is kept per (host, username)
+    and reused for every upload.  If a page is published again
+    before the previous version was uploaded, only the latest
+    version is uploaded.  Uploads whose content is what we (or
+    anyone) last saved to the page are skipped.  Failed uploads are
+    retried `retries` times, waiting `backoff` seconds, then twice as
+    long each time up to `maxBackoff`; the site is logged in again
+    before each retry.
+
+    `siteFactory(host, username, password)` returns an object like
+    mwclient.Site: `site.pages[name]` has `text()` and
+    `save(text, summary=...)`.  Tests can pass a fake one.
+    """
+    def __init__(self, siteFactory=mwclientSite, retries=4, backoff=2.0,
+                 maxBackoff=60.0):
+        self.siteFactory = siteFactory
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self._cond = threading.Condition()
+        # (host, username) -> logged in site
+        self._sites = { }
+        # (host, page) -> sha1 of what was last saved to it
+        self._published = { }
+        # (host, page) -> (body, username, password, summary), the
+        # latest version of pages waiting to be uploaded
+        self._pending = { }
+        self._queue = collections.deque()
+        self._busy = False
+        self._thread = None
+        # Metrics
+        self.uploads = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+
+    def publish(self, host, pagename, body, username=None, password='',
+                summary="Meeting"):
+        """Queue body to be saved as pagename on the wiki at host."""
+        key = (host, pagename)
+        digest = hashlib.sha1(body.encode('utf-8')).digest()
+        with self._cond:
+            if key not in self._pending and \
+                   self._published.get(key) == digest:
+                self.skipped += 1
+                return
+            if key in self._pending:
+                self.coalesced += 1
+            else:
+                self._queue.append(key)
+            self._pending[key] = (body, username, password, summary)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._worker, name='MeetBot2-wiki-publisher')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        """Block until every queued page has been uploaded (or given up).
+
+        Returns False if timeout ran out first."""
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._cond:
+            while self._queue or self._busy:
+                if end is None:
+                    self._cond.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        """Return a dict of counters, for monitoring."""
+        with self._cond:
+            return {'uploads': self.uploads,
+                    'skipped': self.skipped,
+                    'coalesced': self.coalesced,
+                    'retried': self.retried,
+                    'failed': self.failed,
+                    'pending': len(self._queue),
+                    }
+
+    def _site(self, host, username, password):
+        site = self._sites.get((host, username))
+        if site is None:
+            site = self.siteFactory(host, username, password)
+            self._sites[(host, username)] = site
+        return site
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                key = self._queue.popleft()
+                body, username, password, summary = self._pending.pop(key)
+                self._busy = True
+            try:
+                self._upload(key, body, username, password, summary)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _upload(self, key, body, username, password, summary):
+        host, pagename = key
+        digest = hashlib.sha1(body.encode('utf-8')).digest()
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self._cond:
+                    self.retried += 1
+                time.sleep(delay)
+                delay = min(delay*2, self.maxBackoff)
+                with self._cond:
+                    if key in self._pending:
+                        # A newer version is queued, upload that one.
+                        self.coalesced += 1
+                        return
+            try:
+                site = self._site(host, username, password)
+                page = site.pages[pagename]
+                if key not in self._published:
+                    # Find out what is on the wiki now.
+                    current = page.text()
+                    self._published[key] = \
+                        hashlib.sha1(current.encode('utf-8')).digest()
+                if self._published[key] == digest:
+                    with self._cond:
+                        self.skipped += 1
+                    return
+                page.save(body, summary=summary)
+            except Exception:
+                traceback.print_exc()
+                print("(exception above ignored, will retry upload of %s)"%
+                      pagename)
+                # Start again with a fresh session.
+                self._sites.pop((host, username), None)
+                continue
+            self._published[key] = digest
+            with self._cond:
+                self.uploads += 1
+            return
+        with self._cond:
+            self.failed += 1
+        print("Giving up on uploading %s to %s"%(pagename, host))
+
+
+_publisher = None
+_publisherLock = threading.Lock()
+
+def publisher():
+    """Return the WikiPublisher shared by all meetings."""
+    global _publisher
+    with _publisherLock:
+        if _publisher is None:
+            _publisher = WikiPublisher()
+        return _publisher
@@ -0,0 +1,89 @@
+import contextlib
+import threading
+
+
+class MeetingRegistry(object):
+    """The running meetings, keyed by (channel, network).
+
+    The plugin handles messages in many threads at once.  Looking a
+    meeting up takes no lock: the mapping is never changed in place,
+    starting or ending a meeting replaces it with an updated copy
+    (under a lock).  Each meeting also has its own lock, which is
+    held while it is changed (see `locked`), so that lines of one
+    meeting are added one at a time while other meetings carry on.
+
+    `start` and `end` are atomic: of several threads starting the
+    same meeting only one creates it, and of several ending it only
+    one gets it back to do the final save.
+    """
+    def __init__(self, meetings=None):
+        self._lock = threading.Lock()
+        # key -> (meeting, lock)
+        self._meetings = { }
+        if meetings:
+            for key, M in meetings.items():
+                self._meetings[key] = (M, threading.RLock())
+
+    def get(self, key, default=None):
+        entry = self._meetings.get(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def __contains__(self, key):
+        return key in self._meetings
+
+    def __len__(self):
+        return len(self._meetings)
+
+    def keys(self):
+        return list(self._meetings.keys())
+
+    def items(self):
+        return [ (key, entry[0]) for key, entry in self._meetings.items() ]
+
+    def start(self, key, factory):
+        """Register the meeting made by factory() under key.
+
+        Returns the new meeting, or None (without calling factory) if
+        there already is a meeting for key."""
+        with self._lock:
+            if key in self._meetings:
+                return None
+            M = factory()
+            meetings = dict(self._meetings)
+            meetings[key] = (M, threading.RLock())
+            self._meetings = meetings
+        return M
+
+    def end(self, key, M=None):
+        """Unregister the meeting under key and return it.
+
+        If M is given, only if it is still the meeting registered
+        there.  Returns None if there was nothing to end, because
+        another thread got to it first."""
+        with self._lock:
+            entry = self._meetings.get(key)
+            if entry is None or (M is not None and entry[0] is not M):
+                return None
+            meetings = dict(self._meetings)
+            del meetings[key]
+            self._meetings = meetings
+        return entry[0]
+
+    @contextlib.contextmanager
+    def locked(self, key):
+        """Hold the lock of the meeting under key, and yield the meeting.
+
+        Yields None if there is no such meeting, or it ended while
+        waiting for the lock."""
+        entry = self._meetings.get(key)
+        if entry is None:
+            yield None
+            return
+        M, lock = entry
+        with lock:
+            if self._meetings.get(key) is not entry:
+                yield None
+            else:
+                yield M
@@ -0,0 +1,394 @@
+import collections
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ProcessPoolExecutor
+
+
+class SaveScheduler(object):
+    """Coalesce realtime saves of one meeting.
+
+    Instead of saving after every line, `Meeting.add_line` marks the
+    meeting dirty.  The realtime save is then done at most
+    `realtimeMaxLatency` seconds later, or as soon as
+    `realtimeMaxDirtyLines` lines are waiting, whichever comes first.
+    A burst of lines thus costs one `Config.save` call.
+
+    A full save (#endmeeting, #save, deletemeeting) writes everything
+    anyway, so it just discards whatever is pending here.
+    """
+    def __init__(self, M):
+        self.M = M
+        self._lock = threading.Lock()
+        # Held while a save runs, so that the timer thread and the
+        # thread adding lines never save at the same time.
+        self._saveLock = threading.Lock()
+        self._timer = None
+        # The last realtime save handed to the writer pool.
+        self._queued = None
+        self._dirty = 0
+        self._firstDirty = None
+        # Metrics
+        self.requests = 0
+        self.saves = 0
+        self.coalesced = 0
+        self.maxLatency = 0.0
+
+    def mark_dirty(self):
+        """Note that a line was added; save now or schedule a save."""
+        config = self.M.config
+        latency = getattr(config, 'realtimeMaxLatency', 0)
+        maxDirty = getattr(config, 'realtimeMaxDirtyLines', 1)
+        with self._lock:
+            self.requests += 1
+            self._dirty += 1
+            if self._firstDirty is None:
+                self._firstDirty = time.time()
+            flushNow = (not latency or self._dirty >= maxDirty)
+            if not flushNow and self._timer is None:
+                self._timer = threading.Timer(latency, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if flushNow:
+            self.flush()
+
+    def flush(self):
+        """Do the pending realtime save now, if there is one.
+
+        If the meeting has a writer pool, the save is only queued
+        there; a save which is queued but hasn't started yet will
+        pick up the new lines too, so another one isn't queued."""
+        pool = getattr(self.M, 'savePool', None)
+        if pool is None:
+            with self._saveLock:
+                if self._take(saved=True):
+                    self._save()
+            return
+        queued = self._queued
+        if queued is not None and not queued.running() \
+               and not queued.done():
+            self._take(saved=False)
+            return
+        if self._take(saved=True):
+            self._queued = pool.submit(self.M.saveKey, self._save)
+
+    def _save(self):
+        try:
+            self.M.config.save(realtime_update=True)
+        except Exception:
+            if not self.M.config.safeMode:
+                raise
+            traceback.print_exc()
+            print("(exception above ignored, continuing)")
+
+    def discard(self):
+        """Forget pending changes, a full save is writing them."""
+        self._take(saved=False)
+
+    def _take(self, saved):
+        """Reset the dirty state, returning whether anything was dirty."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            dirty = self._dirty
+            if not dirty:
+                return False
+            if saved:
+                self.saves += 1
+                self.coalesced += dirty - 1
+                self.maxLatency = max(self.maxLatency,
+                                      time.time() - self._firstDirty)
+            else:
+                self.coalesced += dirty
+            self._dirty = 0
+            self._firstDirty = None
+            return True
+
+    def stats(self):
+        """Return a dict of counters, for monitoring."""
+        with self._lock:
+            return {'requests': self.requests,
+                    'saves': self.saves,
+                    'coalesced': self.coalesced,
+                    'pending': self._dirty,
+                    'maxLatency': self.maxLatency,
+                    }
+
+
+class WriterPool(object):
+    """A bounded pool of threads running saves in the background.
+
+    Tasks are submitted with a key, normally the (channel, network)
+    of the meeting.  Tasks with the same key run one at a time, in
+    the order they were submitted; tasks with different keys run in
+    parallel.  When more than `maxPending` tasks are waiting,
+    `submit` blocks until the workers catch up.
+    """
+    def __init__(self, workers=4, maxPending=256):
+        self.maxPending = maxPending
+        self._cond = threading.Condition()
+        # key -> deque of (future, fn, args, kwargs) not started yet
+        self._tasks = { }
+        # keys with waiting tasks and nothing running, in FIFO order
+        self._ready = collections.deque()
+        self._running = set()
+        self._pending = 0
+        self._shutdown = False
+        self._threads = [ ]
+        for i in range(workers):
+            t = threading.Thread(target=self._worker,
+                                 name='MeetBot2-writer-%d'%i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) to run after earlier tasks of key.
+
+        Returns a concurrent.futures.Future."""
+        future = Future()
+        with self._cond:
+            while self._pending >= self.maxPending and not self._shutdown:
+                self._cond.wait()
+            if self._shutdown:
+                raise RuntimeError("WriterPool is shut down")
+            queue = self._tasks.get(key)
+            if queue is None:
+                queue = self._tasks[key] = collections.deque()
+            queue.append((future, fn, args, kwargs))
+            self._pending += 1
+            if key not in self._running and len(queue) == 1:
+                self._ready.append(key)
+            self._cond.notify_all()
+        return future
+
+    def wait(self, key, timeout=None):
+        """Block until every task submitted for key so far has run."""
+        done = self.submit(key, lambda: None)
+        done.result(timeout)
+
+    def pending(self, key=None):
+        """Number of tasks waiting, for one key or all of them."""
+        with self._cond:
+            if key is None:
+                return self._pending
+            return len(self._tasks.get(key, ()))
+
+    def shutdown(self, wait=True):
+        """Stop the workers once the queued tasks have run."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    if self._shutdown and not self._pending:
+                        return
+                    self._cond.wait()
+                key = self._ready.popleft()
+                future, fn, args, kwargs = self._tasks[key].popleft()
+                self._running.add(key)
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self._cond:
+                self._running.discard(key)
+                self._pending -= 1
+                if self._tasks[key]:
+                    self._ready.append(key)
+                else:
+                    del self._tasks[key]
+                self._cond.notify_all()
+
+
+class RenderPool(object):
+    """A process pool for slow renders, which can get rid of hung ones.
+
+    Works like the concurrent.futures.ProcessPoolExecutor it wraps
+    (the arguments are passed on to it), but when a render takes too
+    long, `recycle` kills the workers and starts new ones.  Renders
+    which were running alongside the hung one then fail with
+    BrokenProcessPool.
+    """
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._executor = ProcessPoolExecutor(**kwargs)
+        # Renders submitted to the current executor, not done yet.
+        self._futures = set()
+        self._shutdown = False
+        self.recycled = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in a worker, returning a Future."""
+        with self._lock:
+            future = self._executor.submit(fn, *args, **kwargs)
+            futures = self._futures
+            futures.add(future)
+        future.add_done_callback(futures.discard)
+        return future
+
+    def recycle(self, future):
+        """Kill the workers running `future` and start new ones.
+
+        Returns False if the future is done, or its workers were
+        already replaced."""
+        with self._lock:
+            if future not in self._futures:
+                return False
+            executor = self._executor
+            if not self._shutdown:
+                self._executor = ProcessPoolExecutor(**self._kwargs)
+                self._futures = set()
+            self.recycled += 1
+        # ProcessPoolExecutor can't kill its workers (before Python
+        # 3.14's terminate_workers), so do it by hand.
+        processes = list((executor._processes or { }).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        return True
+
+    def shutdown(self, wait=True):
+        """Stop the workers once the submitted renders are done."""
+        with self._lock:
+            self._shutdown = True
+            executor = self._executor
+        executor.shutdown(wait=wait)
+
+
+class MeetingActor(object):
+    """A bounded inbox of work for one meeting, run by its own thread.
+
+    The IRC handlers only `post` what happened (with the time it was
+    received) and return; the worker thread then does it, one event
+    after the other.  So a slow meeting only delays itself, not the
+    handler threads other channels need.
+
+    When `maxDepth` events are waiting, `overflow` says what `post`
+    does: 'block' waits up to `blockTimeout` seconds for room and then
+    drops the event, 'drop' drops it at once.  Dropped events are
+    counted.  The worker thread itself never blocks on its own inbox,
+    and neither do control events (like ending the meeting) posted
+    with force=True: those are always queued, unless the actor stopped.
+    """
+    def __init__(self, name, maxDepth=1000, overflow='block',
+                 blockTimeout=5.0):
+        if overflow not in ('block', 'drop'):
+            raise ValueError("overflow must be 'block' or 'drop', not %r"%
+                             (overflow,))
+        self.name = name
+        self.maxDepth = maxDepth
+        self.overflow = overflow
+        self.blockTimeout = blockTimeout
+        self._cond = threading.Condition()
+        # (future, received, fn, args, kwargs)
+        self._inbox = collections.deque()
+        self._thread = None
+        self._stopped = False
+        # Metrics
+        self.processed = 0
+        self.dropped = 0
+        self.maxDepthSeen = 0
+        self.lag = 0.0
+        self.maxLag = 0.0
+
+    def post(self, fn, *args, force=False, **kwargs):
+        """Queue fn(*args, **kwargs) to be run by the worker thread.
+
+        Returns a concurrent.futures.Future of the result, or None if
+        the event was dropped (inbox full, or the actor stopped).
+        With force, the event is queued even if the inbox is full."""
+        received = time.time()
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                self.dropped += 1
+                return None
+            if len(self._inbox) >= self.maxDepth and not force and \
+                   threading.current_thread() is not self._thread:
+                if self.overflow == 'block':
+                    end = received + self.blockTimeout
+                    while len(self._inbox) >= self.maxDepth and \
+                              not self._stopped:
+                        remaining = end - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                if len(self._inbox) >= self.maxDepth or self._stopped:
+                    self.dropped += 1
+                    return None
+            self._inbox.append((future, received, fn, args, kwargs))
+            self.maxDepthSeen = max(self.maxDepthSeen, len(self._inbox))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._worker, name='MeetBot2-meeting-%s'%(
+                        self.name,))
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+        return future
+
+    def stop(self):
+        """Stop accepting events; the worker exits once the inbox is empty."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def join(self, timeout=None):
+        """Wait for the worker to exit, after stop()."""
+        with self._cond:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def depth(self):
+        """Number of events waiting."""
+        return len(self._inbox)
+
+    def stats(self):
+        """Return a dict of counters, for monitoring.
+
+        `lag` is how long the last event waited in the inbox."""
+        with self._cond:
+            return {'depth': len(self._inbox),
+                    'maxDepth': self.maxDepthSeen,
+                    'processed': self.processed,
+                    'dropped': self.dropped,
+                    'lag': self.lag,
+                    'maxLag': self.maxLag,
+                    }
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._inbox:
+                    if self._stopped:
+                        return
+                    self._cond.wait()
+                future, received, fn, args, kwargs = self._inbox.popleft()
+                self.lag = time.time() - received
+                self.maxLag = max(self.maxLag, self.lag)
+                # Wake up posters waiting for room.
+                self._cond.notify_all()
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    traceback.print_exc()
+                    print("(exception above ignored, continuing)")
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self._cond:
+                self.processed += 1
@@ -1,42 +1,16 @@
+import hashlib
 import os
 import re
 import textwrap
+import threading
 import time
 
+from . import actions
+from . import lines
+from . import publish
+from .formatting import html, rst, text, mw, TextWrapper, wrapList, \
+     replaceWRAP, makeNickRE
 
-# Data sanitizing for various output methods
-def html(text):
-    """Escape bad sequences (in HTML) in user-generated lines."""
-    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-
-def rst(text):
-    """Escapes bad sequences in reST"""
-    matches = re.compile('_( |-|$)')
-    return matches.sub(r'\_\1', text)
-
-
-# wraping functions (for RST)
-class TextWrapper(textwrap.TextWrapper):
-    # why is this a class?
-    wordsep_re = re.compile(r'(\s+)')
-
-
-def wrapList(item, indent=0):
-    return TextWrapper(width=72, initial_indent=' '*indent,
-                       subsequent_indent= ' '*(indent+2),
-                       break_long_words=False).fill(item)
-
-
-def replaceWRAP(item):
-    re_wrap = re.compile(r'sWRAPs(.*)eWRAPe', re.DOTALL)
-    def repl(m):
-        return TextWrapper(width=72, break_long_words=False).fill(m.group(1))
-    return re_wrap.sub(repl, item)
-
-
-def makeNickRE(nick):
-    return re.compile('\\b'+re.escape(nick)+'\\b', re.IGNORECASE)
 
 def MeetBotVersion():
     from . import meeting
@@ -47,9 +21,26 @@ def MeetBotVersion():
 
 
 class _BaseWriter(object):
+    # Which parts of the meeting the output is made from, see
+    # Meeting.changed().  On realtime saves, the writer is only run
+    # again if one of these changed.  The minutes show how many lines
+    # each attendee said, so they change with the log too.
+    depends = ('minutes', 'attendees', 'log')
+    # Set by writers which are slow to render.  They also implement
+    # snapshot() and render(), see Config.offload.
+    offload = False
+    # Bump this when a change to the writer changes its output, so
+    # that archive rebuilds (see archive.py) regenerate it.
+    version = 1
+
     def __init__(self, M, **kwargs):
         self.M = M
 
+    def sources(self, extension=None, **kwargs):
+        """Return the paths of the files (besides the log) which the
+        output is made from, like templates and stylesheets."""
+        return [ ]
+
     def format(self, extension=None, **kwargs):
         """Override this method to implement the formatting.
 
@@ -69,16 +60,25 @@ class _BaseWriter(object):
         """
         raise NotImplementedError
 
+    def saved(self):
+        """Called by Config.save once the output of `format` (or
+        `format_incremental`) is in the file.
+
+        Writers which append to their file on realtime updates only
+        count what is on disk from then on, so that a failed write
+        makes the next save rewrite the whole file."""
+        pass
+
     @property
     def pagetitle(self):
-        if self.M._meetingTopic:
-            return "%s: %s"%(self.M.channel, self.M._meetingTopic)
+        if self.M.meeting_topic:
+            return "%s: %s"%(self.M.channel, self.M.meeting_topic)
         return "%s Meeting"%self.M.channel
 
     def replacements(self):
         return {'pageTitle':self.pagetitle,
                 'owner':self.M.owner,
-                'starttime':time.strftime("%H:%M:%S", self.M.starttime),
+                'starttime':time.strftime("%H:%M:%S", self.M.start_time),
                 'endtime':time.strftime("%H:%M:%S", self.M.endtime),
                 'timeZone':self.M.config.timeZone,
                 'fullLogs':self.M.config.basename+'.log.html',
@@ -87,28 +87,19 @@ class _BaseWriter(object):
                 'MeetBotVersion':MeetBotVersion(),
              }
 
+    @property
+    def model(self):
+        """The minutes.MinutesModel of the meeting, shared by all writers."""
+        return self.M.config.minutesModel()
+
     def iterNickCounts(self):
-        nicks = [ (n,c) for (n,c) in list(self.M.attendees.items()) ]
-        nicks.sort(key=lambda x: x[1], reverse=True)
-        return nicks
+        return self.model.attendance
 
     def iterActionItemsNick(self):
-        for nick in sorted(list(self.M.attendees.keys()), key=lambda x: x.lower()):
-            nick_re = makeNickRE(nick)
-            def nickitems(nick_re):
-                for m in self.M.minutes:
-                    # The hack below is needed because of pickling problems
-                    if m.itemtype != "ACTION": continue
-                    if nick_re.search(m.line) is None: continue
-                    m.assigned = True
-                    yield m
-            yield nick, nickitems(nick_re=nick_re)
+        return self.model.actionsByNick
 
     def iterActionItemsUnassigned(self):
-        for m in self.M.minutes:
-            if m.itemtype != "ACTION": continue
-            if getattr(m, 'assigned', False): continue
-            yield m
+        return self.model.unassigned
 
     def get_template(self, escape=lambda s: s):
         M = self.M
@@ -123,16 +114,15 @@ class _BaseWriter(object):
                               'nick':'',
                               'time':'', 'link':'', 'anchor':''},
                      'items':[] }
-        haveTopic = False
-        for m in M.minutes:
-            if m.itemtype == "TOPIC":
-                if nextTopic['topic']['nick'] or nextTopic['items']:
-                    MeetingItems.append(nextTopic)
-                nextTopic = {'topic':m.template(M, escape), 'items':[] }
-                haveTopic = True
-            else:
+        sections = self.model.sections
+        for topic, items in sections:
+            if topic is not None:
+                nextTopic = {'topic':topic.template(M, escape), 'items':[] }
+            elif not items and len(sections) > 1:
+                continue
+            for m in items:
                 nextTopic['items'].append(m.template(M, escape))
-        MeetingItems.append(nextTopic)
+            MeetingItems.append(nextTopic)
         repl['MeetingItems'] = MeetingItems
         # Format of MeetingItems:
         # [ {'topic': {item_dict},
@@ -160,10 +150,7 @@ class _BaseWriter(object):
         #                      (that isn't a URL)
         #              'url_quoteescaped': 'url' but with " escaped for use in
         #                                  <a href="$url_quoteescaped">
-        ActionItems = [ ]
-        for m in M.minutes:
-            if m.itemtype != "ACTION": continue
-            ActionItems.append(escape(m.line))
+        ActionItems = [ escape(m.line) for m in self.model.actions ]
         repl['ActionItems'] = ActionItems
         # Format of ActionItems: It's just a very simple list of lines.
         # [line, line, line, ...]
@@ -246,28 +233,54 @@ class Template(_BaseWriter):
     If a template ends in .txt, parse with a text-based genshi
     templater.  Otherwise, parse with a HTML-based genshi templater.
     """
+    # Compiled templates, shared by all meetings:
+    #   (path, is text template) -> (mtime, compiled template)
+    _compiled = { }
+    _compiledLock = threading.Lock()
+    _genshi = None
+
+    @classmethod
+    def compile(cls, path, text):
+        """Return the compiled genshi template in `path`.
+
+        Templates are parsed once and reused until the file's mtime
+        changes."""
+        mtime = os.stat(path).st_mtime
+        key = (path, text)
+        cached = cls._compiled.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with cls._compiledLock:
+            if cls._genshi is None:
+                import genshi.template
+                cls._genshi = genshi.template
+            # Do we want to use a text template or HTML ?
+            if text:
+                Template = cls._genshi.NewTextTemplate   # plain text
+            else:
+                Template = cls._genshi.MarkupTemplate    # HTML-like
+            f = open(path, 'r')
+            try:
+                tmpl = Template(f.read(), filepath=path)
+            finally:
+                f.close()
+            cls._compiled[key] = (mtime, tmpl)
+        return tmpl
+
     def format(self, extension=None, template='+template.html'):
         repl = self.get_template2()
 
-        # Do we want to use a text template or HTML ?
-        import genshi.template
-        if template[-4:] in ('.txt', '.rst'):
-            Template = genshi.template.NewTextTemplate   # plain text
-        else:
-            Template = genshi.template.MarkupTemplate    # HTML-like
-
+        text = template[-4:] in ('.txt', '.rst')
         template = self.M.config.findFile(template)
 
         # Do the actual templating work
-        try:
-            f = open(template, 'r')
-            tmpl = Template(f.read())
-            stream = tmpl.generate(**repl)
-        finally:
-            f.close()
-
+        tmpl = self.compile(template, text)
+        stream = tmpl.generate(**repl)
         return stream.render()
 
+    def sources(self, extension=None, template='+template.html'):
+        return [ self.M.config.findFile(template) ]
+
 
 class _CSSmanager(object):
     _css_head = textwrap.dedent('''\
@@ -275,6 +288,61 @@ class _CSSmanager(object):
         %s
         </style>
         ''')
+    # Stylesheets are read once per process: path -> (mtime, css).
+    _cssCache = { }
+    # Shared stylesheets known to be on disk already.
+    _cssWritten = set()
+    _cssLock = threading.Lock()
+
+    @classmethod
+    def readCSS(cls, path):
+        """Return the contents of the stylesheet in `path`.
+
+        The file is read again only when its mtime changes."""
+        mtime = os.stat(path).st_mtime
+        cached = cls._cssCache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        f = open(path, 'r')
+        try:
+            css = f.read()
+        finally:
+            f.close()
+        with cls._cssLock:
+            cls._cssCache[path] = (mtime, css)
+        return css
+
+    def sharedCSS(self, css):
+        """Write `css` once into logFileDir and return a link to it.
+
+        The file is named after a hash of its contents, so every
+        meeting using the same stylesheet links to the same file and
+        it never needs to be rewritten."""
+        config = self.M.config
+        digest = hashlib.sha1(css.encode('utf-8')).hexdigest()[:12]
+        fname = os.path.join(config.logFileDir, 'meetbot-%s.css'%digest)
+        if not getattr(config, 'dontSave', False):
+            with self._cssLock:
+                if fname not in self._cssWritten:
+                    if not os.access(fname, os.F_OK):
+                        config.writeToFile(css, fname, final=True)
+                    self._cssWritten.add(fname)
+        href = os.path.relpath(fname, os.path.dirname(config.filename()))
+        return ('<link rel="stylesheet" type="text/css" href="%s">'%
+                html(href.replace(os.sep, '/')))
+
+    def cssSources(self, name):
+        """The stylesheet used by getCSS(name), as a list for sources()."""
+        cssfile = getattr(self.M.config, 'cssFile_'+name, '')
+        if cssfile.lower() == 'none':
+            return [ ]
+        elif cssfile in ('', 'default'):
+            cssfile = '+css-'+name+'-default.css'
+        try:
+            return [ self.M.config.findFile(cssfile) ]
+        except IOError:
+            # getCSS goes without (or fails, without safeMode).
+            return [ ]
 
     def getCSS(self, name):
         cssfile = getattr(self.M.config, 'cssFile_'+name, '')
@@ -286,12 +354,14 @@ class _CSSmanager(object):
             css_fname = '+css-'+name+'-default.css'
         else:
             css_fname = cssfile
-        css_fname = self.M.config.findFile(css_fname)
         try:
+            css_fname = self.M.config.findFile(css_fname)
             # Stylesheet specified
             if getattr(self.M.config, 'cssEmbed_'+name, True):
                 # external stylesheet
-                css = file(css_fname).read()
+                css = self.readCSS(css_fname)
+                if getattr(self.M.config, 'cssShared_'+name, False):
+                    return self.sharedCSS(css)
                 return self._css_head%css
             else:
                 # linked stylesheet
@@ -307,7 +377,7 @@ class _CSSmanager(object):
             try:
                 css_fname = os.path.join(os.path.dirname(__file__),
                                          'css-'+name+'-default.css')
-                css = open(css_fname).read()
+                css = self.readCSS(css_fname)
                 return self._css_head%css
             except:
                 if not self.M.config.safeMode:
@@ -318,42 +388,139 @@ class _CSSmanager(object):
 
 
 class TextLog(_BaseWriter):
+    update_realtime = True
+    depends = ('log',)
+
+    def __init__(self, M, **kwargs):
+        _BaseWriter.__init__(self, M, **kwargs)
+        # How much of M.lines is already on disk, and M.lines.rewrites
+        # at that time, so that we notice if lines were removed.
+        self._saved = 0
+        self._savedRewrites = 0
+        # The same for the output not yet known to be on disk.
+        self._pending = None
+
+    def _mark_pending(self, n):
+        self._pending = (n, self.M.lines.rewrites)
+        self._saved = 0
+
+    def saved(self):
+        if self._pending is not None:
+            self._saved, self._savedRewrites = self._pending
+            self._pending = None
+
     def format(self, extension=None):
+        """Write raw text logs.
+
+        This yields the log line by line, see Config.save."""
         M = self.M
-        """Write raw text logs."""
-        return "\n".join(M.lines)
-    update_realtime = True
+        # Lines may be added while this runs, only write (and count)
+        # those there are now.
+        n = len(M.lines)
+        self._mark_pending(n)
+        first = True
+        for line in M.lines[:n]:
+            if first:
+                first = False
+                yield line
+            else:
+                yield "\n" + line
+
+    def format_incremental(self, extension=None):
+        """Return only the lines added since the last save.
+
+        Returns None if the lines on disk no longer match the start
+        of M.lines, in which case the whole file must be rewritten."""
+        M = self.M
+        saved = self._saved
+        n = len(M.lines)
+        if saved == 0 or n < saved or \
+               M.lines.rewrites != self._savedRewrites:
+            return None
+        new = M.lines[saved:n]
+        self._mark_pending(n)
+        if not new:
+            return ''
+        return "\n" + "\n".join(new)
 
 
 class HTMLlog1(_BaseWriter):
+    update_realtime = True
+    depends = ('log',)
+    # (pygments module, lexer) once pygments has been set up, and
+    # style -> HtmlFormatter for whole pages.  Shared by all meetings.
+    _pygments = None
+    _formatters = { }
+    _pygmentsLock = threading.Lock()
+
+    def __init__(self, M, **kwargs):
+        _BaseWriter.__init__(self, M, **kwargs)
+        # How many of M.lines are in the file, M.lines.rewrites at
+        # the time, and everything in the file after the last line.
+        self._saved = 0
+        self._savedRewrites = 0
+        self._footer = None
+        # (lines, rewrites) of the output not yet known to be on disk.
+        self._pending = None
+        # (style, HtmlFormatter) for fragments.  Its line numbering
+        # is changed on every use, so it isn't shared.
+        self._fragmentFormatter = None
+
+    @classmethod
+    def lexer(cls):
+        """Return (pygments, lexer) with the lexer for MeetBot logs.
+
+        This is IrcLogsLexer which also knows about #commands.  It
+        is a subclass, so IrcLogsLexer itself is left alone."""
+        if cls._pygments is not None:
+            return cls._pygments
+        with cls._pygmentsLock:
+            if cls._pygments is None:
+                import pygments
+                from pygments.lexers import IrcLogsLexer
+                import pygments.token as token
+                from pygments.lexer import bygroups
+                msg = IrcLogsLexer.tokens['msg']
+                class MeetBotLogLexer(IrcLogsLexer):
+                    tokens = {
+                        'msg': msg[:1] + [
+                            # match:   #topic commands
+                            (r"(\#topic[ \t\f\v]*)(.*\n)",
+                             bygroups(token.Keyword, token.Generic.Heading),
+                             '#pop'),
+                            # match:   #command   (others)
+                            (r"(\#[^\s]+[ \t\f\v]*)(.*\n)",
+                             bygroups(token.Keyword, token.Generic.Strong),
+                             '#pop'),
+                            ] + msg[1:],
+                        }
+                cls._pygments = (pygments, MeetBotLogLexer())
+        return cls._pygments
+
+    @classmethod
+    def formatter(cls, style):
+        """Return the (shared) HtmlFormatter for whole pages."""
+        formatter = cls._formatters.get(style)
+        if formatter is None:
+            from pygments.formatters import HtmlFormatter
+            formatter = HtmlFormatter(lineanchors='l', full=True, style=style)
+            cls._formatters[style] = formatter
+        return formatter
+
     def format(self, extension=None):
         """Write pretty HTML logs."""
         M = self.M
         # pygments lexing setup:
         # (pygments HTML-formatter handles HTML-escaping)
-        import pygments
-        from pygments.lexers import IrcLogsLexer
-        from pygments.formatters import HtmlFormatter
-        import pygments.token as token
-        from pygments.lexer import bygroups
         # Don't do any encoding in this function with pygments.
         # That's only right before the i/o functions in the Config
         # object.
-        formatter = HtmlFormatter(lineanchors='l',
-                                  full=True, style=M.config.pygmentizeStyle,
-                                  outencoding=self.M.config.output_codec)
-        Lexer = IrcLogsLexer
-        Lexer.tokens['msg'][1:1] = \
-           [ # match:   #topic commands
-            (r"(\#topic[ \t\f\v]*)(.*\n)",
-             bygroups(token.Keyword, token.Generic.Heading), '#pop'),
-             # match:   #command   (others)
-            (r"(\#[^\s]+[ \t\f\v]*)(.*\n)",
-             bygroups(token.Keyword, token.Generic.Strong), '#pop'),
-           ]
-        lexer = Lexer()
-        #from rkddp.interact import interact ; interact()
-        out = pygments.highlight("\n".join(M.lines), lexer, formatter)
+        pygments, lexer = self.lexer()
+        formatter = self.formatter(M.config.pygmentizeStyle)
+        n = len(M.lines)
+        self._pending = (n, M.lines.rewrites)
+        self._saved = 0
+        out = pygments.highlight("\n".join(M.lines[:n]), lexer, formatter)
         # Hack it to add "pre { white-space: pre-wrap; }", which make
         # it wrap the pygments html logs.  I think that in a newer
         # version of pygmetns, the "prestyles" HTMLFormatter option
@@ -369,86 +536,178 @@ class HTMLlog1(_BaseWriter):
             out = re.sub(r"(\n\s*</style>)",
                          r"\npre { white-space: pre-wrap; }\1",
                          out, count=1)
+        self._footer = out[out.rfind('</pre>'):]
         return out
 
+    @property
+    def footer(self):
+        return self._footer or ''
+
+    def saved(self):
+        if self._pending is not None:
+            self._saved, self._savedRewrites = self._pending
+            self._pending = None
+
+    def format_incremental(self, extension=None):
+        """Return the highlighted lines added since the last save.
+
+        The result goes into the file just before `footer`.  Returns
+        None if the file has to be regenerated instead."""
+        M = self.M
+        saved = self._saved
+        # Lines may be added while this runs, only output (and count)
+        # those there are now.
+        n = len(M.lines)
+        if not self._footer or saved == 0 or saved > n or \
+               M.lines.rewrites != self._savedRewrites:
+            return None
+        if saved == n:
+            return ''
+        pygments, lexer = self.lexer()
+        style = M.config.pygmentizeStyle
+        if self._fragmentFormatter is None or \
+               self._fragmentFormatter[0] != style:
+            from pygments.formatters import HtmlFormatter
+            self._fragmentFormatter = \
+                (style, HtmlFormatter(lineanchors='l', style=style))
+        formatter = self._fragmentFormatter[1]
+        formatter.linenostart = saved + 1
+        out = pygments.highlight("\n".join(M.lines[saved:n]), lexer,
+                                 formatter)
+        # Only keep the lines, not the <div><pre> around them.
+        start = out.find('<pre>') + len('<pre>')
+        if out.startswith('<span></span>', start):
+            start += len('<span></span>')
+        self._pending = (n, M.lines.rewrites)
+        self._saved = 0
+        return out[start:out.rfind('</pre>')]
+
 
 class HTMLlog2(_BaseWriter, _CSSmanager):
+    update_realtime = True
+    depends = ('log',)
+    # Everything after the last log line.  Realtime updates cut this
+    # off the file, append the new lines and write it back.
+    footer = "</pre>\n</body></html>\n"
+
+    command_re = re.compile(r"(#[^\s]+[ \t\f\v]*)(.*)")
+    command_topic_re = re.compile(r"(#topic[ \t\f\v]*)(.*)")
+    hilight_re = re.compile(r"([^\s]+:)( .*)")
+
+    def __init__(self, M, **kwargs):
+        _BaseWriter.__init__(self, M, **kwargs)
+        # Rendered fragments of M.lines, index i is line number i+1.
+        # _cachedRewrites is M.lines.rewrites when they were rendered,
+        # to notice if lines were removed.  _saved is how many of the
+        # fragments are already on disk, _pending how many are in the
+        # output not yet known to be on disk.
+        self._rendered = [ ]
+        self._cachedRewrites = 0
+        self._saved = 0
+        self._pending = None
+
+    def render_line(self, row):
+        """Return the HTML fragment for one line (a lines.Line) of the log."""
+        if row.kind == lines.ACTION:
+            return ('<a href="#l-%(lineno)s" name="l-%(lineno)s">'
+                    '<span class="tm">%(time)s </span></a>'
+                    '<span class="nka">* %(nick)s</span> '
+                    '<span class="ac">%(line)s</span>'%
+                      {'lineno':row.linenum,
+                       'time':row.timestr(),
+                       'nick':html(row.nick),
+                       'line':html(row.text),})
+        line = row.text
+        # Match #topic
+        m2 = self.command_topic_re.match(line)
+        if m2 is not None:
+            outline = ('<span class="topic">%s</span>'
+                       '<span class="topicline">%s</span>'%
+                       (html(m2.group(1)),html(m2.group(2))))
+        # Match other #commands
+        if m2 is None:
+          m2 = self.command_re.match(line)
+          if m2 is not None:
+            outline = ('<span class="cmd">%s</span>'
+                       '<span class="cmdline">%s</span>'%
+                       (html(m2.group(1)),html(m2.group(2))))
+        # match hilights
+        if m2 is None:
+          m2 = self.hilight_re.match(line)
+          if m2 is not None:
+            outline = ('<span class="hi">%s</span>'
+                       '%s'%
+                       (html(m2.group(1)),html(m2.group(2))))
+        if m2 is None:
+            outline = html(line)
+        return ('<a href="#l-%(lineno)s" name="l-%(lineno)s">'
+                '<span class="tm">%(time)s</span></a>'
+                '<span class="nk"> &lt;%(nick)s&gt;</span> '
+                '%(line)s'%{'lineno':row.linenum,
+                            'time':row.timestr(),
+                            'nick':html(row.nick),
+                            'line':outline,})
+
+    def render_lines(self):
+        """Bring the fragment cache up to date with M.lines."""
+        loglines = self.M.lines
+        if loglines.rewrites != self._cachedRewrites or \
+               len(loglines) < len(self._rendered):
+            # History changed, start over.
+            self._rendered = [ ]
+            self._saved = 0
+            self._pending = None
+            self._cachedRewrites = loglines.rewrites
+        for row in loglines.rows(len(self._rendered)):
+            self._rendered.append(self.render_line(row))
+        return self._rendered
+
     def format(self, extension=None):
-        """Write pretty HTML logs."""
-        M = self.M
-        lines = [ ]
-        line_re = re.compile(r"""\s*
-            (?P<time> \[?[0-9:\s]*\]?)\s*
-            (?P<nick>\s+<[@+\s]?[^>]+>)\s*
-            (?P<line>.*)
-        """, re.VERBOSE)
-        action_re = re.compile(r"""\s*
-            (?P<time> \[?[0-9:\s]*\]?)\s*
-            (?P<nick>\*\s+[@+\s]?[^\s]+)\s*
-            (?P<line>.*)
-        """,re.VERBOSE)
-        command_re = re.compile(r"(#[^\s]+[ \t\f\v]*)(.*)")
-        command_topic_re = re.compile(r"(#topic[ \t\f\v]*)(.*)")
-        hilight_re = re.compile(r"([^\s]+:)( .*)")
-        lineNumber = 0
-        for l in M.lines:
-            lineNumber += 1  # starts from 1
-            # is it a regular line?
-            m = line_re.match(l)
-            if m is not None:
-                line = m.group('line')
-                # Match #topic
-                m2 = command_topic_re.match(line)
-                if m2 is not None:
-                    outline = ('<span class="topic">%s</span>'
-                               '<span class="topicline">%s</span>'%
-                               (html(m2.group(1)),html(m2.group(2))))
-                # Match other #commands
-                if m2 is None:
-                  m2 = command_re.match(line)
-                  if m2 is not None:
-                    outline = ('<span class="cmd">%s</span>'
-                               '<span class="cmdline">%s</span>'%
-                               (html(m2.group(1)),html(m2.group(2))))
-                # match hilights
-                if m2 is None:
-                  m2 = hilight_re.match(line)
-                  if m2 is not None:
-                    outline = ('<span class="hi">%s</span>'
-                               '%s'%
-                               (html(m2.group(1)),html(m2.group(2))))
-                if m2 is None:
-                    outline = html(line)
-                lines.append('<a href="#l-%(lineno)s" name="l-%(lineno)s">'
-                             '<span class="tm">%(time)s</span></a>'
-                             '<span class="nk">%(nick)s</span> '
-                             '%(line)s'%{'lineno':lineNumber,
-                                         'time':html(m.group('time')),
-                                         'nick':html(m.group('nick')),
-                                         'line':outline,})
-                continue
-            m = action_re.match(l)
-            # is it a action line?
-            if m is not None:
-                lines.append('<a href="#l-%(lineno)s" name="l-%(lineno)s">'
-                             '<span class="tm">%(time)s</span></a>'
-                             '<span class="nka">%(nick)s</span> '
-                             '<span class="ac">%(line)s</span>'%
-                               {'lineno':lineNumber,
-                                'time':html(m.group('time')),
-                                'nick':html(m.group('nick')),
-                                'line':html(m.group('line')),})
-                continue
-            print(l)
-            print((m.groups()))
-            print(("**error**", l))
+        """Write pretty HTML logs.
 
+        This yields the page line by line, see Config.save."""
+        M = self.M
+        loglines = self.render_lines()
+        self._pending = len(self._rendered)
+        self._saved = 0
         css = self.getCSS(name='log')
-        return html_template%{'pageTitle':"%s log"%html(M.channel),
-                              #'body':"<br>\n".join(lines),
-                              'body':"<pre>"+("\n".join(lines))+"</pre>",
-                              'headExtra':css,
-                              }
+        def body():
+            yield "<pre>"
+            first = True
+            for line in loglines:
+                if first:
+                    first = False
+                    yield line
+                else:
+                    yield "\n" + line
+            yield "</pre>"
+        return iterHTMLpage({'pageTitle':"%s log"%html(M.channel),
+                             'headExtra':css,
+                             }, body())
+
+    def sources(self, extension=None):
+        return self.cssSources('log')
+
+    def saved(self):
+        if self._pending is not None:
+            self._saved = self._pending
+            self._pending = None
+
+    def format_incremental(self, extension=None):
+        """Return the HTML for the lines added since the last save.
+
+        The result goes into the file just before `footer`.  Returns
+        None if the file has to be regenerated instead."""
+        self.render_lines()
+        saved = self._saved
+        if saved == 0 or saved > len(self._rendered):
+            return None
+        new = self._rendered[saved:]
+        self._pending = len(self._rendered)
+        self._saved = 0
+        if not new:
+            return ''
+        return "\n" + "\n".join(new)
 
 
 HTMLlog = HTMLlog2
@@ -466,6 +725,17 @@ html_template = textwrap.dedent('''\
     ''')
 
 
+def iterHTMLpage(repl, body):
+    """Yield html_template filled in from repl, piece by piece.
+
+    `body` is an iterable of the pieces going in place of %(body)s."""
+    head, tail = html_template.split('%(body)s')
+    yield head%repl
+    for piece in body:
+        yield piece
+    yield tail%repl
+
+
 class HTML1(_BaseWriter):
 
     body = textwrap.dedent('''\
@@ -514,21 +784,19 @@ class HTML1(_BaseWriter):
 
         # Add all minute items to the table
         MeetingItems = [ ]
-        for m in M.minutes:
+        for m in self.model.items:
             MeetingItems.append(m.html(M))
         MeetingItems = "\n".join(MeetingItems)
 
         # Action Items
         ActionItems = [ ]
-        for m in M.minutes:
-            # The hack below is needed because of pickling problems
-            if m.itemtype != "ACTION": continue
+        for m in self.model.actions:
             ActionItems.append("  <li>%s</li>"%html(m.line))
         if len(ActionItems) == 0:
             ActionItems.append("  <li>(none)</li>")
         ActionItems = "\n".join(ActionItems)
 
-        # Action Items, by person (This could be made lots more efficient)
+        # Action Items, by person
         ActionItemsPerson = [ ]
         for nick, items in self.iterActionItemsNick():
             headerPrinted = False
@@ -585,7 +853,7 @@ class HTML2(_BaseWriter, _CSSmanager):
 
         haveTopic = None
         inSublist = False
-        for m in M.minutes:
+        for m in self.model.items:
             item = '<li>'+m.html2(M)
             if m.itemtype == "TOPIC":
                 if inSublist:
@@ -624,9 +892,7 @@ class HTML2(_BaseWriter, _CSSmanager):
         ActionItems.append(self.heading('Action items'))
         ActionItems.append('<ol>')
         numActionItems = 0
-        for m in M.minutes:
-            # The hack below is needed because of pickling problems
-            if m.itemtype != "ACTION": continue
+        for m in self.model.actions:
             ActionItems.append("  <li>%s</li>"%html(m.line))
             numActionItems += 1
         if numActionItems == 0:
@@ -637,7 +903,7 @@ class HTML2(_BaseWriter, _CSSmanager):
     def actionItemsPerson(self):
         """Return the 'Action items, by person' block."""
         M = self.M
-        # Action Items, by person (This could be made lots more efficient)
+        # Action Items, by person
         ActionItemsPerson = [ ]
         ActionItemsPerson.append(self.heading('Action items, by person'))
         ActionItemsPerson.append('<ol>')
@@ -692,42 +958,49 @@ class HTML2(_BaseWriter, _CSSmanager):
         return '<h3>%s</h3>'%name
 
     def format(self, extension=None):
-        """Write the minutes summary."""
+        """Write the minutes summary.
+
+        This yields the page one section at a time, see Config.save."""
         M = self.M
 
         repl = self.replacements()
 
-        body = [ ]
-        body.append(textwrap.dedent("""\
-            <h1>%(pageTitle)s</h1>
-            <span class="details">
-            Meeting started by %(owner)s at %(starttime)s %(timeZone)s
-            (<a href="%(fullLogs)s">full logs</a>).</span>
-            """%repl))
-        body.append(self.meetingItems())
-        body.append(textwrap.dedent("""\
-            <span class="details">
-            Meeting ended at %(endtime)s %(timeZone)s
-            (<a href="%(fullLogs)s">full logs</a>).</span>
-            """%repl))
-        body.append(self.actionItems())
-        body.append(self.actionItemsPerson())
-        body.append(self.peoplePresent())
-        body.append("""<span class="details">"""
-                    """Generated by <a href="%(MeetBotInfoURL)s">MeetBot</a>"""
-                    """%(MeetBotVersion)s.</span>"""%repl)
-        body = [ b for b in body if b is not None ]
-        body = "\n<br><br>\n\n\n\n".join(body)
-        body = replaceWRAP(body)
-
+        def sections():
+            yield textwrap.dedent("""\
+                <h1>%(pageTitle)s</h1>
+                <span class="details">
+                Meeting started by %(owner)s at %(starttime)s %(timeZone)s
+                (<a href="%(fullLogs)s">full logs</a>).</span>
+                """%repl)
+            yield self.meetingItems()
+            yield textwrap.dedent("""\
+                <span class="details">
+                Meeting ended at %(endtime)s %(timeZone)s
+                (<a href="%(fullLogs)s">full logs</a>).</span>
+                """%repl)
+            yield self.actionItems()
+            yield self.actionItemsPerson()
+            yield self.peoplePresent()
+            yield ("""<span class="details">"""
+                   """Generated by <a href="%(MeetBotInfoURL)s">MeetBot</a>"""
+                   """%(MeetBotVersion)s.</span>"""%repl)
+
+        def body():
+            first = True
+            for section in sections():
+                if section is None:
+                    continue
+                if not first:
+                    yield "\n<br><br>\n\n\n\n"
+                first = False
+                yield replaceWRAP(section)
 
         css = self.getCSS(name='minutes')
-        repl.update({'body': body,
-                     'headExtra': css,
-                     })
-        html = html_template % repl
+        repl['headExtra'] = css
+        return iterHTMLpage(repl, body())
 
-        return html
+    def sources(self, extension=None):
+        return self.cssSources('minutes')
 HTML = HTML2
 
 
@@ -790,7 +1063,7 @@ class ReST(_BaseWriter):
         M.rst_urls = [ ]
         M.rst_refs = { }
         haveTopic = None
-        for m in M.minutes:
+        for m in self.model.items:
             item = "* "+m.rst(M)
             if m.itemtype == "TOPIC":
                 if haveTopic:
@@ -808,34 +1081,25 @@ class ReST(_BaseWriter):
 
         # Action Items
         ActionItems = [ ]
-        for m in M.minutes:
-            # The hack below is needed because of pickling problems
-            if m.itemtype != "ACTION": continue
+        for m in self.model.actions:
             #already escaped
             ActionItems.append(wrapList("* %s"%rst(m.line), indent=0))
         ActionItems = "\n\n".join(ActionItems)
 
-        # Action Items, by person (This could be made lots more efficient)
+        # Action Items, by person
         ActionItemsPerson = [ ]
-        for nick in sorted(list(M.attendees.keys()), key=lambda x: x.lower()):
-            nick_re = makeNickRE(nick)
+        for nick, items in self.iterActionItemsNick():
             headerPrinted = False
-            for m in M.minutes:
-                # The hack below is needed because of pickling problems
-                if m.itemtype != "ACTION": continue
-                if nick_re.search(m.line) is None: continue
+            for m in items:
                 if not headerPrinted:
                     ActionItemsPerson.append("* %s"%rst(nick))
                     headerPrinted = True
                 ActionItemsPerson.append(wrapList("* %s"%rst(m.line), 2))
-                m.assigned = True
         # unassigned items:
         Unassigned = [ ]
         Unassigned.append("* **UNASSIGNED**")
         numberUnassigned = 0
-        for m in M.minutes:
-            if m.itemtype != "ACTION": continue
-            if getattr(m, 'assigned', False): continue
+        for m in self.iterActionItemsUnassigned():
             Unassigned.append(wrapList("* %s"%rst(m.line), 2))
             numberUnassigned += 1
         if numberUnassigned == 0:
@@ -865,17 +1129,25 @@ class ReST(_BaseWriter):
         return body
 
 class HTMLfromReST(_BaseWriter):
+    # docutils is slow on long meetings, so it runs in another
+    # process if possible.
+    offload = True
 
-    def format(self, extension=None):
-        M = self.M
+    def snapshot(self, extension=None):
+        """Return the ReST source, render() turns it into HTML."""
+        return ReST(self.M).format(extension)
+
+    @staticmethod
+    def render(rst):
         import docutils.core
-        rst = ReST(M).format(extension)
         rstToHTML = docutils.core.publish_string(rst, writer_name='html',
                              settings_overrides={'file_insertion_enabled': 0,
                                                  'raw_enabled': 0,
-                                'output_encoding':self.M.config.output_codec})
-        return rstToHTML
+                                                 'output_encoding': 'utf-8'})
+        return rstToHTML.decode('utf-8')
 
+    def format(self, extension=None):
+        return self.render(self.snapshot(extension))
 
 
 class Text(_BaseWriter):
@@ -887,7 +1159,7 @@ class Text(_BaseWriter):
         MeetingItems = [ ]
         MeetingItems.append(self.heading('Meeting summary'))
         haveTopic = None
-        for m in M.minutes:
+        for m in self.model.items:
             item = "* "+m.text(M)
             if m.itemtype == "TOPIC":
                 if haveTopic:
@@ -907,9 +1179,7 @@ class Text(_BaseWriter):
         ActionItems = [ ]
         numActionItems = 0
         ActionItems.append(self.heading('Action items'))
-        for m in M.minutes:
-            # The hack below is needed because of pickling problems
-            if m.itemtype != "ACTION": continue
+        for m in self.model.actions:
             #already escaped
             ActionItems.append(wrapList("* %s"%text(m.line), indent=0))
             numActionItems += 1
@@ -919,30 +1189,23 @@ class Text(_BaseWriter):
 
     def actionItemsPerson(self):
         M = self.M
-        # Action Items, by person (This could be made lots more efficient)
+        # Action Items, by person
         ActionItemsPerson = [ ]
         ActionItemsPerson.append(self.heading('Action items, by person'))
         numberAssigned = 0
-        for nick in sorted(list(M.attendees.keys()), key=lambda x: x.lower()):
-            nick_re = makeNickRE(nick)
+        for nick, items in self.iterActionItemsNick():
             headerPrinted = False
-            for m in M.minutes:
-                # The hack below is needed because of pickling problems
-                if m.itemtype != "ACTION": continue
-                if nick_re.search(m.line) is None: continue
+            for m in items:
                 if not headerPrinted:
                     ActionItemsPerson.append("* %s"%text(nick))
                     headerPrinted = True
                 ActionItemsPerson.append(wrapList("* %s"%text(m.line), 2))
                 numberAssigned += 1
-                m.assigned = True
         # unassigned items:
         Unassigned = [ ]
         Unassigned.append("* **UNASSIGNED**")
         numberUnassigned = 0
-        for m in M.minutes:
-            if m.itemtype != "ACTION": continue
-            if getattr(m, 'assigned', False): continue
+        for m in self.iterActionItemsUnassigned():
             Unassigned.append(wrapList("* %s"%text(m.line), 2))
             numberUnassigned += 1
         if numberUnassigned == 0:
@@ -1016,7 +1279,7 @@ class MediaWiki(_BaseWriter):
         MeetingItems = [ ]
         MeetingItems.append(self.heading('Meeting summary'))
         haveTopic = None
-        for m in M.minutes:
+        for m in self.model.items:
             item = "* "+m.mw(M)
             if m.itemtype == "TOPIC":
                 if haveTopic:
@@ -1034,9 +1297,7 @@ class MediaWiki(_BaseWriter):
         ActionItems = [ ]
         numActionItems = 0
         ActionItems.append(self.heading('Action items'))
-        for m in M.minutes:
-            # The hack below is needed because of pickling problems
-            if m.itemtype != "ACTION": continue
+        for m in self.model.actions:
             #already escaped
             ActionItems.append("* %s"%mw(m.line))
             numActionItems += 1
@@ -1047,30 +1308,23 @@ class MediaWiki(_BaseWriter):
 
     def actionItemsPerson(self):
         M = self.M
-        # Action Items, by person (This could be made lots more efficient)
+        # Action Items, by person
         ActionItemsPerson = [ ]
         ActionItemsPerson.append(self.heading('Action items, by person'))
         numberAssigned = 0
-        for nick in sorted(list(M.attendees.keys()), key=lambda x: x.lower()):
-            nick_re = makeNickRE(nick)
+        for nick, items in self.iterActionItemsNick():
             headerPrinted = False
-            for m in M.minutes:
-                # The hack below is needed because of pickling problems
-                if m.itemtype != "ACTION": continue
-                if nick_re.search(m.line) is None: continue
+            for m in items:
                 if not headerPrinted:
                     ActionItemsPerson.append("* %s"%mw(nick))
                     headerPrinted = True
                 ActionItemsPerson.append("** %s"%mw(m.line))
                 numberAssigned += 1
-                m.assigned = True
         # unassigned items:
         Unassigned = [ ]
         Unassigned.append("* **UNASSIGNED**")
         numberUnassigned = 0
-        for m in M.minutes:
-            if m.itemtype != "ACTION": continue
-            if getattr(m, 'assigned', False): continue
+        for m in self.iterActionItemsUnassigned():
             Unassigned.append("** %s"%mw(m.line))
             numberUnassigned += 1
         if numberUnassigned == 0:
@@ -1131,23 +1385,22 @@ class MediaWiki(_BaseWriter):
         body = replaceWRAP(body)
 
 
-        # Do we want to upload?
+        # Do we want to upload?  This only queues the page, the
+        # upload happens in the background (see publish.WikiPublisher).
         if 'mwpath' in kwargs:
-            import mwclient
             mwsite = kwargs['mwsite']
             mwpath = kwargs['mwpath']
             mwusername = kwargs.get('mwusername', None)
             mwpassword = kwargs.get('mwpassword', '')
-            subpagename = os.path.basename(self.M.config.filename())
+            subpagename = self.M.config.basename
             mwfullname = "%s/%s" % (mwpath, subpagename)
-            force_login = (mwusername != None)
-
-            site = mwclient.Site(mwsite, force_login=force_login)
-            if(force_login):
-                site.login(mwusername, mwpassword)
-            page = site.Pages[mwfullname]
-            some = page.edit()
-            page.save(body, summary="Meeting")
+
+            publisher = getattr(self.M.config, 'wikiPublisher', None)
+            if publisher is None:
+                publisher = publish.publisher()
+            publisher.publish(mwsite, mwfullname, body,
+                              username=mwusername, password=mwpassword,
+                              summary="Meeting")
 
         return body
 
@@ -0,0 +1,60 @@
+"""Micro-benchmark: lines per second through Meeting.add_line.
+
+Run from the top of the source tree:
+    python tests/bench_add_line.py [number of lines]
+
+The mix is mostly chat, with some URLs and commands, roughly what a
+busy meeting looks like.  Saving is disabled, so this measures the
+per-line bookkeeping and command dispatch only.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from MeetBot2 import meeting
+
+
+class BenchMeeting(meeting.Meeting):
+    # Only the detection of links is measured, not the items.
+    def do_link(self, **kwargs):
+        self.links += 1
+
+
+def make_lines(n):
+    lines = [ ]
+    for i in range(n):
+        nick = 'nick%d'%(i % 17)
+        if i % 40 == 0:
+            lines.append((nick, '#nick someone%d'%(i % 7)))
+        elif i % 40 == 20:
+            lines.append((nick, 'https://example.org/%d some link'%i))
+        elif i % 40 == 30:
+            lines.append((nick, '#notacommand %d'%i))
+        else:
+            lines.append((nick, 'just chatting about item %d, '
+                                'see the thread from yesterday'%i))
+    return lines
+
+
+def main(n=100000):
+    lines = make_lines(n)
+    M = BenchMeeting(channel='#bench', owner='nick0',
+                     extraConfig={'dontSave': True,
+                                  'writer_map': { }})
+    M.links = 0
+    now = time.localtime()
+    start = time.time()
+    for nick, line in lines:
+        M.add_line(nick, line, time_=now)
+    elapsed = time.time() - start
+    print("%d lines in %.3fs: %.0f lines/s (%d links)"%(
+        n, elapsed, n/elapsed, M.links))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
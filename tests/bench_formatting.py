@@ -0,0 +1,114 @@
+"""Micro-benchmark: MeetBot2.formatting against the old helpers.
+
+Run from the top of the source tree:
+    python tests/bench_formatting.py [number of passes]
+
+The corpus looks like the minutes of a busy meeting: action items
+naming people, topics, links and the odd snake_case identifier.  For
+each helper the old implementation (as it was in writers.py) and the
+new one are timed on the same input, and their output is checked to
+be the same.
+"""
+
+import os
+import re
+import sys
+import textwrap
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from MeetBot2 import formatting
+
+
+# The helpers as they were before MeetBot2.formatting.
+def old_html(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def old_rst(text):
+    matches = re.compile('_( |-|$)')
+    return matches.sub(r'\_\1', text)
+
+class OldTextWrapper(textwrap.TextWrapper):
+    wordsep_re = re.compile(r'(\s+)')
+
+def old_wrapList(item, indent=0):
+    return OldTextWrapper(width=72, initial_indent=' '*indent,
+                          subsequent_indent= ' '*(indent+2),
+                          break_long_words=False).fill(item)
+
+def old_replaceWRAP(item):
+    re_wrap = re.compile(r'sWRAPs(.*)eWRAPe', re.DOTALL)
+    def repl(m):
+        return OldTextWrapper(width=72, break_long_words=False).fill(m.group(1))
+    return re_wrap.sub(repl, item)
+
+def old_makeNickRE(nick):
+    return re.compile('\\b'+re.escape(nick)+'\\b', re.IGNORECASE)
+
+# The translate-table variant, for comparison with formatting.html.
+html_table = str.maketrans({'&':'&amp;', '<':'&lt;', '>':'&gt;'})
+def translate_html(text):
+    return text.translate(html_table)
+
+
+def make_corpus(n=400):
+    nicks = [ 'nick%d'%i for i in range(30) ] + [ 'T-Rex', 'bob_', 'Ann' ]
+    lines = [ ]
+    for i in range(n):
+        nick = nicks[i % len(nicks)]
+        if i % 5 == 0:
+            lines.append('%s to review the patch for config_file handling '
+                         'before the next release & report back'%nick)
+        elif i % 5 == 1:
+            lines.append('https://example.org/bugs/%d <- see comment %d'
+                         %(i, i % 9))
+        elif i % 5 == 2:
+            lines.append('Discussion of the <new> build farm, item %d'%i)
+        elif i % 5 == 3:
+            lines.append('AGREED: %s and %s will update the wiki page '
+                         'with the schedule, the list of blockers and '
+                         'the owners of each of them'%(nick, nicks[i % 7]))
+        else:
+            lines.append('plain text without anything special in it')
+    return nicks, lines
+
+
+def bench(name, old, new, inputs, passes):
+    for x in inputs:
+        assert old(*x) == new(*x), (name, x)
+    times = [ ]
+    for f in (old, new):
+        start = time.time()
+        for i in range(passes):
+            for x in inputs:
+                f(*x)
+        times.append(time.time() - start)
+    print("%-12s old %.3fs  new %.3fs  (%.1fx)"%(
+        name, times[0], times[1], times[0]/max(times[1], 1e-9)))
+
+
+def main(passes=50):
+    nicks, lines = make_corpus()
+    one = [ (line,) for line in lines ]
+    bench('html', old_html, formatting.html, one, passes)
+    bench('html/table', old_html, translate_html, one, passes)
+    bench('rst', old_rst, formatting.rst, one, passes)
+    bench('wrapList', old_wrapList, formatting.wrapList,
+          [ ("* "+line, i % 3) for i, line in enumerate(lines) ], passes)
+    body = "\n".join([ "sWRAPs%seWRAPe"%line for line in lines[:40] ])
+    bench('replaceWRAP', old_replaceWRAP, formatting.replaceWRAP,
+          [ (body,) ], passes)
+    # Compiled patterns can't be compared, so compare what they find.
+    def findall(makeNickRE):
+        def f(line):
+            return [ n for n in nicks if makeNickRE(n).search(line) ]
+        return f
+    bench('makeNickRE', findall(old_makeNickRE),
+          findall(formatting.makeNickRE), one, passes // 10 or 1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+# run_test.py is the old Python 2 test suite, run by hand.
+collect_ignore = ['run_test.py']
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTDIR, '..'))
+
+# Importing supybot (through MeetBot2) creates its conf/, data/,
+# logs/ ... directories, relative to the current directory when they
+# are first used.  Keep them out of the source tree.
+_supybotDir = tempfile.mkdtemp(prefix='meetbot-tests-')
+_cwd = os.getcwd()
+os.chdir(_supybotDir)
+try:
+    from supybot import conf
+    for _name in ('backup', 'conf', 'data', 'log'):
+        conf.supybot.directories.get(_name).setValue(
+            os.path.join(_supybotDir, _name))
+    conf.supybot.directories.data.tmp.setValue(
+        os.path.join(_supybotDir, 'data', 'tmp'))
+finally:
+    os.chdir(_cwd)
@@ -0,0 +1,28 @@
+"""Tests of rebuilding the archive, see MeetBot2.archive."""
+
+import os
+import shutil
+
+from MeetBot2 import archive
+from MeetBot2 import writers
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_rebuild_keeps_log(tmp_path):
+    """A .log.txt output is the log: it is never rebuilt."""
+    logdir = os.path.join(str(tmp_path), 'test', '2008')
+    os.makedirs(logdir)
+    path = os.path.join(logdir, 'test.2008-09-20-10.10.log.txt')
+    shutil.copy(os.path.join(TESTDIR, 'test-script-1.log.txt'), path)
+    log = open(path, 'rb').read()
+    extraConfig = {'logFileDir': str(tmp_path), 'catalogFile': None,
+                   'writer_map': {'.log.txt': writers.TextLog,
+                                  '.txt': writers.Text}}
+    stats = archive.rebuild(extraConfig, jobs=1)
+    assert (stats['rebuilt'], stats['outputs'], stats['failed']) == (1, 1, 0)
+    assert open(path, 'rb').read() == log
+    assert os.access(path[:-len('.log.txt')] + '.txt', os.F_OK)
+    # Nothing changed, so nothing is rebuilt.
+    stats = archive.rebuild(extraConfig, jobs=1)
+    assert (stats['rebuilt'], stats['outputs']) == (0, 0)
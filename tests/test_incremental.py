@@ -0,0 +1,107 @@
+"""Tests of realtime saves appending to the logs, see Config.save.
+
+After lines were added over several realtime saves, each log must be
+byte for byte what a full save writes: when the new lines are spliced
+in before the footer, when history changed and the file is written
+again, and after an append failed.
+"""
+
+import pytest
+
+from MeetBot2 import meeting
+from MeetBot2 import writers
+
+WRITERS = {'.log.txt': writers.TextLog,
+           '.log.html': writers.HTMLlog2,
+           '.log.1.html': writers.HTMLlog1}
+
+LINES = [ ('chair', '#startmeeting incremental'),
+          ('alice', 'hello <everyone> & all'),
+          ('bob', 'alice: hi'),
+          ('chair', '#topic first things'),
+          ('alice', 'ACTION waves'),
+          ('bob', 'caf\xe9 ☃'),
+          ('chair', '#info something to know'),
+          ('alice', 'http://example.com/'),
+          ]
+
+
+def newMeeting(tmp_path):
+    M = meeting.Meeting(channel='#incremental', owner='chair',
+                        filename=str(tmp_path / 'incremental'),
+                        extraConfig={'writer_map': WRITERS,
+                                     'catalogFile': None,
+                                     'cssFile_log': 'none',
+                                     'update_realtime': False},
+                        sendReply=lambda x: None, setTopic=lambda x: None)
+    M.appends = 0
+    appendToFile = M.config.appendToFile
+    def countingAppend(*args, **kwargs):
+        appended = appendToFile(*args, **kwargs)
+        M.appends += appended
+        return appended
+    M.config.appendToFile = countingAppend
+    return M
+
+def contents(M):
+    files = { }
+    for extension in WRITERS:
+        with open(M.config.filename() + extension, 'rb') as f:
+            files[extension] = f.read()
+    return files
+
+def assertFullSave(M):
+    """The files are what a full save writes."""
+    realtime = contents(M)
+    M.config.save()
+    assert realtime == contents(M)
+
+def addLines(M, batch):
+    for nick, line in batch:
+        M.add_line(nick, line)
+    M.config.save(realtime_update=True)
+
+
+def test_appends(tmp_path):
+    M = newMeeting(tmp_path)
+    for i in range(0, len(LINES), 3):
+        addLines(M, LINES[i:i+3])
+    # The first save wrote the files, the others appended to them.
+    assert M.appends == len(WRITERS) * 2
+    assert contents(M)['.log.html'].endswith(
+        writers.HTMLlog2.footer.encode('utf-8'))
+    assertFullSave(M)
+    # Nothing new.
+    M.config.save(realtime_update=True)
+    assertFullSave(M)
+
+
+def test_rewrites(tmp_path):
+    M = newMeeting(tmp_path)
+    addLines(M, LINES[:5])
+    addLines(M, LINES[5:])
+    appends = M.appends
+    M.lines.truncate(4)
+    addLines(M, [ ('bob', 'after the rewrite') ])
+    assert M.appends == appends
+    assertFullSave(M)
+    addLines(M, [ ('bob', 'and more') ])
+    assert M.appends == appends + len(WRITERS)
+    assertFullSave(M)
+
+
+def test_failed_append(tmp_path):
+    M = newMeeting(tmp_path)
+    addLines(M, LINES[:4])
+    appendToFile = M.config.appendToFile
+    def brokenAppend(string, filename, footer='', final=False):
+        # Half of it makes it to the disk.
+        with open(filename, 'ab') as f:
+            f.write(string[:len(string)//2].encode('utf-8'))
+        raise IOError("disk full")
+    M.config.appendToFile = brokenAppend
+    with pytest.raises(IOError):
+        addLines(M, LINES[4:6])
+    M.config.appendToFile = appendToFile
+    addLines(M, LINES[6:])
+    assertFullSave(M)
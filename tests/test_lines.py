@@ -0,0 +1,49 @@
+"""Tests of the meeting log storage, see lines.LineStore."""
+
+import time
+
+import pytest
+
+from MeetBot2 import lines
+
+
+def newStore():
+    store = lines.LineStore()
+    when = time.mktime((2020, 1, 2, 10, 11, 12, 0, 0, -1))
+    store.append('alice', 'hello', when)
+    store.append('bob', 'waves', when + 1, kind=lines.ACTION)
+    store.append('alice', 'bye', when + 2)
+    return store
+
+
+def test_lines():
+    store = newStore()
+    assert len(store) == 3
+    assert list(store) == [ '10:11:12 <alice> hello',
+                            '10:11:13 * bob waves',
+                            '10:11:14 <alice> bye' ]
+    assert store[-1] == '10:11:14 <alice> bye'
+    assert store[1:] == list(store)[1:]
+    row = store.row(1)
+    assert (row.linenum, row.nick, row.text, row.kind, row.timestr()) == \
+           (2, 'bob', 'waves', lines.ACTION, '10:11:13')
+    assert [ row.nick for row in store.rows(1) ] == [ 'bob', 'alice' ]
+    with pytest.raises(IndexError):
+        store.row(3)
+    with pytest.raises(IndexError):
+        store[-4]
+
+
+def test_truncate():
+    store = newStore()
+    store.truncate(3)
+    assert len(store) == 3
+    assert store.rewrites == 0
+    store.truncate(1)
+    assert list(store) == [ '10:11:12 <alice> hello' ]
+    assert store.rewrites == 1
+    # The columns are still in step.
+    store.append('bob', 'back', time.mktime((2020, 1, 2, 10, 12, 0, 0, 0, -1)))
+    assert list(store) == [ '10:11:12 <alice> hello',
+                            '10:12:00 <bob> back' ]
+    assert store.row(1).kind == lines.MESSAGE
@@ -0,0 +1,74 @@
+"""Tests of rendering writers in another process, see Config.offload.
+
+A render done in time is written by the pool.  One which hangs has
+its worker killed and is rendered in-process instead, so the file is
+still written.
+"""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from MeetBot2 import meeting
+from MeetBot2 import scheduler
+from MeetBot2 import writers
+
+
+class PidWriter(writers._BaseWriter):
+    """Says which process rendered it; hangs in the pool if asked to."""
+    offload = True
+    hang = False
+
+    def snapshot(self, extension=None):
+        return self.hang
+
+    @staticmethod
+    def render(hang):
+        if hang and multiprocessing.parent_process() is not None:
+            time.sleep(60)
+        return str(os.getpid())
+
+class HangingWriter(PidWriter):
+    hang = True
+
+
+@pytest.fixture
+def pool(tmp_path):
+    # The workers import this module (and supybot, through MeetBot2)
+    # to unpickle the render, keep what supybot creates out of the
+    # source tree.
+    pool = scheduler.RenderPool(
+        max_workers=1, mp_context=multiprocessing.get_context('forkserver'),
+        initializer=os.chdir, initargs=(str(tmp_path),))
+    yield pool
+    pool.shutdown()
+
+
+def render(tmp_path, pool, writer):
+    M = meeting.Meeting(channel='#offload', owner='x',
+                        filename=str(tmp_path / 'offload'),
+                        extraConfig={'writer_map': {'.pid': writer},
+                                     'offloadTimeout': 2,
+                                     'catalogFile': None},
+                        renderPool=pool)
+    M.config.save()
+    path = str(tmp_path / 'offload.pid')
+    end = time.time() + 30
+    while not os.access(path, os.F_OK) and time.time() < end:
+        time.sleep(0.05)
+    with open(path) as f:
+        return int(f.read())
+
+
+def test_render_in_pool(tmp_path, pool):
+    assert render(tmp_path, pool, PidWriter) != os.getpid()
+    assert pool.recycled == 0
+
+
+def test_hung_render(tmp_path, pool):
+    assert render(tmp_path, pool, HangingWriter) == os.getpid()
+    assert pool.recycled == 1
+    # The pool works again.
+    assert pool.submit(PidWriter.render, False).result(30) != str(os.getpid())
@@ -0,0 +1,369 @@
+"""Concurrency stress test of the plugin's message handling.
+
+Many threads say lines in many meetings at once through doPrivmsg,
+the way supybot calls the threaded plugin, while the meetings are
+ended: some by #endmeeting in the channel, the others by several
+threads running the endmeeting command path (_post_end) at the same
+time, racing with an #endmeeting.  Afterwards:
+
+ - every meeting was ended, and saved for the last time, exactly once
+ - each nick's lines are in its meeting once and in the order said,
+   with none missing before the meeting ended (they are a prefix of
+   what was said)
+ - no journal is left behind
+
+Ending a meeting also works when its inbox is full, and a meeting
+recovered from its journal keeps its start time and chairs, also
+before the bot joined the channel.  A journal which can't be replayed
+doesn't stop the plugin from loading.  Unloading the plugin stops its
+threads and pools, and reloading it recovers the meetings.  Recovering
+from a snapshot brings back the minutes, votes and chairs, and a
+half-written last line of the journal is ignored, also by the next
+recovery.
+"""
+
+import collections
+import importlib
+import os
+import random
+import threading
+import time
+
+import pytest
+from supybot import irclib
+from supybot import ircmsgs
+
+from MeetBot2 import journal
+from MeetBot2 import meeting
+from MeetBot2 import plugin
+
+NETWORK = 'stress'
+MEETINGS = 8
+THREADS = 8
+LINES = 300
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.users = set()
+        self.topic = ''
+
+class FakeState(object):
+    def __init__(self):
+        self.channels = collections.defaultdict(FakeChannel)
+
+class FakeMsg(object):
+    tags = {'receivedOn': NETWORK}
+
+class FakeIrc(object):
+    """The bot's IRC connection, recording what is sent."""
+    network = NETWORK
+    nick = 'meetbot'
+    def __init__(self, state=None):
+        self.msg = FakeMsg()
+        self.state = state if state is not None else FakeState()
+        self.sent = [ ]
+        self._lock = threading.Lock()
+    def sendMsg(self, msg):
+        with self._lock:
+            self.sent.append(msg)
+
+
+def startMeeting(bot, irc, channel):
+    return plugin.meeting_cache.start(
+        (channel, NETWORK), lambda: bot._start_journal(
+            bot._new_meeting(irc, channel, NETWORK, 'chair', None)))
+
+
+@pytest.fixture
+def config(monkeypatch, tmp_path):
+    """Keep what meetings write in tmp_path."""
+    monkeypatch.setattr(meeting.Config, 'logFileDir', str(tmp_path))
+    monkeypatch.setattr(meeting.Config, 'writer_map', { })
+    monkeypatch.setattr(meeting.Config, 'catalogFile', None)
+    return meeting.Config
+
+
+def test_lines_and_ends(monkeypatch, config):
+    finalSaves = collections.Counter()
+    savesLock = threading.Lock()
+    save = meeting.Config.save
+    def countingSave(self, realtime_update=False):
+        if not realtime_update:
+            with savesLock:
+                finalSaves[self.M.channel] += 1
+        return save(self, realtime_update=realtime_update)
+    monkeypatch.setattr(meeting.Config, 'save', countingSave)
+
+    irc = FakeIrc()
+    bot = plugin.MeetBot2(irc)
+    channels = [ '#stress%d'%i for i in range(MEETINGS) ]
+    meetings = { }
+    for channel in channels:
+        M = startMeeting(bot, irc, channel)
+        assert M is not None
+        meetings[channel] = M
+
+    def say(channel, nick, text):
+        bot.doPrivmsg(irc, ircmsgs.privmsg(channel, text,
+                                           prefix='%s!u@h'%nick))
+
+    # (channel, nick) -> lines said, in order
+    sent = collections.defaultdict(list)
+    # (channel, nick) -> number of lines said before any end
+    beforeEnd = collections.Counter()
+    # channel -> results of _post_end
+    commandEnds = collections.defaultdict(list)
+    halfway = threading.Barrier(THREADS + 1)
+    def talk(n):
+        rand = random.Random(n)
+        nick = 'nick%d'%n
+        for i in range(LINES):
+            if i == LINES//2:
+                for channel in channels:
+                    beforeEnd[(channel, nick)] = len(sent[(channel, nick)])
+                halfway.wait()
+            channel = rand.choice(channels)
+            text = 'line %d'%i
+            sent[(channel, nick)].append(text)
+            say(channel, nick, text)
+    def endByCommand(channel):
+        key = (channel, NETWORK)
+        commandEnds[channel].append(
+            bot._post_end(meetings[channel], key, True))
+    threads = [ threading.Thread(target=talk, args=(n,))
+                for n in range(THREADS) ]
+    for t in threads: t.start()
+    halfway.wait()
+    enders = [ ]
+    for i, channel in enumerate(channels):
+        if i % 2 == 0:
+            say(channel, 'chair', '#endmeeting')
+        else:
+            for j in range(3):
+                enders.append(threading.Thread(target=endByCommand,
+                                               args=(channel,)))
+            enders.append(threading.Thread(
+                target=say, args=(channel, 'chair', '#endmeeting')))
+    for t in enders: t.start()
+    for t in threads + enders: t.join()
+    for M in meetings.values():
+        if M.actor._thread is not None:
+            M.actor._thread.join(30)
+            assert not M.actor._thread.is_alive()
+
+    for channel, M in meetings.items():
+        assert (channel, NETWORK) not in plugin.meeting_cache
+        assert M.meeting_is_over or M.endtime is not None
+        endReplies = [ msg for msg in irc.sent
+                       if msg.args[0] == channel and
+                          msg.args[1].startswith('Meeting ended') ]
+        ends = len(endReplies) + commandEnds[channel].count(True)
+        assert ends == 1, "%s ended %d times"%(channel, ends)
+        assert finalSaves[channel] == 1, \
+               "%s saved %d times"%(channel, finalSaves[channel])
+        said = collections.defaultdict(list)
+        for row in M.lines.rows():
+            if row.nick.startswith('nick'):
+                said[row.nick].append(row.text)
+        for n in range(THREADS):
+            nick = 'nick%d'%n
+            lines = said[nick]
+            expected = sent[(channel, nick)]
+            assert lines == expected[:len(lines)], \
+                   "lines of %s in %s lost, duplicated or reordered"%(
+                       nick, channel)
+            assert len(lines) >= beforeEnd[(channel, nick)], \
+                   "lines of %s in %s lost before the end"%(nick, channel)
+    assert os.listdir(plugin.journal_dir()) == [ ]
+
+
+def test_end_with_full_inbox(monkeypatch, config):
+    monkeypatch.setattr(config, 'inboxSize', 1)
+    monkeypatch.setattr(config, 'inboxOverflow', 'drop')
+    irc = FakeIrc()
+    bot = plugin.MeetBot2(irc)
+    M = startMeeting(bot, irc, '#full')
+    # Hold up the actor, and fill its inbox.
+    busy = threading.Event()
+    carryOn = threading.Event()
+    def hold():
+        busy.set()
+        carryOn.wait(10)
+    M.actor.post(hold)
+    assert busy.wait(10)
+    assert M.actor.post(lambda: None) is not None
+    assert M.actor.post(lambda: None) is None
+    ended = [ ]
+    ender = threading.Thread(target=lambda: ended.append(
+        bot._post_end(M, ('#full', NETWORK), True)))
+    ender.start()
+    while M.actor.depth() < 2 and ender.is_alive():
+        time.sleep(0.01)
+    carryOn.set()
+    ender.join(10)
+    assert ended == [ True ]
+    assert ('#full', NETWORK) not in plugin.meeting_cache
+
+
+def test_recover_start_time(config):
+    irc = FakeIrc()
+    bot = plugin.MeetBot2(irc)
+    key = ('#recover', NETWORK)
+    def new():
+        M = bot._new_meeting(irc, '#recover', NETWORK, 'chair', None)
+        M.start_time = time.localtime(time.time() - 3600)
+        M.expected_end = time.mktime(M.start_time) + M.length*60
+        return bot._start_journal(M)
+    M = plugin.meeting_cache.start(key, new)
+    # The bot stops before anything is snapshotted.
+    M.actor.stop()
+    assert plugin.meeting_cache.end(key, M)
+    bot = plugin.MeetBot2(irc)
+    recovered = plugin.meeting_cache.get(key)
+    assert recovered is not None and recovered is not M
+    assert recovered.start_time == M.start_time
+    assert recovered.expected_end == M.expected_end
+    assert bot._post_end(recovered, key, False)
+
+
+def stopBot(key):
+    """Drop the meeting as if the bot stopped, keeping its journal."""
+    M = plugin.meeting_cache.get(key)
+    M.actor.stop()
+    M.actor.join(10)
+    assert plugin.meeting_cache.end(key, M)
+    return M
+
+
+def test_recover_chair_before_join(config):
+    irc = FakeIrc()
+    bot = plugin.MeetBot2(irc)
+    key = ('#chairs', NETWORK)
+    startMeeting(bot, irc, '#chairs')
+    bot.doPrivmsg(irc, ircmsgs.privmsg('#chairs', '#chair bob',
+                                       prefix='chair!u@h'))
+    stopBot(key)
+    # On startup, the bot isn't in any channel yet.
+    irc = FakeIrc(state=irclib.IrcState())
+    bot = plugin.MeetBot2(irc)
+    recovered = plugin.meeting_cache.get(key)
+    assert recovered is not None
+    assert 'bob' in recovered.chairs
+    assert recovered._channelNicks is not None
+    assert bot._post_end(recovered, key, False)
+
+
+def meetingState(M):
+    """What journalState() saves of M, in a form which can be compared."""
+    return {'lines': list(M.lines),
+            'minutes': [ (type(item).__name__,
+                          dict([ (name, value)
+                                 for name, value in vars(item).items()
+                                 if not name.startswith('_') ]))
+                         for item in M.minutes ],
+            'attendees': M.attendees,
+            'chairs': M.chairs,
+            'current_topic': M.current_topic,
+            'vote_topic': M.vote_topic,
+            'voteOptions': M._voteOptions,
+            'votes': M._votes,
+            'voters': M._voters,
+            }
+
+
+def test_recover_snapshot(monkeypatch, config):
+    monkeypatch.setattr(config, 'journalSnapshotEvery', 5)
+    irc = FakeIrc()
+    bot = plugin.MeetBot2(irc)
+    key = ('#snapshot', NETWORK)
+    M = startMeeting(bot, irc, '#snapshot')
+    def say(nick, text):
+        bot.doPrivmsg(irc, ircmsgs.privmsg('#snapshot', text,
+                                           prefix='%s!u@h'%nick))
+        assert M.actor.post(lambda: None).result(10) is None
+    say('chair', '#chair bob')
+    say('chair', '#topic first topic')
+    say('bob', '#info something to know')
+    say('bob', '#startvote Lunch? pizza, sushi')
+    say('alice', '#vote pizza')
+    # Snapshotted here.
+    say('bob', '#vote sushi')
+    say('alice', '#action alice orders')
+    expected = meetingState(M)
+    assert 'bob' in expected['chairs']
+    assert [ name for name, fields in expected['minutes'] ] == \
+           [ 'Topic', 'Info', 'Action' ]
+    assert expected['votes'] == {'pizza': {'alice'}, 'sushi': {'bob'}}
+    stopBot(key)
+    path = M.journal.path
+    with open(path, 'ab') as f:
+        f.write(b'["l",')
+    header, state, events = journal.Journal(path).load()
+    assert state is not None
+    assert [ event[3] for event in events ] == [ '#vote sushi',
+                                                 '#action alice orders' ]
+
+    bot = plugin.MeetBot2(FakeIrc(state=irclib.IrcState()))
+    recovered = plugin.meeting_cache.get(key)
+    assert recovered is not None
+    assert meetingState(recovered) == expected
+    M = recovered
+    say('chair', 'after the recovery')
+    expected = meetingState(M)
+    stopBot(key)
+    bot = plugin.MeetBot2(FakeIrc(state=irclib.IrcState()))
+    recovered = plugin.meeting_cache.get(key)
+    assert recovered is not None
+    assert meetingState(recovered) == expected
+    assert bot._post_end(recovered, key, False)
+
+
+def test_recover_failure(monkeypatch, config):
+    irc = FakeIrc()
+    bot = plugin.MeetBot2(irc)
+    keys = [ ('#broken', NETWORK), ('#fine', NETWORK) ]
+    for channel, network in keys:
+        startMeeting(bot, irc, channel)
+        bot.doPrivmsg(irc, ircmsgs.privmsg(channel, 'hello',
+                                           prefix='chair!u@h'))
+        stopBot((channel, network))
+    replay = journal.replay
+    def brokenReplay(M, state, events):
+        if M.channel == '#broken':
+            raise ValueError("corrupt journal")
+        return replay(M, state, events)
+    monkeypatch.setattr(journal, 'replay', brokenReplay)
+    bot = plugin.MeetBot2(FakeIrc(state=irclib.IrcState()))
+    assert keys[0] not in plugin.meeting_cache
+    recovered = plugin.meeting_cache.get(keys[1])
+    assert recovered is not None
+    assert bot._post_end(recovered, keys[1], False)
+
+
+def test_reload(config):
+    irc = FakeIrc()
+    bot = plugin.MeetBot2(irc)
+    key = ('#reload', NETWORK)
+    M = startMeeting(bot, irc, '#reload')
+    bot.doPrivmsg(irc, ircmsgs.privmsg('#reload', 'hello',
+                                       prefix='chair!u@h'))
+    writerPool, renderPool = plugin.writer_pool, plugin.render_pool
+    bot.die()
+    assert key not in plugin.meeting_cache
+    assert not M.actor._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        writerPool.submit(key, lambda: None)
+    with pytest.raises(RuntimeError):
+        renderPool.submit(len, '')
+    importlib.reload(plugin)
+    assert plugin.writer_pool is not writerPool
+    assert plugin.render_pool is not renderPool
+    bot = plugin.MeetBot2(irc)
+    recovered = plugin.meeting_cache.get(key)
+    assert recovered is not None
+    assert [ row.text for row in recovered.lines.rows() ] == \
+           [ row.text for row in M.lines.rows() ]
+    assert 'hello' in [ row.text for row in recovered.lines.rows() ]
+    assert recovered.savePool is plugin.writer_pool
+    assert bot._post_end(recovered, key, False)
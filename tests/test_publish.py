@@ -0,0 +1,86 @@
+"""Tests of publishing MediaWiki minutes, see MeetBot2.publish."""
+
+import unittest
+
+from MeetBot2 import meeting
+from MeetBot2 import publish
+from MeetBot2 import writers
+
+trivial_contents = """
+10:10:10 <x> #startmeeting
+10:10:10 <x> blah
+10:10:10 <x> #endmeeting
+"""
+
+
+class FakePage(object):
+    def __init__(self, wiki, name):
+        self.wiki, self.name = wiki, name
+    def text(self):
+        return self.wiki.pages.get(self.name, '')
+    def save(self, text, summary=None):
+        self.wiki.saves += 1
+        if self.wiki.failures:
+            self.wiki.failures -= 1
+            raise IOError("wiki is down")
+        self.wiki.pages[self.name] = text
+
+class FakePages(object):
+    def __init__(self, wiki):
+        self.wiki = wiki
+    def __getitem__(self, name):
+        return FakePage(self.wiki, name)
+
+class FakeSite(object):
+    def __init__(self, wiki):
+        self.pages = FakePages(wiki)
+
+class FakeWiki(object):
+    """What siteFactory logs in to, instead of a real wiki."""
+    def __init__(self):
+        self.pages = { }
+        self.saves = 0
+        self.failures = 0
+        self.logins = 0
+    def site(self, host, username, password):
+        self.logins += 1
+        return FakeSite(self)
+
+
+class PublishTest(unittest.TestCase):
+
+    def test_mediawiki_publish(self):
+        """MediaWiki minutes are uploaded in the background."""
+        wiki = FakeWiki()
+        publisher = publish.WikiPublisher(siteFactory=wiki.site, backoff=0)
+        extraConfig = {'writer_map':
+                         {'.mw|mwsite=wiki.example|mwpath=Meetings':
+                          writers.MediaWiki},
+                       'wikiPublisher': publisher}
+        M = meeting.process_meeting(contents=trivial_contents,
+                                    channel="#none", filename='/dev/null',
+                                    dontSave=True, safeMode=False,
+                                    extraConfig=extraConfig, quiet=True)
+        # #endmeeting saved the minutes, wait for their upload.
+        assert publisher.wait(10), "upload did not finish"
+        body = M.save()['.mw']
+        assert publisher.wait(10), "upload did not finish"
+        pagename = 'Meetings/' + M.config.basename
+        self.assertEqual(wiki.pages[pagename], body)
+        self.assertEqual(wiki.saves, 1)
+        # Saving the same minutes again doesn't upload anything.
+        skipped = publisher.stats()['skipped']
+        M.save()
+        assert publisher.wait(10), "upload did not finish"
+        self.assertEqual(wiki.saves, 1)
+        self.assertEqual(publisher.stats()['skipped'], skipped + 1)
+        # Failed uploads are retried, on a new session.
+        wiki.failures = 1
+        M.add_line('nobody', '#info more minutes')
+        body = M.save()['.mw']
+        self.assertIn('more minutes', body)
+        assert publisher.wait(10), "upload did not finish"
+        self.assertEqual(wiki.pages[pagename], body)
+        self.assertEqual(wiki.saves, 3)
+        self.assertEqual(wiki.logins, 2)
+        self.assertEqual(publisher.stats()['uploads'], 2)
@@ -0,0 +1,55 @@
+"""Tests of replaying saved logs, see MeetBot2.meeting.replay_log."""
+
+import os
+import shutil
+
+from MeetBot2 import catalog
+from MeetBot2 import meeting
+from MeetBot2 import writers
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def copyLog(tmp_path):
+    path = os.path.join(str(tmp_path), 'test-script-1.log.txt')
+    shutil.copy(os.path.join(TESTDIR, 'test-script-1.log.txt'), path)
+    return path
+
+
+def test_replay_default_config(monkeypatch, tmp_path):
+    """The default writers work without their stylesheets."""
+    monkeypatch.chdir(tmp_path)
+    path = copyLog(tmp_path)
+    meeting.main(['replay', '-j', '1', path])
+    for extension in ('.html', '.log.html', '.txt'):
+        assert os.access(path[:-len('.log.txt')] + extension, os.F_OK)
+
+
+def test_replay_keeps_log(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    path = copyLog(tmp_path)
+    log = open(path, 'rb').read()
+    M = meeting.replay_log(path, extraConfig={'writer_map': {
+        '.log.txt': writers.TextLog, '.txt': writers.Text}})
+    assert list(M.config.writer_map) == [ '.txt' ]
+    assert open(path, 'rb').read() == log
+
+
+def test_replay_catalog(monkeypatch, tmp_path):
+    """Replayed meetings are recorded under the network in their path,
+    or not at all."""
+    monkeypatch.chdir(tmp_path)
+    logdir = os.path.join(str(tmp_path), 'libera', 'test')
+    os.makedirs(logdir)
+    path = os.path.join(logdir, 'test.2008-09-20-10.10.log.txt')
+    shutil.copy(os.path.join(TESTDIR, 'test-script-1.log.txt'), path)
+    extraConfig = {'logFileDir': str(tmp_path), 'writer_map': { }}
+    meeting.replay_log(path, extraConfig=extraConfig)
+    dbpath = os.path.join(str(tmp_path), meeting.Config.catalogFile)
+    assert not os.access(dbpath, os.F_OK)
+    extraConfig['filenamePattern'] = \
+        '%(network)s/%(channel)s/%(channel)s.%%F-%%H.%%M'
+    for i in range(2):
+        meeting.replay_log(path, extraConfig=extraConfig)
+    rows = catalog.catalog(dbpath).recent('#test', 'libera')
+    assert len(rows) == 1
@@ -0,0 +1,96 @@
+"""Tests of coalescing realtime saves, see scheduler.SaveScheduler."""
+
+from MeetBot2 import journal
+from MeetBot2 import meeting
+
+
+def newMeeting(tmp_path, **config):
+    extraConfig = {'writer_map': { },
+                   'catalogFile': None,
+                   'realtimeMaxLatency': 60,
+                   'realtimeMaxDirtyLines': 1000}
+    extraConfig.update(config)
+    M = meeting.Meeting(channel='#saves', owner='chair',
+                        filename=str(tmp_path / 'saves'),
+                        extraConfig=extraConfig,
+                        sendReply=lambda x: None, setTopic=lambda x: None)
+    M.realtimeSaves = 0
+    save = M.config.save
+    def countingSave(realtime_update=False):
+        if realtime_update:
+            M.realtimeSaves += 1
+        return save(realtime_update=realtime_update)
+    M.config.save = countingSave
+    return M
+
+
+def test_coalesce(tmp_path):
+    M = newMeeting(tmp_path)
+    for i in range(10):
+        M.add_line('nick', 'line %d'%i)
+    assert M.realtimeSaves == 0
+    M.saveScheduler.flush()
+    assert M.realtimeSaves == 1
+    stats = M.saveScheduler.stats()
+    assert stats['requests'] == 10
+    assert stats['saves'] == 1
+    assert stats['coalesced'] == 9
+    assert stats['pending'] == 0
+    # Nothing more to save.
+    M.saveScheduler.flush()
+    assert M.realtimeSaves == 1
+
+
+def test_max_dirty_lines(tmp_path):
+    M = newMeeting(tmp_path, realtimeMaxDirtyLines=5)
+    for i in range(12):
+        M.add_line('nick', 'line %d'%i)
+    assert M.realtimeSaves == 2
+    stats = M.saveScheduler.stats()
+    assert stats['saves'] == 2
+    assert stats['coalesced'] == 8
+    assert stats['pending'] == 2
+
+
+def test_latency(tmp_path):
+    M = newMeeting(tmp_path, realtimeMaxLatency=0.05)
+    M.add_line('nick', 'line')
+    timer = M.saveScheduler._timer
+    assert timer is not None
+    timer.join(10)
+    assert M.realtimeSaves == 1
+    assert M.saveScheduler.stats()['maxLatency'] >= 0.05
+
+
+def test_full_save_discards(tmp_path):
+    M = newMeeting(tmp_path)
+    for i in range(3):
+        M.add_line('nick', 'line %d'%i)
+    M.config.save()
+    assert M.saveScheduler._timer is None
+    stats = M.saveScheduler.stats()
+    assert stats['pending'] == 0
+    assert stats['saves'] == 0
+    assert stats['coalesced'] == 3
+    M.saveScheduler.flush()
+    assert M.realtimeSaves == 0
+
+
+def test_no_saves_after_end(tmp_path):
+    M = newMeeting(tmp_path)
+    M.add_line('chair', '#startmeeting')
+    M.add_line('nick', 'line')
+    M.add_line('chair', '#endmeeting')
+    assert M.meeting_is_over
+    M.add_line('nick', 'too late')
+    assert M.saveScheduler.stats()['pending'] == 0
+    assert M.saveScheduler._timer is None
+
+
+def test_no_saves_during_replay(tmp_path):
+    M = newMeeting(tmp_path)
+    events = [ (journal.LINE, None, 'nick', 'line %d'%i) for i in range(5) ]
+    journal.replay(M, None, events)
+    assert len(M.lines) == 5
+    assert M.saveScheduler.stats()['requests'] == 0
+    assert M.saveScheduler._timer is None
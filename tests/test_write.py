@@ -0,0 +1,153 @@
+"""Tests of writing the output files, see Config.writeToFile.
+
+Files are written to a temporary file which is renamed over them,
+restricted logs are never readable by others (not even for a moment),
+unchanged files aren't written again, and fsync() is called as the
+fsyncPolicy says.
+"""
+
+import os
+import stat
+
+import pytest
+
+from MeetBot2 import meeting
+
+
+@pytest.fixture
+def M(tmp_path):
+    return meeting.Meeting(channel='#write', owner='chair',
+                           filename=str(tmp_path / 'write'),
+                           extraConfig={'writer_map': { },
+                                        'catalogFile': None})
+
+@pytest.fixture
+def replaces(monkeypatch):
+    """The (source, destination) of every rename."""
+    replaces = [ ]
+    replace = os.replace
+    def recordingReplace(src, dst):
+        replaces.append((src, dst))
+        replace(src, dst)
+    monkeypatch.setattr(os, 'replace', recordingReplace)
+    return replaces
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    """The inodes of every file or directory fsync()ed."""
+    fsyncs = [ ]
+    def recordingFsync(fd):
+        fsyncs.append(os.fstat(fd).st_ino)
+    monkeypatch.setattr(os, 'fsync', recordingFsync)
+    return fsyncs
+
+def inode(path):
+    return os.stat(path).st_ino
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_atomic(tmp_path, M, replaces):
+    path = str(tmp_path / 'out.txt')
+    M.config.writeToFile('old', path)
+    def pieces():
+        yield 'new '
+        # Half-way through, the file still has all of the old content.
+        assert read(path) == 'old'
+        yield 'content'
+    M.config.writeToFile(pieces(), path)
+    assert read(path) == 'new content'
+    assert len(replaces) == 2
+    for src, dst in replaces:
+        assert dst == path
+        assert os.path.dirname(src) == str(tmp_path)
+    assert os.listdir(str(tmp_path)) == [ 'out.txt' ]
+
+
+def test_failed_write(tmp_path, M):
+    path = str(tmp_path / 'out.txt')
+    M.config.writeToFile('old', path)
+    def pieces():
+        yield 'new '
+        raise ValueError("broken writer")
+    with pytest.raises(ValueError):
+        M.config.writeToFile(pieces(), path)
+    assert read(path) == 'old'
+    assert os.listdir(str(tmp_path)) == [ 'out.txt' ]
+
+
+def test_restricted(tmp_path, M, monkeypatch):
+    modes = [ ]
+    open_ = os.open
+    def recordingOpen(path, flags, mode=0o777, **kwargs):
+        modes.append(mode)
+        return open_(path, flags, mode, **kwargs)
+    monkeypatch.setattr(os, 'open', recordingOpen)
+    M.restrict_logs = True
+    path = str(tmp_path / 'out.txt')
+    umask = os.umask(0)
+    try:
+        M.config.writeToFile('secret', path)
+    finally:
+        os.umask(umask)
+    # Created without the permissions, not chmod()ed afterwards.
+    assert modes and not modes[0] & M.config.RestrictPerm
+    assert not stat.S_IMODE(os.stat(path).st_mode) & M.config.RestrictPerm
+
+
+def test_unchanged(tmp_path, M, replaces):
+    path = str(tmp_path / 'out.txt')
+    M.config.writeToFile('same', path)
+    M.config.writeToFile('same', path)
+    assert len(replaces) == 1
+    # Generators are only compared once written out.
+    M.config.writeToFile(iter([ 'sa', 'me' ]), path)
+    assert len(replaces) == 1
+    assert os.listdir(str(tmp_path)) == [ 'out.txt' ]
+    # Nor is what is already on disk written again.
+    M2 = meeting.Meeting(channel='#write', owner='chair',
+                         extraConfig={'writer_map': { }})
+    M2.config.writeToFile('same', path)
+    assert len(replaces) == 1
+    # Restricting the logs does write it again.
+    M.restrict_logs = True
+    M.config.writeToFile('same', path)
+    assert len(replaces) == 2
+
+
+def test_fsync_never(tmp_path, M, fsyncs):
+    M.config.fsyncPolicy = 'never'
+    M.config.writeToFile('text', str(tmp_path / 'out.txt'), final=True)
+    assert fsyncs == [ ]
+
+
+def test_fsync_final(tmp_path, M, fsyncs):
+    path = str(tmp_path / 'out.txt')
+    M.config.fsyncPolicy = 'final'
+    M.config.writeToFile('realtime', path)
+    assert fsyncs == [ ]
+    M.config.writeToFile('final', path, final=True)
+    assert sorted(fsyncs) == sorted([ inode(path), inode(str(tmp_path)) ])
+
+
+def test_fsync_interval(tmp_path, M, fsyncs):
+    path1 = str(tmp_path / 'out1.txt')
+    path2 = str(tmp_path / 'out2.txt')
+    M.config.fsyncPolicy = 'interval'
+    M.config.fsyncInterval = 3600
+    M.config.writeToFile('realtime', path1)
+    assert fsyncs == [ ]
+    # The interval is over: everything written since is synced.
+    M.config._lastSync -= 3600
+    M.config.writeToFile('realtime', path2)
+    assert sorted(fsyncs) == sorted([ inode(path1), inode(path2),
+                                      inode(str(tmp_path)) ])
+    del fsyncs[:]
+    # A final save syncs what is left, even within the interval.
+    M.config.writeToFile('realtime again', path1)
+    assert fsyncs == [ ]
+    M.config.writeToFile('final', path2, final=True)
+    assert sorted(fsyncs) == sorted([ inode(path2), inode(path1),
+                                      inode(str(tmp_path)) ])